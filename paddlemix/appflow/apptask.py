@@ -234,5 +234,7 @@ class AppTask(object):
     def __call__(self, *args, **kwargs):
         inputs = self._preprocess(*args)
         outputs = self._run_model(inputs, **kwargs)
+        if self._postprocess is None:
+            return outputs
         results = self._postprocess(outputs)
         return results
@@ -12,12 +12,102 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import functools
+import io
+import os
+import tempfile
+import threading
+import wave
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import librosa
+import numpy as np
+import paddle
+import paddlespeech
+import soundfile
+from packaging import version
 from paddlespeech.cli.whisper import WhisperExecutor
+from paddlespeech.s2t.models.whisper.whisper import (
+    HOP_LENGTH,
+    N_FFT,
+    N_MELS,
+    mel_filters,
+)
 
 from paddlemix.utils.log import logger
 
 from .apptask import AppTask
 
+# Whisper models are trained on 16 kHz audio.
+_WHISPER_SAMPLE_RATE = 16000
+
+# The in-memory path feeds features straight into the `_inputs`/`infer`/`postprocess` stages of
+# WhisperExecutor, which keep this layout since PaddleSpeech 1.3. Older releases go through files.
+_EXECUTOR_STAGES_AVAILABLE = version.parse(version.parse(paddlespeech.__version__).base_version) >= version.parse(
+    "1.3.0"
+)
+
+# WhisperExecutor loads its weights on first use, so executors are shared
+# between task instances built with the same model settings. Each one comes
+# with the lock that serializes the calls on it.
+_EXECUTOR_CACHE = {}
+_EXECUTOR_CACHE_LOCK = threading.Lock()
+
+# Executor arguments that can be overridden per call through the inputs.
+_CALL_KEYS = ("model", "task", "sample_rate", "config", "ckpt_path")
+
+# CPU worker processes, each holding its own executor, keyed like `_EXECUTOR_CACHE` plus the worker count.
+_PROC_POOLS = {}
+
+# Executor state inside a worker process.
+_CHILD_EXECUTOR = None
+_CHILD_CALL_KWARGS = None
+
+# Warm-up wav of this process, created with `mkstemp` so no other process or user can race on it.
+_WARMUP_WAV_PATH = None
+_WARMUP_WAV_LOCK = threading.Lock()
+
+
+def _remove_warmup_wav(path, pid):
+    # Forked workers inherit the path, only the process that created the file removes it.
+    if os.getpid() == pid and os.path.exists(path):
+        os.remove(path)
+
+
+def _get_warmup_wav(sample_rate=16000):
+    """
+    Write one second of 16-bit mono silence used to warm up the executor.
+    """
+    global _WARMUP_WAV_PATH
+    with _WARMUP_WAV_LOCK:
+        if _WARMUP_WAV_PATH is None:
+            fd, path = tempfile.mkstemp(prefix="paddlemix_whisper_warmup_", suffix=".wav")
+            with os.fdopen(fd, "wb") as fp, wave.open(fp, "wb") as f:
+                f.setnchannels(1)
+                f.setsampwidth(2)
+                f.setframerate(sample_rate)
+                f.writeframes(b"\x00\x00" * sample_rate)
+            atexit.register(_remove_warmup_wav, path, os.getpid())
+            _WARMUP_WAV_PATH = path
+    return _WARMUP_WAV_PATH
+
+
+def _init_whisper_in_child(call_kwargs, warmup_wav):
+    """
+    Load the Whisper model once in a worker process of the CPU process pool. `warmup_wav` is created by the
+    parent: workers exit through `os._exit`, so a file of their own would never be removed by `atexit`.
+    """
+    global _CHILD_EXECUTOR, _CHILD_CALL_KWARGS
+    paddle.set_device("cpu")
+    _CHILD_EXECUTOR = WhisperExecutor()
+    _CHILD_CALL_KWARGS = call_kwargs
+    _CHILD_EXECUTOR(audio_file=warmup_wav, **call_kwargs)
+
+
+def _transcribe_in_child(audio_file):
+    return _CHILD_EXECUTOR(audio_file=audio_file, **_CHILD_CALL_KWARGS)["text"]
+
 
 class AudioASRTask(AppTask):
     def __init__(self, task, model, **kwargs):
@@ -26,6 +116,10 @@ class AudioASRTask(AppTask):
         # Default to static mode
         self._static_mode = False
 
+        # Mel filter bank and stft window, built on the device on first use.
+        self._mel_filters = None
+        self._hann_window = None
+
         self._construct_model()
 
     def _construct_model(self):
@@ -33,17 +127,212 @@ class AudioASRTask(AppTask):
         Construct the inference model for the predictor.
         """
 
+        # "paddlespeech" uses WhisperExecutor, "ctranslate2" uses faster-whisper with int8 weights.
+        self._backend = self.kwargs.get("backend", "paddlespeech")
+        if self._backend == "ctranslate2":
+            try:
+                import faster_whisper  # noqa: F401
+            except ImportError:
+                logger.warning("faster-whisper is not installed, fall back to the paddlespeech backend.")
+                self._backend = "paddlespeech"
+
+        # Set `config` and `ckpt_path` to None to use pretrained model.
+        self._call_kwargs = {
+            "model": self.kwargs.get("whisper_model", "whisper"),
+            "task": self.kwargs.get("asr_task", "transcribe"),
+            "sample_rate": self.kwargs.get("sample_rate", 16000),
+            "config": self.kwargs.get("config", None),
+            "ckpt_path": self.kwargs.get("ckpt_path", None),
+        }
+
         # build model
-        whisper_executor = WhisperExecutor()
+        key = self._executor_key()
+
+        # Transcribing in worker processes sidesteps the GIL on CPU, GPU backends stay in-process.
+        self._proc_pool = None
+        if self.kwargs.get("use_procpool", False) and self._backend == "paddlespeech" and paddle.get_device() == "cpu":
+            num_workers = self.kwargs.get("num_workers", max(1, os.cpu_count() // 2))
+            pool_key = key + (num_workers,)
+            with _EXECUTOR_CACHE_LOCK:
+                if pool_key not in _PROC_POOLS:
+                    _PROC_POOLS[pool_key] = ProcessPoolExecutor(
+                        max_workers=num_workers,
+                        initializer=_init_whisper_in_child,
+                        initargs=(self._call_kwargs, _get_warmup_wav()),
+                    )
+                self._proc_pool = _PROC_POOLS[pool_key]
+
+        # With the process pool, the in-process executor only serves in-memory audio and per-call
+        # overrides, so it is built on first use.
+        self._executor = self._executor_lock = None
+        if self._proc_pool is None:
+            self._load_executor(key)
+        if self._backend == "paddlespeech":
+            self._transcribe = functools.partial(self._call_executor, **self._call_kwargs)
+
+    @property
+    def _model(self):
+        if self._executor is None:
+            self._load_executor(self._executor_key())
+        return self._executor
+
+    def _call_executor(self, **kwargs):
+        # WhisperExecutor keeps the inputs and results of a call on itself, so the calls of all the tasks
+        # sharing it must not interleave.
+        model = self._model
+        with self._executor_lock:
+            return model(**kwargs)
+
+    def _load_executor(self, key):
+        """
+        Get the shared in-process executor for `key`, building it on first use.
+        """
+        with _EXECUTOR_CACHE_LOCK:
+            if key not in _EXECUTOR_CACHE:
+                if self._backend == "ctranslate2":
+                    whisper_executor = self._build_ctranslate2_model()
+                else:
+                    whisper_executor = WhisperExecutor()
+                    if self.kwargs.get("warmup", True) and self._proc_pool is None:
+                        # Load the weights and build the decoding graph before the first request.
+                        whisper_executor(audio_file=_get_warmup_wav(), **self._call_kwargs)
+                _EXECUTOR_CACHE[key] = (whisper_executor, threading.Lock())
+            self._executor, self._executor_lock = _EXECUTOR_CACHE[key]
+
+    def _executor_key(self):
+        """
+        Key of the shared executor: the backend, the device and every argument the executor is called
+        or, for faster-whisper, constructed with.
+        """
+        key = (self._backend, self.model, paddle.get_device()) + tuple(sorted(self._call_kwargs.items()))
+        if self._backend == "ctranslate2":
+            key += (
+                self.kwargs.get("model_size", "large-v2"),
+                self.kwargs.get("device_id", 0),
+                self.kwargs.get("compute_type", None),
+                self.kwargs.get("num_workers", 1),
+                self._num_threads,
+            )
+        return key
+
+    def _build_ctranslate2_model(self):
+        """
+        Construct a faster-whisper model running on CTranslate2.
+        """
+        from faster_whisper import WhisperModel
+
+        if paddle.get_device().startswith("gpu"):
+            device, compute_type = "cuda", "int8_float16"
+        else:
+            device, compute_type = "cpu", "int8"
+        return WhisperModel(
+            self.kwargs.get("model_size", "large-v2"),
+            device=device,
+            device_index=self.kwargs.get("device_id", 0),
+            compute_type=self.kwargs.get("compute_type", compute_type),
+            cpu_threads=self._num_threads,
+            num_workers=self.kwargs.get("num_workers", 1),
+        )
 
-        self._model = whisper_executor
+    def _transcribe_ctranslate2(self, audio_file, task, use_vad):
+        """
+        Transcribe with faster-whisper. With VAD enabled, the speech segments are decoded
+        in parallel by the CTranslate2 workers and joined back in time order.
+        """
+        num_workers = self.kwargs.get("num_workers", 1)
+        if not use_vad or num_workers <= 1:
+            segments, _ = self._model.transcribe(audio_file, task=task, beam_size=5, vad_filter=use_vad)
+            return "".join(segment.text for segment in segments).strip()
+
+        from faster_whisper.audio import decode_audio
+        from faster_whisper.vad import get_speech_timestamps
+
+        audio = decode_audio(audio_file, sampling_rate=16000)
+        chunks = [audio[ts["start"] : ts["end"]] for ts in get_speech_timestamps(audio)]
+
+        def _transcribe_chunk(chunk):
+            segments, _ = self._model.transcribe(chunk, task=task, beam_size=5, without_timestamps=True)
+            return "".join(segment.text for segment in segments)
+
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            texts = list(pool.map(_transcribe_chunk, chunks))
+        return "".join(texts).strip()
+
+    def _log_mel_spectrogram(self, waveforms):
+        """
+        Compute Whisper log-mel features for several waveforms with one batched stft on the device.
+        """
+        if self._mel_filters is None:
+            self._mel_filters = paddle.to_tensor(mel_filters(self._model.resource_path, N_MELS))
+            self._hann_window = paddle.audio.functional.get_window("hann", N_FFT)
+
+        # Each clip gets the reflect padding of a centered stft on its own, and only the zeros beyond that
+        # are shared padding. The frames kept per clip never reach them, so the features of a clip do not
+        # depend on the other clips in the batch.
+        lengths = [waveform.shape[0] for waveform in waveforms]
+        batch = np.zeros((len(waveforms), max(lengths) + N_FFT), dtype="float32")
+        for i, waveform in enumerate(waveforms):
+            batch[i, : lengths[i] + N_FFT] = np.pad(waveform, N_FFT // 2, mode="reflect")
+
+        stft = paddle.signal.stft(paddle.to_tensor(batch), N_FFT, HOP_LENGTH, window=self._hann_window, center=False)
+        magnitudes = stft[:, :, :-1].abs() ** 2
+        log_spec = paddle.clip(paddle.matmul(self._mel_filters, magnitudes), min=1e-10).log10()
+
+        mels = []
+        for i, length in enumerate(lengths):
+            mel = log_spec[i, :, : length // HOP_LENGTH]
+            mel = paddle.maximum(mel, mel.max() - 8.0)
+            mels.append((mel + 4.0) / 4.0)
+        return mels
+
+    def _transcribe_in_memory(self, audios, **kwargs):
+        """
+        Transcribe wav buffers or 16 kHz waveform arrays without going through files on disk.
+        The features of all inputs are extracted in one batch.
+        """
+        waveforms = []
+        for audio in audios:
+            if isinstance(audio, io.BytesIO):
+                audio, sample_rate = soundfile.read(audio, dtype="float32", always_2d=True)
+                audio = audio[:, 0]
+                if sample_rate != _WHISPER_SAMPLE_RATE:
+                    audio = librosa.resample(audio, orig_sr=sample_rate, target_sr=_WHISPER_SAMPLE_RATE)
+            waveforms.append(audio.astype("float32"))
+
+        if not _EXECUTOR_STAGES_AVAILABLE:
+            return [self._transcribe_waveform_file(waveform, **kwargs) for waveform in waveforms]
+
+        model = self._model
+        results = []
+        with self._executor_lock:
+            if not hasattr(model, "model"):
+                # The executor only loads its weights inside `__call__`.
+                model(audio_file=_get_warmup_wav(), **kwargs)
+
+            for mel in self._log_mel_spectrogram(waveforms):
+                model._inputs["audio"] = mel
+                model._inputs["audio_len"] = paddle.to_tensor(mel.shape[0]).unsqueeze(axis=0)
+                model.infer(kwargs["model"])
+                results.append(model.postprocess())
+        return results
+
+    def _transcribe_waveform_file(self, waveform, **kwargs):
+        """
+        Transcribe a 16 kHz waveform through the public executor call on a private temporary wav file.
+        """
+        fd, path = tempfile.mkstemp(suffix=".wav")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                soundfile.write(f, waveform, _WHISPER_SAMPLE_RATE, format="WAV", subtype="PCM_16")
+            return self._call_executor(audio_file=path, **kwargs)
+        finally:
+            os.remove(path)
 
     def _preprocess(self, inputs):
         """ """
-        audio = inputs.get("audio", None)
-        assert audio is not None, "The image is None"
-        prompt = inputs.get("prompt")
-        assert prompt is not None, "The prompt is None"
+        for key in ("audio", "prompt"):
+            if inputs.get(key) is None:
+                raise ValueError(f"The {key} is None")
         return inputs
 
     def _run_model(self, inputs):
@@ -51,29 +340,93 @@ class AudioASRTask(AppTask):
         Run the task model from the outputs of the `_preprocess` function.
         """
 
-        _model = inputs.get("model", "whisper")
-        _task = inputs.get("task", "transcribe")
-        _sample_rate = inputs.get("sample_rate", 16000)
-        _config = inputs.get("config", None)
-        _ckpt_path = inputs.get("ckpt_path", None)
+        overrides = {key: inputs[key] for key in _CALL_KEYS if key in inputs}
+        if overrides:
+            call_kwargs = dict(self._call_kwargs, **overrides)
+            transcribe = functools.partial(self._call_executor, **call_kwargs)
+        else:
+            call_kwargs = self._call_kwargs
+            transcribe = self._transcribe if self._backend == "paddlespeech" else None
 
-        result = self._model(
-            model=_model,
-            task=_task,
-            sample_rate=_sample_rate,
-            config=_config,  # Set `_config` and `_ckpt_path` to None to use pretrained model.
-            ckpt_path=_ckpt_path,
-            audio_file=inputs["audio"],
-        )
-        logger.info("Audio File ASR Result: {}".format(result["text"]))
+        # A list of audio files is transcribed in one pass; the executor keeps the
+        # model loaded after the first file, so only feature extraction and decoding
+        # run per file.
+        audio = inputs["audio"]
+        is_batched = isinstance(audio, (list, tuple))
+        audio_files = audio if is_batched else [audio]
+
+        texts = [None] * len(audio_files)
+        in_memory = []
+        futures = []
+        for idx, audio_file in enumerate(audio_files):
+            if self._proc_pool is not None and not overrides and isinstance(audio_file, (str, os.PathLike)):
+                futures.append((idx, self._proc_pool.submit(_transcribe_in_child, audio_file)))
+                continue
+
+            if isinstance(audio_file, (bytes, bytearray)):
+                audio_file = io.BytesIO(audio_file)
+
+            if self._backend == "ctranslate2":
+                texts[idx] = self._transcribe_ctranslate2(audio_file, call_kwargs["task"], inputs.get("use_vad", True))
+            elif isinstance(audio_file, (io.BytesIO, np.ndarray)):
+                in_memory.append((idx, audio_file))
+            else:
+                texts[idx] = transcribe(audio_file=audio_file)["text"]
+
+        if in_memory:
+            indices, audios = zip(*in_memory)
+            results = self._transcribe_in_memory(audios, **call_kwargs)
+            for idx, result in zip(indices, results):
+                texts[idx] = result["text"]
 
-        inputs["prompt"] = inputs["prompt"].format(result["text"])
+        for idx, future in futures:
+            texts[idx] = future.result()
+
+        for text in texts:
+            logger.info("Audio File ASR Result: %s", text)
+
+        prompt = inputs["prompt"]
+        # Only run `str.format` when the prompt has a placeholder for the transcription.
+        if "{}" in prompt or "{0}" in prompt:
+            prompts = [prompt.format(text) for text in texts]
+        else:
+            prompts = [prompt + " " + text for text in texts]
+        inputs["prompt"] = prompts if is_batched else prompts[0]
 
         return inputs
 
-    def _postprocess(self, inputs):
+    def _run_model_stream(self, inputs):
         """
-        The model output is tag ids, this function will convert the model output to raw text.
+        Generator variant of `_run_model` that yields the transcription piece by piece:
+        per decoded segment with faster-whisper, per audio file with PaddleSpeech.
         """
+        overrides = {key: inputs[key] for key in _CALL_KEYS if key in inputs}
+        call_kwargs = dict(self._call_kwargs, **overrides)
 
-        return inputs
+        audio = inputs["audio"]
+        audio_files = audio if isinstance(audio, (list, tuple)) else [audio]
+        for audio_file in audio_files:
+            if isinstance(audio_file, (bytes, bytearray)):
+                audio_file = io.BytesIO(audio_file)
+
+            if self._backend == "ctranslate2":
+                segments, _ = self._model.transcribe(
+                    audio_file, task=call_kwargs["task"], beam_size=5, vad_filter=inputs.get("use_vad", True)
+                )
+                # faster-whisper decodes lazily, each segment is ready as soon as it is yielded.
+                for segment in segments:
+                    yield segment.text
+            elif isinstance(audio_file, (io.BytesIO, np.ndarray)):
+                yield self._transcribe_in_memory([audio_file], **call_kwargs)[0]["text"]
+            else:
+                yield self._call_executor(audio_file=audio_file, **call_kwargs)["text"]
+
+    def stream(self, inputs):
+        """
+        Transcribe `inputs["audio"]` and yield partial texts as soon as they are decoded.
+        """
+        inputs = self._preprocess(inputs)
+        yield from self._run_model_stream(inputs)
+
+    # The prompt built in `_run_model` is the final output, `AppTask.__call__` skips this stage.
+    _postprocess = None
@@ -13,14 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import copy
+import functools
+import hashlib
+import json
+import mmap
 import os
 import re
+import threading
+import uuid
 import warnings
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from itertools import chain
 from pathlib import Path
-from typing import Callable, Dict, List, Optional, Union
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 
+import numpy as np
 import paddle
 import paddle.nn as nn
 import paddle.nn.functional as F
@@ -38,6 +47,7 @@ from .utils import (
     TO_DIFFUSERS,
     _get_model_file,
     deprecate,
+    get_map_location_default,
     is_omegaconf_available,
     is_paddlenlp_available,
     is_safetensors_available,
@@ -73,6 +83,16 @@ TORCH_LORA_WEIGHT_NAME = "pytorch_lora_weights.bin"
 TORCH_LORA_WEIGHT_NAME_SAFE = "pytorch_lora_weights.safetensors"
 PADDLE_LORA_WEIGHT_NAME = "paddle_lora_weights.pdparams"
 
+# Default LoRA file name by `(to_diffusers, safe_serialization)`.
+_LORA_WEIGHT_NAMES = {
+    (True, True): TORCH_LORA_WEIGHT_NAME_SAFE,
+    (True, False): TORCH_LORA_WEIGHT_NAME,
+    (False, True): PADDLE_LORA_WEIGHT_NAME,
+    (False, False): PADDLE_LORA_WEIGHT_NAME,
+}
+# Above this many bytes the diffusers safetensors LoRA file is split into shards plus a `.index.json` file.
+_LORA_MAX_SHARD_SIZE = 5 * 1024**3
+
 TORCH_TEXT_INVERSION_NAME = "learned_embeds.bin"
 TORCH_TEXT_INVERSION_NAME_SAFE = "learned_embeds.safetensors"
 PADDLE_TEXT_INVERSION_NAME = "learned_embeds.pdparams"
@@ -81,22 +101,649 @@ TORCH_CUSTOM_DIFFUSION_WEIGHT_NAME = "pytorch_custom_diffusion_weights.bin"
 TORCH_CUSTOM_DIFFUSION_WEIGHT_NAME_SAFE = "pytorch_custom_diffusion_weights.safetensors"
 PADDLE_CUSTOM_DIFFUSION_WEIGHT_NAME = "paddle_custom_diffusion_weights.pdparams"
 
+# Up weights of the text encoder projections that get patched with LoRA layers.
+_LORA_UP_WEIGHT_RE = re.compile(
+    r"^(.*)\.(q_proj|k_proj|v_proj|out_proj|linear1|linear2)\.lora_linear_layer\.up\.weight$"
+)
+
+# Renames from diffusers to ppdiffusers parameter names, applied in order.
+_DIFFUSERS_NAME_MAPPING = {
+    ".encoder.": ".transformer.",
+    ".layer_norm": ".norm",
+    ".mlp.": ".",
+    ".fc1.": ".linear1.",
+    ".fc2.": ".linear2.",
+    ".final_layer_norm.": ".ln_final.",
+    ".embeddings.": ".",
+    ".position_embedding.": ".positional_embedding.",
+    ".patch_embedding.": ".conv1.",
+    "visual_projection.weight": "vision_projection",
+    "text_projection.weight": "text_projection",
+    ".pre_layrnorm.": ".ln_pre.",
+    ".post_layernorm.": ".ln_post.",
+}
+# Matches a name that any of the renames above applies to.
+_DIFFUSERS_NAME_RE = re.compile("|".join(map(re.escape, _DIFFUSERS_NAME_MAPPING)))
+# Renames from ppdiffusers to diffusers parameter names when saving, as `(old, new)` pairs.
+_TO_DIFFUSERS_NAME_MAPPING = ((".transformer.", ".encoder."),)
+
+# Key prefixes of A1111 / kohya-ss formatted LoRA checkpoints.
+_KOHYA_PREFIXES = ("lora_te_", "lora_unet_", "lora_te1_", "lora_te2_")
+
+
+@functools.lru_cache(maxsize=16384)
+def _diffusers_to_ppdiffusers_name(name):
+    """
+    Rename a diffusers parameter name to its ppdiffusers counterpart. A single regex search skips the names
+    no rename applies to (most UNet ones), and the result is cached since LoRA keys repeat across loads.
+    """
+    if _DIFFUSERS_NAME_RE.search(name) is None:
+        return name
+    # The renames are applied one after the other, a rename can expose the pattern of a later one
+    # (`.mlp.fc1.` -> `.fc1.` -> `.linear1.`), so they cannot be done in a single substitution pass.
+    for old_name, new_name in _DIFFUSERS_NAME_MAPPING.items():
+        name = name.replace(old_name, new_name)
+    return name
+
 
-def transpose_state_dict(state_dict, name_mapping=None):
+@functools.lru_cache(maxsize=16384)
+def _rename_key(key, name_mapping):
+    """
+    Apply the `(old, new)` renames of `name_mapping` to `key`. Cached, a training loop saves the same keys
+    every time, and most of them (all the UNet ones for `.transformer.`) need no rename at all.
+    """
+    for old_name, new_name in name_mapping:
+        if old_name in key:
+            key = key.replace(old_name, new_name)
+    return key
+
+
+def transpose_state_dict(state_dict, name_mapping=None, consume=False):
+    # Only the 2-D linear weights change layout, every other tensor is passed through untouched.
+    if not name_mapping and not any(v.ndim == 2 for v in state_dict.values()):
+        return state_dict
+    name_mapping = tuple(name_mapping.items()) if name_mapping else None
     new_state_dict = {}
-    for k, v in state_dict.items():
+    # With `consume=True` the input is emptied on the way, so each tensor and its transposed copy are
+    # the only pair alive together instead of both whole state dicts.
+    for k in list(state_dict):
+        v = state_dict.pop(k) if consume else state_dict[k]
         if name_mapping is not None:
-            for old_name, new_name in name_mapping.items():
-                k = k.replace(old_name, new_name)
+            k = _rename_key(k, name_mapping)
         if v.ndim == 2:
             new_state_dict[k] = v.T.contiguous() if hasattr(v, "contiguous") else v.T
         else:
-            new_state_dict[k] = v.contiguous() if hasattr(v, "contiguous") else v
+            new_state_dict[k] = v
     return new_state_dict
 
 
+def _mmap_safe_load(path):
+    """
+    Load a `.safetensors` file tensor by tensor from a memory map, so the checkpoint is not
+    first materialized as a whole numpy dict and then copied again into paddle tensors.
+    """
+    state_dict = {}
+    with paddle.device_scope(get_map_location_default()):
+        with safetensors.safe_open(path, framework="np") as f:
+            for k in f.keys():
+                v = f.get_tensor(k)
+                if v.ndim == 0:
+                    v = v.reshape((1,))
+                state_dict[k] = paddle.to_tensor(v)
+            tied = (f.metadata() or {}).get("tied")
+    # Tied tensors are stored once by `_stream_safe_save`, the other keys point at the stored one.
+    if tied is not None:
+        for k, first_key in json.loads(tied).items():
+            state_dict[k] = state_dict[first_key]
+    return state_dict
+
+
+_SAFETENSORS_DTYPES = {
+    paddle.float64: ("F64", 8),
+    paddle.float32: ("F32", 4),
+    paddle.float16: ("F16", 2),
+    paddle.bfloat16: ("BF16", 2),
+    paddle.int64: ("I64", 8),
+    paddle.int32: ("I32", 4),
+    paddle.int16: ("I16", 2),
+    paddle.int8: ("I8", 1),
+    paddle.uint8: ("U8", 1),
+    paddle.bool: ("BOOL", 1),
+}
+
+
+def _host_array(tensor):
+    """
+    A numpy array holding the bytes of `tensor`. Cpu tensors are viewed in place through the buffer protocol of
+    their dense tensor instead of being copied by `Tensor.numpy()`, other tensors are copied to the host.
+    bfloat16 tensors come back as uint16 arrays, which have the same byte layout.
+    """
+    if tensor.place.is_cpu_place():
+        try:
+            return np.array(tensor.get_tensor(), copy=False)
+        except Exception:
+            pass
+    return tensor.numpy()
+
+
+def _stream_safe_save(state_dict, path, metadata=None, transpose=False, dedupe_tied=True):
+    """
+    Write paddle tensors to a `.safetensors` file without building an intermediate numpy/torch dict.
+    The header and byte offsets are computed from shapes and dtypes alone, then every tensor is copied
+    straight into its slice of the memory-mapped file, so only one tensor lives on the host at a time.
+    With `transpose=True` the 2-D tensors are written transposed (the torch layout of linear weights).
+    With `dedupe_tied=True` a tensor stored under several keys (tied weights) is written once, the other keys
+    are recorded as aliases in the `"tied"` metadata entry, which only `_mmap_safe_load` expands again. Files
+    meant for other libraries need `dedupe_tied=False`, which writes every key.
+    """
+    header = {}
+    metadata = dict(metadata or {})
+    offset = 0
+    first_keys = {}
+    tied = {}
+    for k, v in state_dict.items():
+        first_key = first_keys.setdefault(id(v), k) if dedupe_tied else k
+        if first_key != k:
+            tied[k] = first_key
+            continue
+        dtype, itemsize = _SAFETENSORS_DTYPES[v.dtype]
+        shape = list(v.shape)
+        if transpose and len(shape) == 2:
+            shape.reverse()
+        nbytes = int(np.prod(shape, dtype=np.int64)) * itemsize
+        header[k] = {"dtype": dtype, "shape": shape, "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    if tied:
+        metadata["tied"] = json.dumps(tied)
+    if metadata:
+        header["__metadata__"] = metadata
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # The data section has to start on an 8 byte boundary, the header is padded with spaces.
+    header_bytes += b" " * (-len(header_bytes) % 8)
+    body_start = 8 + len(header_bytes)
+
+    def host_bytes(tensor, nbytes):
+        array = _host_array(tensor)
+        if array.nbytes != nbytes:
+            array = tensor.numpy()
+        if transpose and array.ndim == 2:
+            array = array.T
+        return np.ascontiguousarray(array)
+
+    to_write = []
+    for k, v in state_dict.items():
+        if k not in tied and header[k]["data_offsets"][0] != header[k]["data_offsets"][1]:
+            to_write.append((header[k]["data_offsets"], v))
+
+    with open(path, "wb+") as f:
+        f.truncate(body_start + offset)
+        with mmap.mmap(f.fileno(), body_start + offset) as mm:
+            mm[:8] = len(header_bytes).to_bytes(8, "little")
+            mm[8:body_start] = header_bytes
+            if all(v.place.is_cpu_place() for _, v in to_write):
+                for (begin, end), v in to_write:
+                    mm[body_start + begin : body_start + end] = memoryview(host_bytes(v, end - begin)).cast("B")
+                return
+
+            # Device tensors: the device to host copies stay on the calling thread, ordered with its compute,
+            # and a worker copies the previous tensor into the file meanwhile. At most two tensors are on the
+            # host at a time.
+            def write(begin, end, array):
+                mm[body_start + begin : body_start + end] = memoryview(array).cast("B")
+
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                pending = None
+                for (begin, end), v in to_write:
+                    array = host_bytes(v, end - begin)
+                    if pending is not None:
+                        pending.result()
+                    pending = pool.submit(write, begin, end, array)
+                    del array
+                if pending is not None:
+                    pending.result()
+
+
+def _safetensors_nbytes(tensor):
+    return int(np.prod(tensor.shape, dtype=np.int64)) * _SAFETENSORS_DTYPES[tensor.dtype][1]
+
+
+def _shard_state_dict(state_dict, max_shard_size, dedupe_tied=True):
+    """
+    Split `state_dict` greedily, in key order, into shards of at most `max_shard_size` bytes; a tensor larger
+    than that gets a shard of its own. With `dedupe_tied=True` tied keys go to the shard of the first key of
+    their tensor, so `_stream_safe_save` still writes every tensor once. Returns the shards and their sizes in
+    bytes.
+    """
+    shards, sizes = [{}], [0]
+    shard_of = {}
+    for k, v in state_dict.items():
+        shard = shard_of.get(id(v)) if dedupe_tied else None
+        if shard is not None:
+            shard[k] = v
+            continue
+        nbytes = _safetensors_nbytes(v)
+        if shards[-1] and sizes[-1] + nbytes > max_shard_size:
+            shards.append({})
+            sizes.append(0)
+        shards[-1][k] = v
+        sizes[-1] += nbytes
+        shard_of[id(v)] = shards[-1]
+    return shards, sizes
+
+
+def _write_json(obj, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+
+
+# The `Future`s of the `write_lora_layers(..., async_save=True)` calls that have not finished, by target directory.
+_PENDING_LORA_SAVES = {}
+_PENDING_LORA_SAVES_LOCK = threading.Lock()
+
+
+def _forget_pending_lora_save(save_directory, future):
+    with _PENDING_LORA_SAVES_LOCK:
+        if _PENDING_LORA_SAVES.get(save_directory) is future:
+            del _PENDING_LORA_SAVES[save_directory]
+
+
+@functools.lru_cache(maxsize=None)
+def _lora_save_executor():
+    # A single worker keeps background LoRA saves in submission order.
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="lora_save")
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_lora_save_function(to_diffusers, safe_serialization):
+    """
+    The default save function of `write_lora_layers`, built once per combination of flags.
+    """
+    if not to_diffusers:
+        return paddle.save
+    if safe_serialization:
+        # The torch layout is written tensor by tensor, `write_lora_layers` does not transpose first. Every key
+        # is written, diffusers does not know the `"tied"` aliases.
+        return functools.partial(_stream_safe_save, metadata={"format": "pt"}, transpose=True, dedupe_tied=False)
+    if not is_torch_available():
+        raise ImportError(
+            "`to_diffusers=True` with `safe_serialization=False` requires the `torch library: `pip install torch`."
+        )
+    return torch.save
+
+
+def _atomic_save(save_function, state_dict, save_path):
+    """
+    Write with `save_function` to a temporary file next to `save_path`, then move it into place. A process killed
+    mid-save leaves the previous checkpoint intact instead of a truncated file.
+    """
+    save_directory, weight_name = os.path.split(save_path)
+    # A random name: pids are not unique across the hosts sharing a filesystem in multi-node training.
+    tmp_path = os.path.join(save_directory, f".{weight_name}.tmp.{uuid.uuid4().hex}")
+    try:
+        save_function(state_dict, tmp_path)
+        fd = os.open(tmp_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    # Persist the rename itself, directories can't be opened this way on Windows.
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(save_directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _load_lora_file(model_file):
+    if str(model_file).endswith(".index.json"):
+        # Sharded file: the index maps every key to its shard, which sits next to the index.
+        with open(model_file, "r", encoding="utf-8") as f:
+            weight_map = json.load(f)["weight_map"]
+        shard_dir = os.path.dirname(model_file)
+        state_dict = {}
+        for shard_file in dict.fromkeys(weight_map.values()):
+            state_dict.update(_load_lora_file(os.path.join(shard_dir, shard_file)))
+        return state_dict
+    if is_safetensors_available() and str(model_file).endswith(".safetensors"):
+        try:
+            return _mmap_safe_load(model_file)
+        except Exception:
+            logger.info(f"Cant load file {model_file} with safetensors.safe_open, falling back to `smart_load`!")
+    return smart_load(model_file)
+
+
+# Kohya LoRA files already converted to the diffusers layout, keyed by file path, mtime, size and unet config.
+# Only the most recently used files are kept.
+LORA_CONVERTED_CACHE_DIR = os.path.join(PPDIFFUSERS_CACHE, "lora_converted")
+LORA_CONVERTED_CACHE_MAX_FILES = 32
+
+
+def _converted_kohya_lora_file(model_file, unet_config=None):
+    if not is_safetensors_available() or not os.path.isfile(model_file):
+        return None
+    stat = os.stat(model_file)
+    config = None if unet_config is None else sorted(unet_config.items())
+    key = f"{os.path.abspath(model_file)}:{stat.st_mtime_ns}:{stat.st_size}:{config}"
+    return os.path.join(LORA_CONVERTED_CACHE_DIR, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".safetensors")
+
+
+def _load_converted_kohya_lora(converted_file):
+    """
+    Load a cached conversion, returns None when it is missing or can't be read so the file is converted again.
+    """
+    if not os.path.isfile(converted_file):
+        return None
+    try:
+        with safetensors.safe_open(converted_file, framework="np") as f:
+            metadata = f.metadata()
+        network_alphas = json.loads(metadata["alphas_json"])
+        state_dict = _mmap_safe_load(converted_file)
+        # bfloat16 tensors are stored as their uint16 bit patterns and come back as bfloat16.
+        for k in json.loads(metadata.get("bfloat16_json", "[]")):
+            if state_dict[k].dtype != paddle.bfloat16:
+                raise ValueError(f"{k} was not loaded as bfloat16")
+    except Exception as e:
+        logger.info(f"Ignoring the cached converted LoRA weights {converted_file}: {e}")
+        try:
+            os.remove(converted_file)
+        except OSError:
+            pass
+        return None
+    # Mark the file as recently used for `_evict_converted_kohya_loras`.
+    os.utime(converted_file)
+    return state_dict, network_alphas
+
+
+def _evict_converted_kohya_loras():
+    entries = [entry for entry in os.scandir(LORA_CONVERTED_CACHE_DIR) if entry.name.endswith(".safetensors")]
+    entries.sort(key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+    for entry in entries[LORA_CONVERTED_CACHE_MAX_FILES:]:
+        os.remove(entry.path)
+
+
+def _save_converted_kohya_lora(converted_file, state_dict, network_alphas):
+    import safetensors.numpy
+
+    tmp_file = f"{converted_file}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(converted_file), exist_ok=True)
+        # `Tensor.numpy()` returns the bit patterns of bfloat16 tensors as uint16 arrays.
+        safetensors.numpy.save_file(
+            {k: v.numpy() for k, v in state_dict.items()},
+            tmp_file,
+            metadata={
+                "alphas_json": json.dumps(network_alphas),
+                "bfloat16_json": json.dumps([k for k, v in state_dict.items() if v.dtype == paddle.bfloat16]),
+            },
+        )
+        os.replace(tmp_file, converted_file)
+        _evict_converted_kohya_loras()
+    except Exception as e:
+        logger.info(f"Could not cache the converted LoRA weights to {converted_file}: {e}")
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def _fold_network_alpha(state_dict, network_alpha):
+    """
+    Scale the LoRA up weights of `state_dict` by `network_alpha / rank` once at load time, so the LoRA layers
+    can be created without `network_alpha` and skip that multiply in every forward.
+    """
+    if network_alpha is None:
+        return state_dict
+    folded = dict(state_dict)
+    for key, down in state_dict.items():
+        if key.endswith("down.weight"):
+            rank = down.shape[1] if down.ndim == 2 else down.shape[0]
+            up_key = key[: -len("down.weight")] + "up.weight"
+            folded[up_key] = state_dict[up_key] * (network_alpha / rank)
+    return folded
+
+
+# Resolved LoRA weight files and their `_lora_file_signature`, keyed by the arguments that select the file.
+_LORA_FILE_CACHE = {}
+
+
+def _lora_file_signature(model_file, local_dir):
+    """
+    mtime and size of the resolved file, plus the mtime of the local directory it was picked from: a file
+    re-saved in place or a candidate added to the directory invalidates the cached resolution.
+    """
+    stat = os.stat(model_file)
+    dir_mtime = os.stat(local_dir).st_mtime_ns if os.path.isdir(local_dir) else None
+    return stat.st_mtime_ns, stat.st_size, dir_mtime
+
+
+def _resolve_lora_file(pretrained_model_name_or_path, from_diffusers, weight_name, use_safetensors, **kwargs):
+    """
+    Resolve the LoRA weight file to load. Local directories are listed once instead of probing
+    each candidate name, and the hub is only queried for candidates that are not found locally.
+    """
+    cache_key = (
+        str(pretrained_model_name_or_path),
+        from_diffusers,
+        weight_name,
+        use_safetensors,
+        kwargs.get("revision"),
+        kwargs.get("subfolder"),
+        kwargs.get("from_hf_hub"),
+        kwargs.get("cache_dir"),
+        kwargs.get("local_files_only"),
+    )
+    local_dir = os.path.join(str(pretrained_model_name_or_path), kwargs.get("subfolder") or "")
+    cached = _LORA_FILE_CACHE.get(cache_key)
+    if cached is not None and not kwargs.get("force_download"):
+        model_file, signature = cached
+        try:
+            if _lora_file_signature(model_file, local_dir) == signature:
+                return model_file
+        except OSError:
+            pass
+
+    if weight_name is not None:
+        candidates = [weight_name]
+    elif from_diffusers:
+        # Let's first try to load .safetensors weights
+        candidates = (
+            [TORCH_LORA_WEIGHT_NAME_SAFE, TORCH_LORA_WEIGHT_NAME] if use_safetensors else [TORCH_LORA_WEIGHT_NAME]
+        )
+    else:
+        candidates = [PADDLE_LORA_WEIGHT_NAME]
+
+    model_file = None
+    if os.path.isdir(local_dir):
+        local_files = set(os.listdir(local_dir))
+        for name in candidates:
+            if name in local_files:
+                model_file = os.path.join(local_dir, name)
+                break
+            if name + ".index.json" in local_files:
+                model_file = os.path.join(local_dir, name + ".index.json")
+                break
+
+    if model_file is None:
+        for i, name in enumerate(candidates):
+            try:
+                model_file = _get_model_file(pretrained_model_name_or_path, weights_name=name, **kwargs)
+                break
+            except Exception:
+                if i == len(candidates) - 1:
+                    raise
+
+    _LORA_FILE_CACHE[cache_key] = (model_file, _lora_file_signature(model_file, local_dir))
+    return model_file
+
+
+def _split_lora_state_dict(state_dict, prefixes):
+    """
+    Partition `state_dict` in a single pass into one dict per prefix, with the `"{prefix}."` part
+    stripped from the keys, and a dict of the entries that match none of the prefixes.
+    """
+    prefix_dots = {prefix: prefix + "." for prefix in prefixes}
+    splits = {prefix: {} for prefix in prefixes}
+    rest = {}
+    for k, v in state_dict.items():
+        for prefix, prefix_dot in prefix_dots.items():
+            if k.startswith(prefix_dot):
+                splits[prefix][k[len(prefix_dot) :]] = v
+                break
+        else:
+            rest[k] = v
+    return splits, rest
+
+
+# Suffixes of the old text encoder LoRA naming convention and their `PatchedLoraProjection` counterparts.
+_LEGACY_TEXT_ENCODER_LORA_SUFFIXES = {
+    f"to_{proj}_lora.{kind}.weight": f"{proj}_proj.lora_linear_layer.{kind}.weight"
+    for proj in ("q", "k", "v", "out")
+    for kind in ("up", "down")
+}
+
+
+_TEXT_ENCODER_ALPHA_PREFIXES = ("text_encoder.", "text_encoder_2.")
+
+
+def _convert_legacy_text_encoder_lora_key(key):
+    # One split and one dict lookup per key instead of rebuilding every candidate key per attention module.
+    module_name, _, suffix = key.rpartition(".to_")
+    new_suffix = _LEGACY_TEXT_ENCODER_LORA_SUFFIXES.get("to_" + suffix)
+    return key if new_suffix is None else f"{module_name}.{new_suffix}"
+
+
+@paddle.no_grad()
+def _assign_state_dict(model, state_dict, place=None, share_tensors=False):
+    """
+    Load `state_dict` into `model` by letting every parameter share the storage of a tensor instead of copying
+    into it. Cpu tensors headed for a GPU are batched per dtype: they are packed into one flat buffer, staged in
+    pinned memory and sent with a single non-blocking copy, then split back into per-parameter pieces on the
+    device. Values are cast to the parameter dtype on the target device. The tensors of `state_dict` itself are
+    only shared with `share_tensors=True`, for state dicts the loader created and nobody else holds; otherwise
+    the parameters get a copy. Parameters that are not materialized yet (created under `paddle.LazyGuard`) are
+    placed on `place`. Returns the keys that do not match any parameter of `model`.
+    """
+
+    def share(param, value, fresh=True):
+        if value.dtype != param.dtype:
+            value = value.cast(param.dtype)
+        elif not fresh:
+            value = value.clone()
+        if value.shape == param.shape:
+            value._share_buffer_to(param)
+        else:
+            param.set_value(value)
+
+    params = dict(model.named_parameters())
+    unexpected_keys = []
+    host_to_device = defaultdict(list)
+    for key, value in state_dict.items():
+        param = params.get(key)
+        if param is None:
+            unexpected_keys.append(key)
+            continue
+        target_place = param.place if place is None or param._is_initialized() else place
+        if value.place.is_cpu_place() and target_place.is_gpu_place() and value.size > 0:
+            host_to_device[(value.dtype, str(target_place))].append((param, value, target_place))
+            continue
+        if not value.place._equals(target_place):
+            share(param, value._copy_to(target_place, False))
+        else:
+            share(param, value, fresh=share_tensors)
+
+    for group in host_to_device.values():
+        values = [value for _, value, _ in group]
+        flat = paddle.concat([value.reshape([-1]) for value in values])
+        flat = flat._copy_to(paddle.CUDAPinnedPlace(), True)._copy_to(group[0][2], False)
+        pieces = paddle.split(flat, [value.size for value in values])
+        for (param, value, _), piece in zip(group, pieces):
+            share(param, piece.reshape(value.shape))
+    return unexpected_keys
+
+
+# LoRA down weights that can be folded into a base linear layer. The first group is the path of
+# the module holding the LoRA layer, the optional second group the projection of an attention processor.
+_LORA_MERGE_RE = re.compile(
+    r"^(.*?)(?:\.processor\.(to_q|to_k|to_v|to_out)_lora|\.lora_linear_layer|\.lora)\.down\.weight$"
+)
+
+
+@paddle.no_grad()
+def _merge_lora_into_linear(linear, down, up, alpha=None, scale=1.0):
+    """
+    Fold a LoRA pair into `linear` in place: `W <- W + scale * (alpha / rank) * down @ up`. A negative
+    `scale` subtracts it again.
+    """
+    delta = paddle.matmul(down.cast("float32"), up.cast("float32")) * scale
+    if alpha is not None:
+        delta = delta * (alpha / down.shape[1])
+    weight = linear.weight
+    weight.set_value((weight.cast("float32") + delta).cast(weight.dtype))
+
+
+def _merge_lora_weights(model, state_dict, network_alphas=None, lora_scale=1.0):
+    """
+    Fold every LoRA pair of `state_dict` that targets a plain linear layer of `model` into the
+    layer weight. Returns the entries that could not be merged, so they can still be loaded as
+    LoRA layers. The merged pairs are recorded on `model`, `_unmerge_lora_weights` subtracts them again.
+    """
+    network_alphas = network_alphas or {}
+    if getattr(model, "_merged_lora_weights", None) is None:
+        model._merged_lora_weights = []
+    merges = []
+    # Attention processors are loaded as a whole, so they are only merged when all of their entries can be.
+    unmergeable_processors = set()
+    for key in state_dict:
+        match = _LORA_MERGE_RE.match(key)
+        up_key = key[: -len("down.weight")] + "up.weight"
+        target = None
+        if match is not None and up_key in state_dict and state_dict[key].ndim == 2:
+            module_name, proj = match.groups()
+            if proj is not None:
+                module_name = f"{module_name}.{proj}" + (".0" if proj == "to_out" else "")
+            try:
+                target = functools.reduce(getattr, module_name.split("."), model)
+            except AttributeError:
+                target = None
+            if not isinstance(target, nn.Linear):
+                target = None
+        if target is not None:
+            merges.append((key, up_key, target, match.group(1)))
+        elif ".processor." in key:
+            unmergeable_processors.add(key.split(".processor.")[0])
+
+    remaining = dict(state_dict)
+    for key, up_key, target, module_name in merges:
+        if module_name in unmergeable_processors:
+            continue
+        alpha = network_alphas.get(key + ".alpha", network_alphas.get(module_name + ".alpha"))
+        # The LoRA pair is small next to the layer, a copy of it is kept rather than of the base weight.
+        down, up = remaining.pop(key).clone(), remaining.pop(up_key).clone()
+        _merge_lora_into_linear(target, down, up, alpha=alpha, scale=lora_scale)
+        model._merged_lora_weights.append((target, down, up, alpha, lora_scale))
+    return remaining
+
+
+def _unmerge_lora_weights(model):
+    """
+    Subtract the LoRA pairs merged into `model` by `_merge_lora_weights`, the latest first. Half precision
+    weights come back up to rounding.
+    """
+    merged = getattr(model, "_merged_lora_weights", None)
+    if not merged:
+        return
+    for linear, down, up, alpha, scale in reversed(merged):
+        _merge_lora_into_linear(linear, down, up, alpha=alpha, scale=-scale)
+    model._merged_lora_weights = []
+
+
 class PatchedLoraProjection(nn.Layer):
-    def __init__(self, regular_linear_layer, lora_scale=1, network_alpha=None, rank=4, dtype=None):
+    def __init__(self, regular_linear_layer, lora_scale=1, network_alpha=None, rank=4, dtype=None, lazy_init=False):
         super().__init__()
         from .models.lora import LoRALinearLayer
 
@@ -107,19 +754,198 @@ class PatchedLoraProjection(nn.Layer):
 
         in_features, out_features = self.regular_linear_layer.weight.shape
 
-        self.lora_linear_layer = LoRALinearLayer(
-            in_features,
-            out_features,
-            network_alpha=network_alpha,
-            dtype=dtype,
-            rank=rank,
-        )
+        if lazy_init and hasattr(paddle, "LazyGuard"):
+            # The LoRA weights are replaced by loaded ones right away, so skip their allocation and
+            # initialization. Weights that are not loaded must be materialized with `param.initialize()`.
+            with paddle.dtype_guard(dtype), paddle.LazyGuard():
+                self.lora_linear_layer = LoRALinearLayer(
+                    in_features,
+                    out_features,
+                    network_alpha=network_alpha,
+                    rank=rank,
+                    init_weights=False,
+                )
+        else:
+            self.lora_linear_layer = LoRALinearLayer(
+                in_features,
+                out_features,
+                network_alpha=network_alpha,
+                dtype=dtype,
+                rank=rank,
+            )
 
         self.lora_scale = lora_scale
+        # Set by `stack_lora`: the down/up matrices of every adapter concatenated along the rank axis.
+        self.stacked_lora = None
+        # Set by `fuse_down_projection`: the base weight concatenated with the LoRA down matrices.
+        self.fused_lora = None
+        # Set by `FusedQKVLora`: the LoRA shared with the sibling q/k/v projections and the index of this one.
+        self.fused_qkv = None
+        self._select_forward()
+
+    def _select_forward(self):
+        # Pick the forward of the current mode once, whenever the mode changes, instead of checking
+        # the three modes on every call.
+        cls = type(self)
+        if self.fused_qkv is not None:
+            self._lora_forward = cls._forward_fused_qkv
+        elif self.fused_lora is not None:
+            self._lora_forward = cls._forward_fused
+        elif self.stacked_lora is not None:
+            self._lora_forward = cls._forward_stacked
+        else:
+            self._lora_forward = cls._forward_lora
+
+    def _lora_factors(self):
+        if self.stacked_lora is not None:
+            return self.stacked_lora["down"], self.stacked_lora["up"], self.stacked_lora["scales"]
+        layer = self.lora_linear_layer
+        scale = 1.0 if layer.network_alpha is None else layer.network_alpha / layer.rank
+        return (
+            layer.down.weight.detach(),
+            layer.up.weight.detach(),
+            paddle.full([layer.rank], scale, dtype=layer.down.weight.dtype),
+        )
+
+    @paddle.no_grad()
+    def stack_lora(self, down, up, scale=1.0):
+        """
+        Add another adapter to this projection. All the adapters are concatenated along the rank axis, so the
+        forward runs a single down/up matmul pair `((x @ [A_1, A_2, ...]) * s) @ [B_1; B_2; ...]` whatever their
+        number. `scale` is the fusion weight of the new adapter, including its `network_alpha / rank` factor.
+        """
+        stacked_down, stacked_up, stacked_scales = self._lora_factors()
+        dtype = stacked_down.dtype
+        self.stacked_lora = {
+            "down": paddle.concat([stacked_down, down.cast(dtype)], axis=1),
+            "up": paddle.concat([stacked_up, up.cast(dtype)], axis=0),
+            "scales": paddle.concat([stacked_scales, paddle.full([down.shape[1]], scale, dtype=dtype)]),
+        }
+        if self.fused_lora is not None:
+            self.fuse_down_projection()
+        if self.fused_qkv is not None:
+            self.fused_qkv[0].build()
+        self._select_forward()
+
+    @paddle.no_grad()
+    def fuse_down_projection(self):
+        """
+        Concatenate the LoRA down matrices to the base weight (`[W, A]`), so the base output `Y` and the small
+        rank-r LoRA activation `S = x @ A` come out of a single matmul, and the up projection is added to `Y` by
+        a second one, `addmm(Y, S, B)`. Meant for inference: the LoRA parameters are copied, so later updates to
+        them are not seen until this is called again.
+        """
+        down, up, scales = self._lora_factors()
+        weight = self.regular_linear_layer.weight
+        bias = self.regular_linear_layer.bias
+        if bias is not None:
+            bias = paddle.concat([bias, paddle.zeros([down.shape[1]], dtype=bias.dtype)])
+        self.fused_lora = {
+            "weight": paddle.concat([weight, down.cast(weight.dtype)], axis=1),
+            "bias": bias,
+            # The per-rank scales are folded into the rows of the up matrix.
+            "up": (up * scales.unsqueeze(-1)).cast(weight.dtype),
+        }
+        self._select_forward()
 
     def forward(self, input):
+        return self._lora_forward(self, input)
+
+    def _forward_lora(self, input):
         return self.regular_linear_layer(input) + self.lora_scale * self.lora_linear_layer(input)
 
+    def _forward_fused_qkv(self, input):
+        fused_qkv, index = self.fused_qkv
+        return self.regular_linear_layer(input) + self.lora_scale * fused_qkv(input, index)
+
+    def _forward_fused(self, input):
+        fused = self.fused_lora
+        rank = fused["up"].shape[0]
+        hidden_states = F.linear(input, fused["weight"], fused["bias"])
+        hidden_states, lora_hidden_states = paddle.split(hidden_states, [-1, rank], axis=-1)
+        # Scaling the small up matrix is cheaper than scaling the activation.
+        up = fused["up"] if self.lora_scale == 1.0 else fused["up"] * self.lora_scale
+        shape = hidden_states.shape
+        hidden_states = paddle.addmm(
+            hidden_states.reshape([-1, shape[-1]]), lora_hidden_states.reshape([-1, rank]), up
+        )
+        return hidden_states.reshape(shape)
+
+    def _forward_stacked(self, input):
+        stacked = self.stacked_lora
+        dtype = stacked["down"].dtype
+        lora_input = input if input.dtype == dtype else input.cast(dtype)
+        lora_hidden_states = paddle.matmul(lora_input, stacked["down"]) * stacked["scales"]
+        lora_hidden_states = paddle.matmul(lora_hidden_states, stacked["up"])
+        if input.dtype != dtype:
+            lora_hidden_states = lora_hidden_states.cast(input.dtype)
+        return self.regular_linear_layer(input) + self.lora_scale * lora_hidden_states
+
+
+class FusedQKVLora:
+    """
+    LoRA shared by the q/k/v `PatchedLoraProjection`s of one attention module. The down matrices are
+    concatenated along the rank axis and the up matrices laid out block-diagonally, so the three LoRA
+    outputs come out of a single `((x @ A_qkv) * s) @ B_qkv`. The `_prepare_qkv` of the attention module is
+    wrapped to compute them once per self-attention forward. They are only kept for that call and the calling
+    thread, so the text encoder stays re-entrant; a projection called on any other input computes them itself.
+
+    Meant for inference: the LoRA parameters are copied without gradients, so later updates to them are not
+    seen until `build` is called again.
+    """
+
+    def __init__(self, attn_module, projections):
+        self.projections = projections
+        self._local = threading.local()
+        for index, projection in enumerate(projections):
+            projection.fused_qkv = (self, index)
+            projection._select_forward()
+        self.build()
+
+        prepare_qkv = attn_module._prepare_qkv
+
+        @functools.wraps(prepare_qkv)
+        def _prepare_qkv(query, key, value, cache=None):
+            if key is not query or value is not query:
+                return prepare_qkv(query, key, value, cache)
+            self._local.shared = (query, self.lora(query))
+            try:
+                return prepare_qkv(query, key, value, cache)
+            finally:
+                self._local.shared = None
+
+        # Removed again by `_remove_text_encoder_monkey_patch_classmethod`.
+        attn_module._prepare_qkv = _prepare_qkv
+
+    @paddle.no_grad()
+    def build(self):
+        factors = [projection._lora_factors() for projection in self.projections]
+        dtype = factors[0][0].dtype
+        ranks = [down.shape[1] for down, _, _ in factors]
+        self.out_features = [up.shape[1] for _, up, _ in factors]
+        self.down = paddle.concat([down.cast(dtype) for down, _, _ in factors], axis=1)
+        self.scales = paddle.concat([scales.cast(dtype) for _, _, scales in factors])
+        self.up = paddle.zeros([sum(ranks), sum(self.out_features)], dtype=dtype)
+        row = col = 0
+        for (_, up, _), rank, out_features in zip(factors, ranks, self.out_features):
+            self.up[row : row + rank, col : col + out_features] = up.cast(dtype)
+            row, col = row + rank, col + out_features
+
+    def lora(self, input):
+        dtype = self.down.dtype
+        hidden_states = input if input.dtype == dtype else input.cast(dtype)
+        hidden_states = paddle.matmul(hidden_states, self.down) * self.scales
+        hidden_states = paddle.matmul(hidden_states, self.up)
+        if input.dtype != dtype:
+            hidden_states = hidden_states.cast(input.dtype)
+        return paddle.split(hidden_states, self.out_features, axis=-1)
+
+    def __call__(self, input, index):
+        shared = getattr(self._local, "shared", None)
+        if shared is not None and shared[0] is input:
+            return shared[1][index]
+        return self.lora(input)[index]
+
 
 def text_encoder_attn_modules(text_encoder):
     attn_modules = []
@@ -149,21 +975,43 @@ def text_encoder_mlp_modules(text_encoder):
     return mlp_modules
 
 
-def text_encoder_lora_state_dict(text_encoder):
-    state_dict = {}
+def _cached_lora_modules(text_encoder):
+    """
+    Return the attention and mlp modules of `text_encoder` that can be patched with LoRA layers.
+    The enumeration is stored on the text encoder, since patching only replaces the projections
+    inside these modules and never the modules themselves.
+    """
+    modules = getattr(text_encoder, "_ppdiffusers_lora_modules", None)
+    if modules is None:
+        modules = {
+            "attn": text_encoder_attn_modules(text_encoder),
+            "mlp": text_encoder_mlp_modules(text_encoder),
+        }
+        text_encoder._ppdiffusers_lora_modules = modules
+    return modules
 
-    for name, module in text_encoder_attn_modules(text_encoder):
-        for k, v in module.q_proj.lora_linear_layer.state_dict().items():
-            state_dict[f"{name}.q_proj.lora_linear_layer.{k}"] = v
 
-        for k, v in module.k_proj.lora_linear_layer.state_dict().items():
-            state_dict[f"{name}.k_proj.lora_linear_layer.{k}"] = v
+def _bump_lora_version(text_encoder):
+    # Counts the LoRA changes of the text encoder, cached text encoder outputs are keyed on it.
+    text_encoder._lora_version = getattr(text_encoder, "_lora_version", 0) + 1
 
-        for k, v in module.v_proj.lora_linear_layer.state_dict().items():
-            state_dict[f"{name}.v_proj.lora_linear_layer.{k}"] = v
 
-        for k, v in module.out_proj.lora_linear_layer.state_dict().items():
-            state_dict[f"{name}.out_proj.lora_linear_layer.{k}"] = v
+def _clear_prompt_cache(pipeline):
+    # The `_encode_prompt` results some pipelines cache are stale once their text encoder or tokenizer changes.
+    cache = getattr(pipeline, "_prompt_cache", None)
+    if cache is not None:
+        cache.clear()
+
+
+def text_encoder_lora_state_dict(text_encoder):
+    state_dict = {}
+
+    for name, module in _cached_lora_modules(text_encoder)["attn"]:
+        for proj in ("q_proj", "k_proj", "v_proj", "out_proj"):
+            # One prefix per projection, the keys are then joined by plain concatenation.
+            prefix = name + "." + proj + ".lora_linear_layer."
+            for k, v in getattr(module, proj).lora_linear_layer.state_dict().items():
+                state_dict[prefix + k] = v
 
     return state_dict
 
@@ -181,11 +1029,12 @@ class AttnProcsLayers(nn.Layer):
         # we add a hook to state_dict() and load_state_dict() so that the
         # naming fits with `unet.attn_processors`
         def map_to(state_dict, *args, **kwargs):
+            # The values are the parameters themselves (paddle's `state_dict()` does not copy them), only
+            # the `layers.{num}` head of each key is swapped for the processor name.
             new_state_dict = {}
             for key, value in state_dict.items():
-                num = int(key.split(".")[1])  # 0 is always "layers"
-                new_key = key.replace(f"layers.{num}", self.mapping[num])
-                new_state_dict[new_key] = value
+                num, _, rest = key[len("layers.") :].partition(".")
+                new_state_dict[self.mapping[int(num)] + "." + rest] = value
 
             return new_state_dict
 
@@ -371,31 +1220,36 @@ class UNet2DConditionLoadersMixin:
         attn_processors = {}
         non_attn_lora_layers = []
 
-        is_lora = all(("lora" in k or k.endswith(".alpha")) for k in state_dict.keys())
-        is_custom_diffusion = any("custom_diffusion" in k for k in state_dict.keys())
+        # Classify the keys in a single pass instead of one `all`/`any` scan per property.
+        is_lora = is_new_lora_format = True
+        is_custom_diffusion = is_text_encoder_present = False
+        for k in state_dict:
+            if is_lora and not ("lora" in k or k.endswith(".alpha")):
+                is_lora = False
+            if not is_custom_diffusion and "custom_diffusion" in k:
+                is_custom_diffusion = True
+            if k.startswith(self.text_encoder_name):
+                is_text_encoder_present = True
+            elif is_new_lora_format and not k.startswith(self.unet_name):
+                is_new_lora_format = False
 
         if from_diffusers or is_torch_file(model_file):
             state_dict = transpose_state_dict(state_dict)
 
         if is_lora:
-            is_new_lora_format = all(
-                key.startswith(self.unet_name) or key.startswith(self.text_encoder_name) for key in state_dict.keys()
-            )
             if is_new_lora_format:
                 # Strip the `"unet"` prefix.
-                is_text_encoder_present = any(key.startswith(self.text_encoder_name) for key in state_dict.keys())
                 if is_text_encoder_present:
                     warn_message = "The state_dict contains LoRA params corresponding to the text encoder which are not being used here. To use both UNet and text encoder related LoRA params, use [`pipe.load_lora_weights()`](https://huggingface.co/docs/diffusers/main/en/api/loaders#diffusers.loaders.LoraLoaderMixin.load_lora_weights)."
                     warnings.warn(warn_message)
-                unet_keys = [k for k in state_dict.keys() if k.startswith(self.unet_name)]
-                state_dict = {k.replace(f"{self.unet_name}.", ""): v for k, v in state_dict.items() if k in unet_keys}
+                unet_prefix = f"{self.unet_name}."
+                prefix_len = len(unet_prefix)
+                state_dict = {k[prefix_len:]: v for k, v in state_dict.items() if k.startswith(unet_prefix)}
 
             lora_grouped_dict = defaultdict(dict)
             mapped_network_alphas = {}
 
-            all_keys = list(state_dict.keys())
-            for key in all_keys:
-                value = state_dict.pop(key)
+            for key, value in state_dict.items():
                 attn_processor_key, sub_key = ".".join(key.split(".")[:-3]), ".".join(key.split(".")[-3:])
                 lora_grouped_dict[attn_processor_key][sub_key] = value.cast(
                     dtype="float32"
@@ -407,16 +1261,14 @@ class UNet2DConditionLoadersMixin:
                         if k.replace(".alpha", "") in key:
                             mapped_network_alphas.update({attn_processor_key: network_alphas[k]})
 
-            if len(state_dict) > 0:
-                raise ValueError(
-                    f"The state_dict has to be empty at this point but has the following keys \n\n {', '.join(state_dict.keys())}"
-                )
-
             for key, value_dict in lora_grouped_dict.items():
                 attn_processor = self
                 for sub_key in key.split("."):
                     attn_processor = getattr(attn_processor, sub_key)
 
+                # The LoRA layers below are created without `network_alpha`, it is folded into the up weights.
+                value_dict = _fold_network_alpha(value_dict, mapped_network_alphas.get(key))
+
                 # Process non-attention layers, which don't have to_{k,v,q,out_proj}_lora layers
                 # or add_{k,v,q,out_proj}_proj_lora layers.
                 if "lora.down.weight" in value_dict:
@@ -437,14 +1289,12 @@ class UNet2DConditionLoadersMixin:
                             kernel_size=kernel_size,
                             stride=attn_processor._stride,
                             padding=attn_processor._padding,
-                            network_alpha=mapped_network_alphas.get(key),
                         )
                     elif isinstance(attn_processor, LoRACompatibleLinear):
                         lora = LoRALinearLayer(
                             attn_processor.weight.shape[0],
                             attn_processor.weight.shape[1],
                             rank,
-                            mapped_network_alphas.get(key),
                         )
                     else:
                         raise ValueError(f"Module {key} is not a LoRACompatibleConv or LoRACompatibleLinear module.")
@@ -484,7 +1334,6 @@ class UNet2DConditionLoadersMixin:
                             rank=rank_mapping.get("to_k_lora.down.weight"),
                             hidden_size=hidden_size_mapping.get("to_k_lora.up.weight"),
                             cross_attention_dim=cross_attention_dim,
-                            network_alpha=mapped_network_alphas.get(key),
                             q_rank=rank_mapping.get("to_q_lora.down.weight"),
                             q_hidden_size=hidden_size_mapping.get("to_q_lora.up.weight"),
                             v_rank=rank_mapping.get("to_v_lora.down.weight"),
@@ -505,7 +1354,6 @@ class UNet2DConditionLoadersMixin:
                             rank=rank_mapping.get("to_k_lora.down.weight", None),
                             hidden_size=hidden_size_mapping.get("to_k_lora.up.weight", None),
                             cross_attention_dim=cross_attention_dim,
-                            network_alpha=mapped_network_alphas.get(key),
                         )
 
                     attn_processors[key].load_dict(value_dict)
@@ -991,6 +1839,7 @@ class TextualInversionLoaderMixin:
         with paddle.no_grad():
             for token_id, embedding in token_ids_and_embeddings:
                 self.text_encoder.get_input_embeddings().weight[token_id] = embedding
+        _clear_prompt_cache(self)
 
 
 class LoraLoaderMixin:
@@ -1016,15 +1865,102 @@ class LoraLoaderMixin:
                 See [`~loaders.LoraLoaderMixin.lora_state_dict`].
             kwargs (`dict`, *optional*):
                 See [`~loaders.LoraLoaderMixin.lora_state_dict`].
+            merge (`bool`, *optional*, defaults to `False`):
+                Fold the LoRA weights into the base linear weights instead of adding LoRA layers, so inference
+                runs the plain model graph. `unload_lora_weights` subtracts merged weights again, half precision
+                weights come back up to rounding.
+            stack (`bool`, *optional*, defaults to `False`):
+                Add these weights on top of the LoRA already loaded instead of replacing it. The text encoder
+                adapters are stacked along the rank axis and run as one batched matmul; the UNet weights are merged
+                into the base weights.
+            adapter_weight (`float`, *optional*, defaults to 1.0):
+                Fusion weight of a stacked adapter.
+            pf_lora (`bool`, *optional*, defaults to `False`):
+                Concatenate the text encoder LoRA down matrices to the base weights so each patched projection
+                runs one matmul for the base output and the LoRA down projection. Meant for inference.
+            fuse_qkv (`bool`, *optional*, defaults to `False`):
+                Run the LoRA of the text encoder q/k/v projections as one down/up matmul pair per attention module.
+                Meant for inference.
         """
+        merge = kwargs.pop("merge", False)
+        stack = kwargs.pop("stack", False)
+        adapter_weight = kwargs.pop("adapter_weight", 1.0)
+        pf_lora = kwargs.pop("pf_lora", False)
+        fuse_qkv = kwargs.pop("fuse_qkv", False)
         state_dict, network_alphas = self.lora_state_dict(pretrained_model_name_or_path_or_dict, **kwargs)
-        self.load_lora_into_unet(state_dict, network_alphas=network_alphas, unet=self.unet)
+        self.load_lora_into_unet(
+            state_dict,
+            network_alphas=network_alphas,
+            unet=self.unet,
+            merge=merge or stack,
+            lora_scale=adapter_weight if stack else 1.0,
+        )
         self.load_lora_into_text_encoder(
             state_dict,
             network_alphas=network_alphas,
             text_encoder=self.text_encoder,
             lora_scale=self.lora_scale,
+            merge=merge,
+            stack=stack,
+            adapter_weight=adapter_weight,
+            pf_lora=pf_lora,
+            fuse_qkv=fuse_qkv,
+            # A state dict passed in stays the caller's, only the tensors loaded from a file are shared.
+            share_tensors=not isinstance(pretrained_model_name_or_path_or_dict, dict),
         )
+        _clear_prompt_cache(self)
+
+    def load_lora_weights_many(
+        self,
+        pretrained_model_name_or_path_or_dicts: List[Union[str, Dict[str, paddle.Tensor]]],
+        adapter_weights: Optional[List[float]] = None,
+        **kwargs,
+    ):
+        """
+        Load several LoRA weights and stack them, see `stack` in [`~loaders.LoraLoaderMixin.load_lora_weights`].
+        The weight files are fetched and converted in parallel threads, only applying them to `self.unet` and
+        `self.text_encoder` is sequential. The UNet weights are merged into the base weights, `unload_lora_weights`
+        subtracts them again.
+
+        Parameters:
+            pretrained_model_name_or_path_or_dicts (`List[str or os.PathLike or dict]`):
+                See [`~loaders.LoraLoaderMixin.lora_state_dict`].
+            adapter_weights (`List[float]`, *optional*):
+                Fusion weight of each adapter, defaults to 1.0 for all of them.
+            kwargs (`dict`, *optional*):
+                See [`~loaders.LoraLoaderMixin.lora_state_dict`], and `pf_lora` and `fuse_qkv` in
+                [`~loaders.LoraLoaderMixin.load_lora_weights`].
+        """
+        if adapter_weights is None:
+            adapter_weights = [1.0] * len(pretrained_model_name_or_path_or_dicts)
+        if len(adapter_weights) != len(pretrained_model_name_or_path_or_dicts):
+            raise ValueError(
+                f"Got {len(adapter_weights)} adapter weights for {len(pretrained_model_name_or_path_or_dicts)} LoRA weights."
+            )
+        pf_lora = kwargs.pop("pf_lora", False)
+        fuse_qkv = kwargs.pop("fuse_qkv", False)
+        lora_state_dict = functools.partial(self.lora_state_dict, **kwargs)
+        with ThreadPoolExecutor(max_workers=min(8, max(len(pretrained_model_name_or_path_or_dicts), 1))) as executor:
+            loaded = list(executor.map(lora_state_dict, pretrained_model_name_or_path_or_dicts))
+
+        for source, (state_dict, network_alphas), adapter_weight in zip(
+            pretrained_model_name_or_path_or_dicts, loaded, adapter_weights
+        ):
+            self.load_lora_into_unet(
+                state_dict, network_alphas=network_alphas, unet=self.unet, merge=True, lora_scale=adapter_weight
+            )
+            self.load_lora_into_text_encoder(
+                state_dict,
+                network_alphas=network_alphas,
+                text_encoder=self.text_encoder,
+                lora_scale=self.lora_scale,
+                stack=True,
+                adapter_weight=adapter_weight,
+                pf_lora=pf_lora,
+                fuse_qkv=fuse_qkv,
+                share_tensors=not isinstance(source, dict),
+            )
+        _clear_prompt_cache(self)
 
     @classmethod
     def lora_state_dict(
@@ -1113,112 +2049,71 @@ class LoraLoaderMixin:
             "framework": "pytorch" if from_diffusers else "paddle",
         }
 
-        model_file = None
-
         if not isinstance(pretrained_model_name_or_path_or_dict, dict):
-            if from_diffusers:
-                # Let's first try to load .safetensors weights
-                if (use_safetensors and weight_name is None) or (
-                    weight_name is not None and weight_name.endswith(".safetensors")
-                ):
-                    try:
-                        model_file = _get_model_file(
-                            pretrained_model_name_or_path_or_dict,
-                            weights_name=weight_name or TORCH_LORA_WEIGHT_NAME_SAFE,
-                            cache_dir=cache_dir,
-                            force_download=force_download,
-                            resume_download=resume_download,
-                            proxies=proxies,
-                            local_files_only=local_files_only,
-                            use_auth_token=use_auth_token,
-                            revision=revision,
-                            subfolder=subfolder,
-                            user_agent=user_agent,
-                            from_hf_hub=from_hf_hub,
-                        )
-                        state_dict = smart_load(model_file)
-                    except Exception:
-                        model_file = None
-                        pass
-                if model_file is None:
-                    model_file = _get_model_file(
-                        pretrained_model_name_or_path_or_dict,
-                        weights_name=weight_name or TORCH_LORA_WEIGHT_NAME,
-                        cache_dir=cache_dir,
-                        force_download=force_download,
-                        resume_download=resume_download,
-                        proxies=proxies,
-                        local_files_only=local_files_only,
-                        use_auth_token=use_auth_token,
-                        revision=revision,
-                        subfolder=subfolder,
-                        user_agent=user_agent,
-                        from_hf_hub=from_hf_hub,
-                    )
-                    state_dict = smart_load(model_file)
-            else:
-                model_file = _get_model_file(
-                    pretrained_model_name_or_path_or_dict,
-                    weights_name=weight_name or PADDLE_LORA_WEIGHT_NAME,
-                    cache_dir=cache_dir,
-                    force_download=force_download,
-                    resume_download=resume_download,
-                    proxies=proxies,
-                    local_files_only=local_files_only,
-                    use_auth_token=use_auth_token,
-                    revision=revision,
-                    subfolder=subfolder,
-                    user_agent=user_agent,
-                    from_hf_hub=from_hf_hub,
-                )
-                state_dict = smart_load(model_file)
+            model_file = _resolve_lora_file(
+                pretrained_model_name_or_path_or_dict,
+                from_diffusers=from_diffusers,
+                weight_name=weight_name,
+                use_safetensors=use_safetensors,
+                cache_dir=cache_dir,
+                force_download=force_download,
+                resume_download=resume_download,
+                proxies=proxies,
+                local_files_only=local_files_only,
+                use_auth_token=use_auth_token,
+                revision=revision,
+                subfolder=subfolder,
+                user_agent=user_agent,
+                from_hf_hub=from_hf_hub,
+            )
+            converted_file = _converted_kohya_lora_file(model_file, unet_config)
+            converted = None if converted_file is None else _load_converted_kohya_lora(converted_file)
+            state_dict = None if converted is not None else _load_lora_file(model_file)
         else:
+            converted_file = converted = None
             state_dict = pretrained_model_name_or_path_or_dict
 
         network_alphas = None
-        if all(
-            (
-                k.startswith("lora_te_")
-                or k.startswith("lora_unet_")
-                or k.startswith("lora_te1_")
-                or k.startswith("lora_te2_")
-            )
-            for k in state_dict.keys()
-        ):
+        if converted is not None:
+            # This kohya LoRA file was already converted.
+            from_diffusers = True
+            state_dict, network_alphas = converted
+        elif all(k.startswith(_KOHYA_PREFIXES) for k in state_dict):
             from_diffusers = True
             # Map SDXL blocks correctly.
             if unet_config is not None:
                 # use unet config to remap block numbers
                 state_dict = cls._map_sgm_blocks_to_diffusers(state_dict, unet_config)
             state_dict, network_alphas = cls._convert_kohya_lora_to_diffusers(state_dict)
+            if converted_file is not None:
+                _save_converted_kohya_lora(converted_file, state_dict, network_alphas)
 
         if from_diffusers:
             # convert diffusers name to pppdiffusers name
-            name_mapping_dict = {
-                ".encoder.": ".transformer.",
-                ".layer_norm": ".norm",
-                ".mlp.": ".",
-                ".fc1.": ".linear1.",
-                ".fc2.": ".linear2.",
-                ".final_layer_norm.": ".ln_final.",
-                ".embeddings.": ".",
-                ".position_embedding.": ".positional_embedding.",
-                ".patch_embedding.": ".conv1.",
-                "visual_projection.weight": "vision_projection",
-                "text_projection.weight": "text_projection",
-                ".pre_layrnorm.": ".ln_pre.",
-                ".post_layernorm.": ".ln_post.",
-            }
-            state_dict_keys = list(state_dict.keys())
             new_state_dict = {}
-            for k in state_dict_keys:
-                tensor = state_dict.pop(k)
+            # A state dict loaded here is emptied while it is converted, so the loaded and the transposed copy
+            # of a tensor are alive together only one at a time, not for the whole checkpoint.
+            owns_state_dict = state_dict is not pretrained_model_name_or_path_or_dict
+            for k in list(state_dict):
+                tensor = state_dict.pop(k) if owns_state_dict else state_dict[k]
                 if tensor.ndim == 2:
                     tensor = tensor.T
-                for oldk, newk in name_mapping_dict.items():
-                    k = k.replace(oldk, newk)
-                new_state_dict[k] = tensor
+                new_state_dict[_diffusers_to_ppdiffusers_name(k)] = tensor
             state_dict = new_state_dict
+
+            if network_alphas is not None:
+                # Key the text encoder alphas by the path of the patched projection, e.g.
+                # `text_encoder.text_model.transformer.layers.0.self_attn.q_proj.alpha`.
+                new_network_alphas = {}
+                for k, alpha in network_alphas.items():
+                    if k.startswith(_TEXT_ENCODER_ALPHA_PREFIXES) and k.endswith(".down.weight.alpha"):
+                        k = _diffusers_to_ppdiffusers_name(k)
+                        k = _convert_legacy_text_encoder_lora_key(k[: -len(".alpha")])
+                        if k.endswith(".lora_linear_layer.down.weight"):
+                            k = k[: -len(".lora_linear_layer.down.weight")]
+                        k += ".alpha"
+                    new_network_alphas[k] = alpha
+                network_alphas = new_network_alphas
         return state_dict, network_alphas
 
     @classmethod
@@ -1312,7 +2207,7 @@ class LoraLoaderMixin:
         return new_state_dict
 
     @classmethod
-    def load_lora_into_unet(cls, state_dict, network_alphas, unet):
+    def load_lora_into_unet(cls, state_dict, network_alphas, unet, merge=False, lora_scale=1.0):
         """
         This will load the LoRA layers specified in `state_dict` into `unet`.
 
@@ -1325,24 +2220,24 @@ class LoraLoaderMixin:
                 See `LoRALinearLayer` for more details.
             unet (`UNet2DConditionModel`):
                 The UNet model to load the LoRA layers into.
+            merge (`bool`, *optional*, defaults to `False`):
+                Fold the LoRA weights of linear layers into the base weights instead of adding LoRA layers.
+            lora_scale (`float`, *optional*, defaults to 1.0):
+                Scale of the merged LoRA weights. Only used with `merge=True`.
         """
         # If the serialization format is new (introduced in https://github.com/huggingface/diffusers/pull/2918),
         # then the `state_dict` keys should have `self.unet_name` and/or `self.text_encoder_name` as
         # their prefixes.
-        keys = list(state_dict.keys())
+        splits, rest = _split_lora_state_dict(state_dict, (cls.unet_name, cls.text_encoder_name))
 
-        if all(key.startswith(cls.unet_name) or key.startswith(cls.text_encoder_name) for key in keys):
+        if all(key.startswith((cls.unet_name, cls.text_encoder_name)) for key in rest):
             # Load the layers corresponding to UNet.
             logger.info(f"Loading {cls.unet_name}.")
 
-            unet_keys = [k for k in keys if k.startswith(cls.unet_name)]
-            state_dict = {k.replace(f"{cls.unet_name}.", ""): v for k, v in state_dict.items() if k in unet_keys}
+            state_dict = splits[cls.unet_name]
 
             if network_alphas is not None:
-                alpha_keys = [k for k in network_alphas.keys() if k.startswith(cls.unet_name)]
-                network_alphas = {
-                    k.replace(f"{cls.unet_name}.", ""): v for k, v in network_alphas.items() if k in alpha_keys
-                }
+                network_alphas = _split_lora_state_dict(network_alphas, (cls.unet_name,))[0][cls.unet_name]
 
         else:
             # Otherwise, we're dealing with the old format. This means the `state_dict` should only
@@ -1350,11 +2245,29 @@ class LoraLoaderMixin:
             warn_message = "You have saved the LoRA weights using the old format. To convert the old LoRA weights to the new format, you can first load them in a dictionary and then create a new dictionary like the following: `new_state_dict = {f'unet'.{module_name}: params for module_name, params in old_state_dict.items()}`."
             warnings.warn(warn_message)
 
+        if merge:
+            state_dict = _merge_lora_weights(unet, state_dict, network_alphas, lora_scale)
+            if len(state_dict) == 0:
+                return
+
         # load loras into unet
         unet.load_attn_procs(state_dict, network_alphas=network_alphas)
 
     @classmethod
-    def load_lora_into_text_encoder(cls, state_dict, network_alphas, text_encoder, prefix=None, lora_scale=1.0):
+    def load_lora_into_text_encoder(
+        cls,
+        state_dict,
+        network_alphas,
+        text_encoder,
+        prefix=None,
+        lora_scale=1.0,
+        merge=False,
+        stack=False,
+        adapter_weight=1.0,
+        pf_lora=False,
+        fuse_qkv=False,
+        share_tensors=False,
+    ):
         """
         This will load the LoRA layers specified in `state_dict` into `text_encoder`
 
@@ -1371,84 +2284,147 @@ class LoraLoaderMixin:
             lora_scale (`float`):
                 How much to scale the output of the lora linear layer before it is added with the output of the regular
                 lora layer.
+            merge (`bool`, *optional*, defaults to `False`):
+                Fold the LoRA weights into the base linear weights instead of monkey-patching the text encoder.
+            stack (`bool`, *optional*, defaults to `False`):
+                Stack the LoRA weights on the projections that are already patched (see
+                [`PatchedLoraProjection.stack_lora`]) instead of replacing them.
+            adapter_weight (`float`, *optional*, defaults to 1.0):
+                Fusion weight of the stacked adapter. Also applied when `stack=True` loads the first adapter.
+            pf_lora (`bool`, *optional*, defaults to `False`):
+                Fuse the LoRA down projections with the base weights, see
+                [`PatchedLoraProjection.fuse_down_projection`].
+            fuse_qkv (`bool`, *optional*, defaults to `False`):
+                Share one LoRA matmul pair between the q/k/v projections of each attention module, see
+                [`FusedQKVLora`].
+            share_tensors (`bool`, *optional*, defaults to `False`):
+                Let the LoRA parameters share the storage of the `state_dict` tensors instead of copying them. Only
+                for state dicts nobody else holds, e.g. the ones `load_lora_weights` loads from files.
         """
 
         # If the serialization format is new (introduced in https://github.com/huggingface/diffusers/pull/2918),
         # then the `state_dict` keys should have `self.unet_name` and/or `self.text_encoder_name` as
         # their prefixes.
-        keys = list(state_dict.keys())
         prefix = cls.text_encoder_name if prefix is None else prefix
 
-        if any(cls.text_encoder_name in key for key in keys):
-            # Load the layers corresponding to text encoder and make necessary adjustments.
-            text_encoder_keys = [k for k in keys if k.startswith(prefix)]
+        # UNet-only LoRAs (the common kohya case) skip the text encoder path entirely.
+        text_encoder_prefix = f"{prefix}."
+        if not any(k.startswith(text_encoder_prefix) for k in state_dict):
+            return
+        # Merged and stacked LoRA weights change the text encoder without going through `_modify_text_encoder`.
+        _bump_lora_version(text_encoder)
+
+        logger.info(f"Loading {prefix}.")
+        # Load the layers corresponding to text encoder and make necessary adjustments.
+        text_encoder_lora_state_dict = _split_lora_state_dict(state_dict, (prefix,))[0][prefix]
+
+        if any("to_out_lora" in k for k in text_encoder_lora_state_dict):
+            # Convert from the old naming convention to the new naming convention.
+            #
+            # Previously, the old LoRA layers were stored on the state dict at the
+            # same level as the attention block i.e.
+            # `text_model.encoder.layers.11.self_attn.to_out_lora.up.weight`.
+            #
+            # This is no actual module at that point, they were monkey patched on to the
+            # existing module. We want to be able to load them via their actual state dict.
+            # They're in `PatchedLoraProjection.lora_linear_layer` now.
             text_encoder_lora_state_dict = {
-                k.replace(f"{prefix}.", ""): v for k, v in state_dict.items() if k in text_encoder_keys
+                _convert_legacy_text_encoder_lora_key(k): v for k, v in text_encoder_lora_state_dict.items()
             }
 
-            if len(text_encoder_lora_state_dict) > 0:
-                logger.info(f"Loading {prefix}.")
-
-                if any("to_out_lora" in k for k in text_encoder_lora_state_dict.keys()):
-                    # Convert from the old naming convention to the new naming convention.
-                    #
-                    # Previously, the old LoRA layers were stored on the state dict at the
-                    # same level as the attention block i.e.
-                    # `text_model.encoder.layers.11.self_attn.to_out_lora.up.weight`.
-                    #
-                    # This is no actual module at that point, they were monkey patched on to the
-                    # existing module. We want to be able to load them via their actual state dict.
-                    # They're in `PatchedLoraProjection.lora_linear_layer` now.
-                    for name, _ in text_encoder_attn_modules(text_encoder):
-                        text_encoder_lora_state_dict[
-                            f"{name}.q_proj.lora_linear_layer.up.weight"
-                        ] = text_encoder_lora_state_dict.pop(f"{name}.to_q_lora.up.weight")
-                        text_encoder_lora_state_dict[
-                            f"{name}.k_proj.lora_linear_layer.up.weight"
-                        ] = text_encoder_lora_state_dict.pop(f"{name}.to_k_lora.up.weight")
-                        text_encoder_lora_state_dict[
-                            f"{name}.v_proj.lora_linear_layer.up.weight"
-                        ] = text_encoder_lora_state_dict.pop(f"{name}.to_v_lora.up.weight")
-                        text_encoder_lora_state_dict[
-                            f"{name}.out_proj.lora_linear_layer.up.weight"
-                        ] = text_encoder_lora_state_dict.pop(f"{name}.to_out_lora.up.weight")
-
-                        text_encoder_lora_state_dict[
-                            f"{name}.q_proj.lora_linear_layer.down.weight"
-                        ] = text_encoder_lora_state_dict.pop(f"{name}.to_q_lora.down.weight")
-                        text_encoder_lora_state_dict[
-                            f"{name}.k_proj.lora_linear_layer.down.weight"
-                        ] = text_encoder_lora_state_dict.pop(f"{name}.to_k_lora.down.weight")
-                        text_encoder_lora_state_dict[
-                            f"{name}.v_proj.lora_linear_layer.down.weight"
-                        ] = text_encoder_lora_state_dict.pop(f"{name}.to_v_lora.down.weight")
-                        text_encoder_lora_state_dict[
-                            f"{name}.out_proj.lora_linear_layer.down.weight"
-                        ] = text_encoder_lora_state_dict.pop(f"{name}.to_out_lora.down.weight")
-
-                rank = text_encoder_lora_state_dict[
-                    "text_model.transformer.layers.0.self_attn.out_proj.lora_linear_layer.up.weight"
-                ].shape[0]
-                patch_mlp = any(".linear1." in key for key in text_encoder_lora_state_dict.keys())
-
-                cls._modify_text_encoder(
-                    text_encoder,
-                    lora_scale,
-                    network_alphas,
-                    rank=rank,
-                    patch_mlp=patch_mlp,
-                )
+        if network_alphas is not None:
+            network_alphas = _split_lora_state_dict(network_alphas, (prefix,))[0][prefix]
 
-                # set correct dtype & device
-                text_encoder_lora_state_dict = {
-                    k: v._to(dtype=text_encoder.dtype) for k, v in text_encoder_lora_state_dict.items()
-                }
-                text_encoder.load_dict(text_encoder_lora_state_dict)
-                # load_state_dict_results = text_encoder.load_dict(text_encoder_lora_state_dict)
-                # if len(load_state_dict_results.unexpected_keys) != 0:
-                #     raise ValueError(
-                #         f"failed to load text encoder state dict, unexpected keys: {load_state_dict_results.unexpected_keys}"
-                #     )
+        if merge:
+            text_encoder_lora_state_dict = _merge_lora_weights(
+                text_encoder, text_encoder_lora_state_dict, network_alphas, lora_scale
+            )
+            if len(text_encoder_lora_state_dict) == 0:
+                return
+
+        if stack and getattr(text_encoder, "_patched_lora_modules", None):
+            cls._stack_text_encoder_lora(text_encoder, text_encoder_lora_state_dict, network_alphas, adapter_weight)
+            if pf_lora:
+                cls._fuse_text_encoder_lora(text_encoder)
+            if fuse_qkv:
+                cls._fuse_text_encoder_qkv_lora(text_encoder)
+            return
+
+        # One pass over the keys collects the rank of every patched projection, tells whether
+        # the mlp layers carry LoRA weights and folds the network alphas (and the weight of the
+        # first stacked adapter) into the up weights.
+        network_alphas = network_alphas or {}
+        up_scale = adapter_weight if stack else 1.0
+        rank = {}
+        patch_mlp = False
+        for key, value in text_encoder_lora_state_dict.items():
+            match = _LORA_UP_WEIGHT_RE.match(key)
+            if match is not None:
+                rank[match.groups()] = value.shape[0]
+                patch_mlp = patch_mlp or match.group(2) in ("linear1", "linear2")
+                alpha = network_alphas.get(key[: -len(".lora_linear_layer.up.weight")] + ".alpha")
+                scale = up_scale if alpha is None else up_scale * alpha / value.shape[0]
+                if scale != 1.0:
+                    text_encoder_lora_state_dict[key] = value * scale
+
+        # The LoRA weights are created lazily, they get their storage from the loaded tensors.
+        # The alphas are folded already, so the patched projections are created without them.
+        lora_parameters = cls._modify_text_encoder(
+            text_encoder,
+            lora_scale,
+            rank=rank,
+            patch_mlp=patch_mlp,
+            lazy_init=True,
+        )
+
+        # `_assign_state_dict` moves the tensors to the device and dtype of the text encoder parameters.
+        unexpected_keys = _assign_state_dict(
+            text_encoder,
+            text_encoder_lora_state_dict,
+            place=text_encoder.parameters()[0].place,
+            share_tensors=share_tensors,
+        )
+        if len(unexpected_keys) != 0:
+            logger.warning(f"failed to load text encoder state dict, unexpected keys: {unexpected_keys}")
+        for param in lora_parameters:
+            if not param._is_initialized():
+                param.initialize()
+        if pf_lora:
+            cls._fuse_text_encoder_lora(text_encoder)
+        if fuse_qkv:
+            cls._fuse_text_encoder_qkv_lora(text_encoder)
+
+    @classmethod
+    def _stack_text_encoder_lora(cls, text_encoder, state_dict, network_alphas=None, adapter_weight=1.0):
+        network_alphas = network_alphas or {}
+        for key, up in state_dict.items():
+            match = _LORA_UP_WEIGHT_RE.match(key)
+            if match is None:
+                continue
+            name = key[: -len(".lora_linear_layer.up.weight")]
+            projection = functools.reduce(getattr, name.split("."), text_encoder)
+            if not isinstance(projection, PatchedLoraProjection):
+                raise ValueError(f"Cannot stack LoRA weights on {name}, it has no LoRA loaded.")
+            down = state_dict[f"{name}.lora_linear_layer.down.weight"]
+            alpha = network_alphas.get(f"{name}.alpha")
+            scale = adapter_weight if alpha is None else adapter_weight * alpha / up.shape[0]
+            projection.stack_lora(down, up, scale)
+
+    @classmethod
+    def _fuse_text_encoder_lora(cls, text_encoder):
+        for layer in getattr(text_encoder, "_patched_lora_modules", ()):
+            if layer.fused_lora is None:
+                layer.fuse_down_projection()
+
+    @classmethod
+    def _fuse_text_encoder_qkv_lora(cls, text_encoder):
+        for _, attn_module in _cached_lora_modules(text_encoder)["attn"]:
+            projections = [attn_module.q_proj, attn_module.k_proj, attn_module.v_proj]
+            if all(
+                isinstance(projection, PatchedLoraProjection) and projection.fused_qkv is None
+                for projection in projections
+            ):
+                FusedQKVLora(attn_module, projections)
 
     @property
     def lora_scale(self) -> float:
@@ -1458,21 +2434,27 @@ class LoraLoaderMixin:
 
     def _remove_text_encoder_monkey_patch(self):
         self._remove_text_encoder_monkey_patch_classmethod(self.text_encoder)
+        if self.text_encoder is not None:
+            self.text_encoder._ppdiffusers_lora_modules = None
+        _clear_prompt_cache(self)
 
     @classmethod
     def _remove_text_encoder_monkey_patch_classmethod(cls, text_encoder):
-        for _, attn_module in text_encoder_attn_modules(text_encoder):
-            if isinstance(attn_module.q_proj, PatchedLoraProjection):
-                attn_module.q_proj = attn_module.q_proj.regular_linear_layer
-                attn_module.k_proj = attn_module.k_proj.regular_linear_layer
-                attn_module.v_proj = attn_module.v_proj.regular_linear_layer
-                attn_module.out_proj = attn_module.out_proj.regular_linear_layer
-
-        for _, mlp_module in text_encoder_mlp_modules(text_encoder):
-            if isinstance(mlp_module.linear1, PatchedLoraProjection):
-                mlp_module.linear1 = mlp_module.linear1.regular_linear_layer
-            if isinstance(mlp_module.linear2, PatchedLoraProjection):
-                mlp_module.linear2 = mlp_module.linear2.regular_linear_layer
+        # Every patch goes through `_modify_text_encoder`, which records where it patched, so restoring is a
+        # flat pass over those sites. A text encoder without any (or no text encoder at all) is not walked.
+        sites = getattr(text_encoder, "_patched_lora_sites", None)
+        if not sites:
+            return
+        for module, proj in sites:
+            projection = getattr(module, proj)
+            if isinstance(projection, PatchedLoraProjection):
+                setattr(module, proj, projection.regular_linear_layer)
+            # The wrapper installed by `FusedQKVLora`.
+            module.__dict__.pop("_prepare_qkv", None)
+
+        text_encoder._patched_lora_sites = []
+        text_encoder._patched_lora_modules = []
+        _bump_lora_version(text_encoder)
 
     # @classmethod
     # def _modify_text_encoder(
@@ -1587,9 +2569,10 @@ class LoraLoaderMixin:
         text_encoder,
         lora_scale=1,
         network_alphas=None,
-        rank=4,
+        rank: Union[Dict[Tuple[str, str], int], int] = 4,
         dtype=None,
         patch_mlp=False,
+        lazy_init=False,
     ):
         r"""
         Monkey-patches the forward passes of attention modules of the text encoder.
@@ -1597,50 +2580,51 @@ class LoraLoaderMixin:
 
         # First, remove any monkey-patch that might have been applied before
         cls._remove_text_encoder_monkey_patch_classmethod(text_encoder)
+        _bump_lora_version(text_encoder)
 
         lora_parameters = []
-        network_alphas = {} if network_alphas is None else network_alphas
-
-        for name, attn_module in text_encoder_attn_modules(text_encoder):
-            query_alpha = network_alphas.get(name + ".k.proj.alpha")
-            key_alpha = network_alphas.get(name + ".q.proj.alpha")
-            value_alpha = network_alphas.get(name + ".v.proj.alpha")
-            proj_alpha = network_alphas.get(name + ".out.proj.alpha")
-
-            attn_module.q_proj = PatchedLoraProjection(
-                attn_module.q_proj, lora_scale, network_alpha=query_alpha, rank=rank, dtype=dtype
-            )
-            lora_parameters.extend(attn_module.q_proj.lora_linear_layer.parameters())
-
-            attn_module.k_proj = PatchedLoraProjection(
-                attn_module.k_proj, lora_scale, network_alpha=key_alpha, rank=rank, dtype=dtype
-            )
-            lora_parameters.extend(attn_module.k_proj.lora_linear_layer.parameters())
-
-            attn_module.v_proj = PatchedLoraProjection(
-                attn_module.v_proj, lora_scale, network_alpha=value_alpha, rank=rank, dtype=dtype
-            )
-            lora_parameters.extend(attn_module.v_proj.lora_linear_layer.parameters())
-
-            attn_module.out_proj = PatchedLoraProjection(
-                attn_module.out_proj, lora_scale, network_alpha=proj_alpha, rank=rank, dtype=dtype
-            )
-            lora_parameters.extend(attn_module.out_proj.lora_linear_layer.parameters())
+        # Group the alphas by module once, `{module}.{proj}.alpha` -> grouped[module][proj], so each
+        # module below does a single lookup instead of one scan of `network_alphas` per projection.
+        grouped_alphas = defaultdict(dict)
+        for key, alpha in (network_alphas or {}).items():
+            module, _, proj = key[: -len(".alpha")].rpartition(".")
+            grouped_alphas[module][proj] = alpha
+
+        if isinstance(rank, dict):
+            # Projections without an entry fall back to the rank of the loaded LoRA.
+            rank_dict, default_rank = rank, next(iter(rank.values()), 4)
+        else:
+            rank_dict, default_rank = {}, rank
 
+        # The projections to patch, attention ones first and then, if requested, the mlp ones.
+        modules = _cached_lora_modules(text_encoder)
+        targets = [(name, module, ("q_proj", "k_proj", "v_proj", "out_proj")) for name, module in modules["attn"]]
         if patch_mlp:
-            for name, mlp_module in text_encoder_mlp_modules(text_encoder):
-                fc1_alpha = network_alphas.get(name + ".linear1.alpha")
-                fc2_alpha = network_alphas.get(name + ".linear2.alpha")
-
-                mlp_module.linear1 = PatchedLoraProjection(
-                    mlp_module.linear1, lora_scale, network_alpha=fc1_alpha, rank=rank, dtype=dtype
-                )
-                lora_parameters.extend(mlp_module.linear1.lora_linear_layer.parameters())
-
-                mlp_module.linear2 = PatchedLoraProjection(
-                    mlp_module.linear2, lora_scale, network_alpha=fc2_alpha, rank=rank, dtype=dtype
+            targets.extend((name, module, ("linear1", "linear2")) for name, module in modules["mlp"])
+
+        # Every projection patched below is recorded on the text encoder, with the `(module, name)` it was
+        # set on, so fusing and unpatching iterate these flat lists and stacking checks them, instead of
+        # walking the modules and type checking each projection.
+        patched_modules = text_encoder._patched_lora_modules = []
+        patched_sites = text_encoder._patched_lora_sites = []
+
+        for name, module, projections in targets:
+            alphas = grouped_alphas.pop(name, {})
+            for proj in projections:
+                projection = PatchedLoraProjection(
+                    getattr(module, proj),
+                    lora_scale,
+                    network_alpha=alphas.get(proj),
+                    rank=rank_dict.get((name, proj), default_rank),
+                    dtype=dtype,
+                    lazy_init=lazy_init,
                 )
-                lora_parameters.extend(mlp_module.linear2.lora_linear_layer.parameters())
+                setattr(module, proj, projection)
+                patched_modules.append(projection)
+                patched_sites.append((module, proj))
+                # The two known handles, instead of walking `lora_linear_layer.parameters()`.
+                lora_parameters.append(projection.lora_linear_layer.down.weight)
+                lora_parameters.append(projection.lora_linear_layer.up.weight)
 
         return lora_parameters
 
@@ -1655,6 +2639,9 @@ class LoraLoaderMixin:
         save_function: Callable = None,
         safe_serialization: bool = False,
         to_diffusers: Optional[bool] = None,
+        async_save: bool = False,
+        save_dtype: Optional[paddle.dtype] = None,
+        max_shard_size: Optional[int] = _LORA_MAX_SHARD_SIZE,
     ):
         r"""
         Save the LoRA parameters corresponding to the UNet and text encoder.
@@ -1674,31 +2661,32 @@ class LoraLoaderMixin:
                 The function to use to save the state dictionary. Useful during distributed training when you need to
                 replace `paddle.save` with another method. Can be configured with the environment variable
                 `DIFFUSERS_SAVE_MODE`.
+            async_save (`bool`, *optional*, defaults to `False`):
+                Copy the weights to the host and write them from a background thread, returning a
+                `concurrent.futures.Future`. The next save to the same directory waits for it, so saves to a
+                directory still land in order.
+            save_dtype (`paddle.dtype`, *optional*):
+                Cast the floating point LoRA weights to this dtype (e.g. `paddle.float16` or `paddle.bfloat16`) before
+                writing, halving the file size of fp32 adapters. Defaults to the dtype the weights already hold. Keep
+                `None` for checkpoints that resume training and need the fp32 weights.
+            max_shard_size (`int`, *optional*, defaults to 5 GiB):
+                With `to_diffusers=True` and `safe_serialization=True`, weights larger than this many bytes are
+                written as several shards plus a `<weight_name>.index.json` file, so the shards can be uploaded in
+                parallel. `None` always writes a single file.
         """
-        # Create a flat dictionary.
-        state_dict = {}
+        if unet_lora_layers is None and text_encoder_lora_layers is None:
+            raise ValueError("You must pass at least one of `unet_lora_layers` or `text_encoder_lora_layers`.")
 
-        # Populate the dictionary.
+        # Chain the prefixed `(key, tensor)` pairs of both models; `write_lora_layers` builds the one flat dict.
+        parts = []
         if unet_lora_layers is not None:
-            weights = unet_lora_layers.state_dict() if isinstance(unet_lora_layers, nn.Layer) else unet_lora_layers
-
-            unet_lora_state_dict = {f"{self.unet_name}.{module_name}": param for module_name, param in weights.items()}
-            state_dict.update(unet_lora_state_dict)
-
+            parts.append(self._pack_lora_weights(unet_lora_layers, self.unet_name, save_dtype))
         if text_encoder_lora_layers is not None:
-            weights = (
-                text_encoder_lora_layers.state_dict()
-                if isinstance(text_encoder_lora_layers, nn.Layer)
-                else text_encoder_lora_layers
-            )
-
-            text_encoder_lora_state_dict = {
-                f"{self.text_encoder_name}.{module_name}": param for module_name, param in weights.items()
-            }
-            state_dict.update(text_encoder_lora_state_dict)
+            parts.append(self._pack_lora_weights(text_encoder_lora_layers, self.text_encoder_name, save_dtype))
+        state_dict = chain.from_iterable(parts)
 
         # Save the model
-        self.write_lora_layers(
+        return self.write_lora_layers(
             state_dict=state_dict,
             save_directory=save_directory,
             is_main_process=is_main_process,
@@ -1706,64 +2694,158 @@ class LoraLoaderMixin:
             save_function=save_function,
             safe_serialization=safe_serialization,
             to_diffusers=to_diffusers,
+            async_save=async_save,
+            max_shard_size=max_shard_size,
         )
 
+    @staticmethod
+    def _pack_lora_weights(layers, prefix, save_dtype=None):
+        """
+        Yield the `(f"{prefix}.{name}", tensor)` pairs of a LoRA layer or state dict, casting floating point tensors
+        to `save_dtype` when it is given. Keys of a state dict that already carry `prefix` are passed through as is,
+        so packing an already packed dict is a no-op.
+        """
+        prefix = prefix + "."
+        if isinstance(layers, nn.Layer):
+            pairs = ((prefix + module_name, param) for module_name, param in layers.state_dict().items())
+        else:
+            # Plain dicts are streamed straight from the caller's dict, no intermediate dict is built.
+            pairs = (
+                (module_name if module_name.startswith(prefix) else prefix + module_name, param)
+                for module_name, param in layers.items()
+            )
+        if save_dtype is None:
+            yield from pairs
+            return
+        for key, param in pairs:
+            # `cast` always copies, so only pay for it when the dtype actually changes.
+            if param.dtype != save_dtype and paddle.is_floating_point(param):
+                param = param.cast(save_dtype)
+            yield key, param
+
+    @staticmethod
     def write_lora_layers(
-        state_dict: Dict[str, paddle.Tensor],
+        state_dict: Union[Dict[str, paddle.Tensor], Iterable[Tuple[str, paddle.Tensor]]],
         save_directory: str,
         is_main_process: bool,
         weight_name: str,
         save_function: Callable,
         safe_serialization: bool,
         to_diffusers=None,
+        async_save: bool = False,
+        max_shard_size: Optional[int] = _LORA_MAX_SHARD_SIZE,
     ):
+        # Saves to a directory are written in order, a save started in the background finishes before the next one
+        # to the same directory. Saves to other directories do not wait for it.
+        directory_key = os.path.abspath(save_directory)
+        with _PENDING_LORA_SAVES_LOCK:
+            pending = _PENDING_LORA_SAVES.get(directory_key)
+        if pending is not None:
+            pending.result()
+
+        if async_save:
+            # Snapshot the weights on the host now, so training can keep updating them while the
+            # snapshot is converted and written by the background thread.
+            state_dict = {
+                k: v.detach().clone() if v.place.is_cpu_place() else v.detach().cpu()
+                for k, v in (state_dict.items() if isinstance(state_dict, dict) else state_dict)
+            }
+            future = _lora_save_executor().submit(
+                LoraLoaderMixin._write_lora_layers,
+                state_dict=state_dict,
+                save_directory=save_directory,
+                is_main_process=is_main_process,
+                weight_name=weight_name,
+                save_function=save_function,
+                safe_serialization=safe_serialization,
+                to_diffusers=to_diffusers,
+                max_shard_size=max_shard_size,
+            )
+            with _PENDING_LORA_SAVES_LOCK:
+                _PENDING_LORA_SAVES[directory_key] = future
+            future.add_done_callback(functools.partial(_forget_pending_lora_save, directory_key))
+            return future
+
+        LoraLoaderMixin._write_lora_layers(
+            state_dict=state_dict,
+            save_directory=save_directory,
+            is_main_process=is_main_process,
+            weight_name=weight_name,
+            save_function=save_function,
+            safe_serialization=safe_serialization,
+            to_diffusers=to_diffusers,
+            max_shard_size=max_shard_size,
+        )
+
+    @staticmethod
+    def _write_lora_layers(
+        state_dict,
+        save_directory,
+        is_main_process,
+        weight_name,
+        save_function,
+        safe_serialization,
+        to_diffusers=None,
+        max_shard_size=_LORA_MAX_SHARD_SIZE,
+    ):
+        # The synchronous part of `write_lora_layers`, also what its background saves run.
         if to_diffusers is None:
             to_diffusers = TO_DIFFUSERS
         if to_diffusers and safe_serialization and not is_safetensors_available():
             raise ImportError("`safe_serialization` requires the `safetensors library: `pip install safetensors`.")
 
-        if os.path.isfile(save_directory):
+        # `makedirs` fails on an existing file, so this needs no separate `isfile` check.
+        try:
+            os.makedirs(save_directory, exist_ok=True)
+        except FileExistsError:
             logger.error(f"Provided path ({save_directory}) should be a directory, not a file")
             return
 
-        os.makedirs(save_directory, exist_ok=True)
-
         if weight_name is None:
-            if to_diffusers:
-                if safe_serialization:
-                    weight_name = TORCH_LORA_WEIGHT_NAME_SAFE
-                else:
-                    weight_name = TORCH_LORA_WEIGHT_NAME
-            else:
-                weight_name = PADDLE_LORA_WEIGHT_NAME
+            weight_name = _LORA_WEIGHT_NAMES[bool(to_diffusers), bool(safe_serialization)]
 
         # choose save_function
+        shardable = False
         if save_function is None:
-            if to_diffusers:
-                if safe_serialization:
-                    if is_torch_available():
-                        _save_function = safetensors.torch.save_file
-                        state_dict = convert_state_dict(state_dict, framework="torch")
-                    else:
-                        _save_function = safetensors.numpy.save_file
-                        state_dict = convert_state_dict(state_dict, framework="numpy")
-
-                    def save_function(weights, filename):
-                        return _save_function(weights, filename, metadata={"format": "pt"})
-
-                else:
-                    if not is_torch_available():
-                        raise ImportError(
-                            "`to_diffusers=True` with `safe_serialization=False` requires the `torch library: `pip install torch`."
-                        )
-                    save_function = torch.save
-                    state_dict = convert_state_dict(state_dict, framework="torch")
-                state_dict = transpose_state_dict(state_dict, name_mapping={".transformer.": ".encoder."})
-            else:
-                save_function = paddle.save
-
-        save_function(state_dict, os.path.join(save_directory, weight_name))
-        logger.info(f"Model weights saved in {os.path.join(save_directory, weight_name)}")
+            save_function = _resolve_lora_save_function(to_diffusers, safe_serialization)
+            if to_diffusers and safe_serialization:
+                shardable = max_shard_size is not None
+                # Only rename here, the weights are transposed one at a time while they are written. The
+                # renamed dict is built straight from the `(key, tensor)` pairs, it is the only dict of the save.
+                items = state_dict.items() if isinstance(state_dict, dict) else state_dict
+                state_dict = {_rename_key(k, _TO_DIFFUSERS_NAME_MAPPING): v for k, v in items}
+            elif to_diffusers:
+                state_dict = convert_state_dict(dict(state_dict), framework="torch")
+                state_dict = transpose_state_dict(
+                    state_dict, name_mapping=dict(_TO_DIFFUSERS_NAME_MAPPING), consume=True
+                )
+        if not isinstance(state_dict, dict):
+            state_dict = dict(state_dict)
+
+        save_path = os.path.join(save_directory, weight_name)
+        if shardable:
+            shards, sizes = _shard_state_dict(state_dict, max_shard_size, dedupe_tied=False)
+            if len(shards) > 1:
+                # Same layout as the sharded diffusers/transformers checkpoints, each shard can be uploaded on its own.
+                stem, ext = os.path.splitext(weight_name)
+                weight_map = {}
+                for i, shard in enumerate(shards):
+                    shard_name = f"{stem}-{i + 1:05d}-of-{len(shards):05d}{ext}"
+                    _atomic_save(save_function, shard, os.path.join(save_directory, shard_name))
+                    weight_map.update(dict.fromkeys(shard, shard_name))
+                index = {"metadata": {"total_size": sum(sizes)}, "weight_map": weight_map}
+                _atomic_save(_write_json, index, save_path + ".index.json")
+                # A single file from an earlier save would be picked over the index when loading.
+                if os.path.isfile(save_path):
+                    os.remove(save_path)
+                logger.info(
+                    f"Model weights saved in {len(shards)} shards in {save_directory}, see {save_path}.index.json"
+                )
+                return
+        _atomic_save(save_function, state_dict, save_path)
+        if os.path.isfile(save_path + ".index.json"):
+            os.remove(save_path + ".index.json")
+        logger.info(f"Model weights saved in {save_path}")
 
     @classmethod
     def _convert_kohya_lora_to_diffusers(cls, state_dict):
@@ -1968,6 +3050,12 @@ class LoraLoaderMixin:
                 if hasattr(module, "set_lora_layer"):
                     module.set_lora_layer(None)
 
+        # Merged weights, from `merge=True`, `stack=True` or `load_lora_weights_many`, are subtracted again.
+        _unmerge_lora_weights(self.unet)
+        if self.text_encoder is not None and getattr(self.text_encoder, "_merged_lora_weights", None):
+            _unmerge_lora_weights(self.text_encoder)
+            _bump_lora_version(self.text_encoder)
+
         # Safe to call the following regardless of LoRA.
         self._remove_text_encoder_monkey_patch()
 
@@ -65,6 +65,7 @@ class Attention(nn.Layer):
     ):
         super().__init__()
         inner_dim = dim_head * heads
+        self.is_cross_attention = cross_attention_dim is not None
         cross_attention_dim = cross_attention_dim if cross_attention_dim is not None else query_dim
         self.upcast_attention = upcast_attention
         self.upcast_softmax = upcast_softmax
@@ -137,6 +138,11 @@ class Attention(nn.Layer):
             self.to_k = None
             self.to_v = None
 
+        # set by `fuse_projections`
+        self.to_qkv = None
+        self.to_kv = None
+        self.fused_projections = False
+
         if self.added_kv_proj_dim is not None:
             self.add_k_proj = nn.Linear(added_kv_proj_dim, inner_dim)
             self.add_v_proj = nn.Linear(added_kv_proj_dim, inner_dim)
@@ -275,6 +281,66 @@ class Attention(nn.Layer):
 
         self.processor = processor
 
+    @paddle.no_grad()
+    def fuse_projections(self):
+        r"""
+        Fuse the query, key and value projections of self-attention into one `to_qkv` linear layer, and the key and
+        value projections of cross-attention into one `to_kv` layer, so that [`AttnProcessor`] and
+        [`XFormersAttnProcessor`] (which [`AttnProcessor2_5`] aliases) run one matmul where they ran three or two.
+        Other processors, e.g. the LoRA ones, keep using the separate projections and gain nothing.
+
+        The separate projections are kept next to the fused copy, so this costs as much extra memory as the q/k/v
+        weights themselves. Call [`~Attention.unfuse_projections`] to free it, and before changing the weights or
+        saving the model.
+        """
+        if self.fused_projections or self.to_k is None:
+            return
+        projections = [self.to_k, self.to_v] if self.is_cross_attention else [self.to_q, self.to_k, self.to_v]
+        # weight-only quantized or LoRA carrying projections cannot simply be concatenated
+        if not all(isinstance(p, nn.Linear) and getattr(p, "lora_layer", None) is None for p in projections):
+            return
+
+        weight = paddle.concat([p.weight for p in projections], axis=1)
+        has_bias = projections[0].bias is not None
+        fused = nn.Linear(weight.shape[0], weight.shape[1], bias_attr=None if has_bias else False)
+        fused.to(dtype=weight.dtype)
+        fused.weight.set_value(weight)
+        if has_bias:
+            fused.bias.set_value(paddle.concat([p.bias for p in projections]))
+
+        if self.is_cross_attention:
+            self.to_kv = fused
+        else:
+            self.to_qkv = fused
+        self.fused_projections = True
+
+    def unfuse_projections(self):
+        r"""
+        Drop the projections fused by [`~Attention.fuse_projections`] and go back to the separate ones.
+        """
+        self.to_qkv = None
+        self.to_kv = None
+        self.fused_projections = False
+
+    def project_qkv(self, hidden_states, encoder_hidden_states=None):
+        r"""
+        Compute the query, key and value projections, through the fused projections if there are any.
+        """
+        if encoder_hidden_states is None:
+            if self.to_qkv is not None:
+                return self.to_qkv(hidden_states).chunk(3, axis=-1)
+            encoder_hidden_states = hidden_states
+        elif self.norm_cross:
+            encoder_hidden_states = self.norm_encoder_hidden_states(encoder_hidden_states)
+
+        query = self.to_q(hidden_states)
+        if self.to_kv is not None:
+            key, value = self.to_kv(encoder_hidden_states).chunk(2, axis=-1)
+        else:
+            key = self.to_k(encoder_hidden_states)
+            value = self.to_v(encoder_hidden_states)
+        return query, key, value
+
     def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None, **cross_attention_kwargs):
         # The `Attention` class can call different attention processors / attention functions
         # here we simply pass along all tensors to the selected processor class
@@ -416,15 +482,7 @@ class AttnProcessor:
         if attn.group_norm is not None:
             hidden_states = attn.group_norm(hidden_states.transpose([0, 2, 1])).transpose([0, 2, 1])
 
-        query = attn.to_q(hidden_states)
-
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-        elif attn.norm_cross:
-            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
-
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+        query, key, value = attn.project_qkv(hidden_states, encoder_hidden_states)
 
         query = attn.head_to_batch_dim(query)
         key = attn.head_to_batch_dim(key)
@@ -938,15 +996,7 @@ class XFormersAttnProcessor:
         if attn.group_norm is not None:
             hidden_states = attn.group_norm(hidden_states.transpose([0, 2, 1])).transpose([0, 2, 1])
 
-        query = attn.to_q(hidden_states)
-
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-        elif attn.norm_cross:
-            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
-
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+        query, key, value = attn.project_qkv(hidden_states, encoder_hidden_states)
 
         # if transpose = False, query's shape will be [batch_size, seq_len, num_head, head_dim]
         query = attn.head_to_batch_dim(query, transpose=False)
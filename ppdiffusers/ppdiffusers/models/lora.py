@@ -20,7 +20,9 @@ from ..initializer import normal_, zeros_
 
 
 class LoRALinearLayer(nn.Layer):
-    def __init__(self, in_features, out_features, rank=4, network_alpha=None, device=None, dtype=None):
+    def __init__(
+        self, in_features, out_features, rank=4, network_alpha=None, device=None, dtype=None, init_weights=True
+    ):
         super().__init__()
 
         if rank > min(in_features, out_features):
@@ -48,19 +50,26 @@ class LoRALinearLayer(nn.Layer):
         self.network_alpha = network_alpha
         self.rank = rank
 
-        normal_(self.down.weight, std=1 / rank)
-        zeros_(self.up.weight)
+        # `init_weights=False` is used when the weights are loaded right away, e.g. under `paddle.LazyGuard`.
+        if init_weights:
+            normal_(self.down.weight, std=1 / rank)
+            zeros_(self.up.weight)
 
     def forward(self, hidden_states):
         orig_dtype = hidden_states.dtype
         dtype = self.down.weight.dtype
-        down_hidden_states = self.down(hidden_states.cast(dtype))
+        # `cast` copies even when the dtype does not change, so only cast around mixed precision weights.
+        if orig_dtype != dtype:
+            hidden_states = hidden_states.cast(dtype)
+        down_hidden_states = self.down(hidden_states)
         up_hidden_states = self.up(down_hidden_states)
 
         if self.network_alpha is not None:
             up_hidden_states *= self.network_alpha / self.rank
 
-        return up_hidden_states.cast(orig_dtype)
+        if orig_dtype != dtype:
+            up_hidden_states = up_hidden_states.cast(orig_dtype)
+        return up_hidden_states
 
 
 class LoRAConv2dLayer(nn.Layer):
@@ -243,6 +243,26 @@ class ModelMixin(nn.Layer):
         """
         self.set_use_memory_efficient_attention_xformers(False)
 
+    def fuse_qkv_projections(self):
+        r"""
+        Fuse the query, key and value projections of every attention layer, so that each self-attention runs one
+        matmul for them and each cross-attention one for key and value. Only [`AttnProcessor`] and
+        [`XFormersAttnProcessor`] / [`AttnProcessor2_5`] use the fused layers. The separate projections are kept, so
+        the attention q/k/v weights take twice the memory until [`~ModelMixin.unfuse_qkv_projections`] is called,
+        which must also be done before loading new weights into the model or saving it.
+        """
+        for module in self.sublayers(include_self=True):
+            if hasattr(module, "fuse_projections"):
+                module.fuse_projections()
+
+    def unfuse_qkv_projections(self):
+        r"""
+        Go back to the separate query, key and value projections after [`~ModelMixin.fuse_qkv_projections`].
+        """
+        for module in self.sublayers(include_self=True):
+            if hasattr(module, "unfuse_projections"):
+                module.unfuse_projections()
+
     def save_pretrained(
         self,
         save_directory: Union[str, os.PathLike],
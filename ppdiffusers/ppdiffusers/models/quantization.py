@@ -0,0 +1,72 @@
+# Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List
+
+import paddle
+import paddle.nn as nn
+
+WEIGHT_ONLY_ALGOS = ("weight_only_int8", "weight_only_int4")
+
+
+class WeightOnlyLinear(nn.Layer):
+    r"""
+    An `nn.Linear` with its weight stored quantized by `paddle.nn.quant.weight_quantize`. Activations and outputs
+    keep their dtype, `"weight_only_int8"` halves and `"weight_only_int4"` quarters the fp16 weight memory and
+    bandwidth.
+    """
+
+    def __init__(self, linear: nn.Linear, algo: str):
+        super().__init__()
+        quant_weight, weight_scale = paddle.nn.quant.weight_quantize(linear.weight, algo=algo)
+        self.register_buffer("quant_weight", quant_weight)
+        self.register_buffer("weight_scale", weight_scale)
+        self.bias = linear.bias
+        self.weight_dtype = "int4" if algo == "weight_only_int4" else "int8"
+
+    def forward(self, x):
+        return paddle.nn.quant.weight_only_linear(
+            x, self.quant_weight, bias=self.bias, weight_scale=self.weight_scale, weight_dtype=self.weight_dtype
+        )
+
+
+def quantize_linear_layers(layers: List[nn.Layer], algo: str = "weight_only_int8"):
+    r"""
+    Replace every `nn.Linear` inside `layers` with a [`WeightOnlyLinear`]. Linear layers carrying a LoRA layer are
+    left untouched. Everything is checked before the first layer is replaced, so a failing call leaves `layers` as
+    they were.
+
+    Args:
+        layers (`List[nn.Layer]`):
+            The layers to quantize, their linear weights have to be float16 or bfloat16.
+        algo (`str`, *optional*, defaults to `"weight_only_int8"`):
+            `"weight_only_int8"` or `"weight_only_int4"`.
+    """
+    if algo not in WEIGHT_ONLY_ALGOS:
+        raise ValueError(f"`algo` must be `weight_only_int8` or `weight_only_int4`, but got {algo}.")
+    targets = []
+    for layer in layers:
+        for parent in layer.sublayers(include_self=True):
+            for name, child in parent.named_children():
+                if isinstance(child, nn.Linear) and getattr(child, "lora_layer", None) is None:
+                    if child.weight.dtype not in (paddle.float16, paddle.bfloat16):
+                        raise ValueError(
+                            f"Weight only quantization requires float16 or bfloat16 weights, but got "
+                            f"{child.weight.dtype}. Cast the model with `paddle_dtype=paddle.float16` first."
+                        )
+                    targets.append((parent, name, child))
+    if not hasattr(paddle.nn.quant, "weight_only_linear") or not paddle.is_compiled_with_cuda():
+        raise RuntimeError("Weight only quantization requires a GPU build of paddle with `weight_only_linear`.")
+    for parent, name, child in targets:
+        setattr(parent, name, WeightOnlyLinear(child, algo))
@@ -12,8 +12,16 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import functools
 import inspect
+import queue
+import threading
+import time
 import warnings
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
@@ -24,6 +32,7 @@ import PIL.Image
 from ...image_processor import VaeImageProcessor
 from ...loaders import FromSingleFileMixin, LoraLoaderMixin, TextualInversionLoaderMixin
 from ...models import AutoencoderKL, ControlNetModel, UNet2DConditionModel
+from ...models.quantization import quantize_linear_layers
 from ...schedulers import KarrasDiffusionSchedulers
 from ...utils import deprecate, logging, randn_tensor, replace_example_docstring
 from ..pipeline_utils import DiffusionPipeline
@@ -32,6 +41,10 @@ from ..stable_diffusion.safety_checker import StableDiffusionSafetyChecker
 from .multicontrolnet import MultiControlNetModel
 
 logger = logging.get_logger(__name__)
+# Guards the lazy start of the `submit` worker of a pipeline.
+_SUBMIT_LOCK = threading.Lock()
+# Queued after the last request to stop a `submit` worker.
+_SUBMIT_STOP = object()
 EXAMPLE_DOC_STRING = """
     Examples:
         ```py
@@ -87,15 +100,107 @@ def prepare_image(image):
         if isinstance(image, (PIL.Image.Image, np.ndarray)):
             image = [image]
         if isinstance(image, list) and isinstance(image[0], PIL.Image.Image):
-            image = [np.array(i.convert("RGB"))[(None), :] for i in image]
-            image = np.concatenate(image, axis=0)
+            # Fill one preallocated batch instead of concatenating per-image arrays.
+            image = [i.convert("RGB") for i in image]
+            batch = np.empty((len(image), image[0].height, image[0].width, 3), dtype=np.uint8)
+            for i, img in enumerate(image):
+                batch[i] = np.asarray(img)
+            image = batch
         elif isinstance(image, list) and isinstance(image[0], np.ndarray):
-            image = np.concatenate([i[(None), :] for i in image], axis=0)
-        image = image.transpose(0, 3, 1, 2)
-        image = paddle.to_tensor(data=image).cast(dtype="float32") / 127.5 - 1.0
+            image = np.stack(image, axis=0)
+        # The NCHW float copy is made once, the scale and shift are done in place on it.
+        image = image.transpose(0, 3, 1, 2).astype(np.float32, order="C")
+        np.divide(image, 127.5, out=image)
+        np.subtract(image, 1.0, out=image)
+        image = paddle.to_tensor(data=image)
     return image
 
 
+def _serialized(method):
+    # The scheduler timesteps and the prompt cache are state of the pipeline, so calls from the `submit` worker
+    # and the caller's threads run one at a time.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._call_lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _image_size(image):
+    # The size of a request's image input, two requests only share a batch when their sizes match.
+    if isinstance(image, (list, tuple)):
+        return tuple(_image_size(i) for i in image)
+    if isinstance(image, PIL.Image.Image):
+        return image.size
+    return tuple(image.shape)
+
+
+def _fail_unfinished(requests, error):
+    for request in requests:
+        if not request[4].done():
+            request[4].set_exception(error)
+
+
+def _submit_worker(pipeline_ref, requests):
+    # Runs the requests of `StableDiffusionControlNetImg2ImgPipeline.submit`. Only a weak reference to the pipeline
+    # is kept between batches, so the worker does not keep the pipeline and its weights alive; it stops when the
+    # pipeline is closed or garbage collected.
+    while True:
+        request = requests.get()
+        if request is _SUBMIT_STOP:
+            return
+        pipeline = pipeline_ref()
+        if pipeline is None:
+            request[4].set_exception(RuntimeError("The pipeline was garbage collected before running the request."))
+            continue
+
+        batch = [request]
+        stop = False
+        deadline = time.monotonic() + pipeline._submit_max_wait_ms / 1000
+        while len(batch) < pipeline._submit_max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is _SUBMIT_STOP:
+                stop = True
+                break
+            batch.append(request)
+
+        # Whatever goes wrong with a batch fails its futures, the worker keeps serving the requests after it.
+        groups = []
+        try:
+            for request in batch:
+                for group in groups:
+                    if pipeline._can_batch(group[0], request):
+                        group.append(request)
+                        break
+                else:
+                    groups.append([request])
+        except BaseException as e:
+            _fail_unfinished(batch, e)
+            groups = []
+        for group in groups:
+            try:
+                pipeline._run_submitted(group)
+            except BaseException as e:
+                _fail_unfinished(group, e)
+        del pipeline
+        if stop:
+            return
+
+
+@functools.lru_cache(maxsize=None)
+def _scheduler_step_accepts(scheduler_class):
+    # Whether `scheduler_class.step` takes `eta` and `generator`, inspected once per scheduler class.
+    parameters = inspect.signature(scheduler_class.step).parameters
+    return "eta" in parameters, "generator" in parameters
+
+
 class StableDiffusionControlNetImg2ImgPipeline(
     DiffusionPipeline, TextualInversionLoaderMixin, LoraLoaderMixin, FromSingleFileMixin
 ):
@@ -134,6 +239,12 @@ class StableDiffusionControlNetImg2ImgPipeline(
     """
 
     _optional_components = ["safety_checker", "feature_extractor"]
+    # Number of `_encode_prompt` results kept per pipeline, most recently used last. Off until `enable_prompt_cache`.
+    _prompt_cache_size = 0
+    _model_cpu_offload = False
+    # `submit` coalesces the requests queued within this many milliseconds, up to this many per pipeline call.
+    _submit_max_wait_ms = 20
+    _submit_max_batch = 8
 
     def __init__(
         self,
@@ -174,8 +285,34 @@ class StableDiffusionControlNetImg2ImgPipeline(
             vae_scale_factor=self.vae_scale_factor, do_convert_rgb=True, do_normalize=False
         )
         self.register_to_config(requires_safety_checker=requires_safety_checker)
+        self._call_lock = threading.RLock()
+
+    def enable_prompt_cache(self, maxsize: int = 32):
+        r"""
+        Keep the text embeddings of the `maxsize` most recently encoded prompts, so that calls repeating a prompt skip
+        the text encoder. The cache is disabled by default.
+
+        Loading or unloading LoRA weights and textual inversion embeddings invalidates the cache. Other changes to
+        the text encoder weights, e.g. `set_state_dict`, do not: call [`~disable_prompt_cache`] before them.
+
+        Args:
+            maxsize (`int`, *optional*, defaults to 32):
+                Number of cached prompt embeddings. `0` disables the cache.
+        """
+        if maxsize < 0:
+            raise ValueError(f"`maxsize` has to be a non-negative integer but is {maxsize}.")
+        self._prompt_cache_size = maxsize
+        cache = getattr(self, "_prompt_cache", None)
+        if cache is not None:
+            while len(cache) > maxsize:
+                cache.popitem(last=False)
+
+    def disable_prompt_cache(self):
+        r"""
+        Stop caching text embeddings and drop the ones already cached.
+        """
+        self.enable_prompt_cache(maxsize=0)
 
-    # Copied from ppdiffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline._encode_prompt
     def _encode_prompt(
         self,
         prompt,
@@ -214,6 +351,34 @@ class StableDiffusionControlNetImg2ImgPipeline(
         # function of text encoder can correctly access it
         if lora_scale is not None and isinstance(self, LoraLoaderMixin):
             self._lora_scale = lora_scale
+
+        # Encoding the same prompts again gives the same embeddings, only look them up. The key covers the LoRA
+        # scale, the LoRA changes counted on the text encoder and the tokenizer vocabulary, which grows with textual
+        # inversion. The LoRA and textual inversion loaders also clear the cache.
+        cache_key = None
+        if (
+            self._prompt_cache_size > 0
+            and prompt is not None
+            and prompt_embeds is None
+            and negative_prompt_embeds is None
+        ):
+            cache_key = (
+                tuple(prompt) if isinstance(prompt, list) else prompt,
+                tuple(negative_prompt) if isinstance(negative_prompt, list) else negative_prompt,
+                num_images_per_prompt,
+                do_classifier_free_guidance,
+                self.lora_scale,
+                getattr(self.text_encoder, "_lora_version", 0),
+                len(self.tokenizer),
+                self.text_encoder.dtype,
+            )
+            if not hasattr(self, "_prompt_cache"):
+                self._prompt_cache = OrderedDict()
+            cached = self._prompt_cache.get(cache_key)
+            if cached is not None:
+                self._prompt_cache.move_to_end(cache_key)
+                return cached.clone()
+
         if prompt is not None and isinstance(prompt, str):
             batch_size = 1
         elif prompt is not None and isinstance(prompt, list):
@@ -233,10 +398,9 @@ class StableDiffusionControlNetImg2ImgPipeline(
             )
             text_input_ids = text_inputs.input_ids
             untruncated_ids = self.tokenizer(prompt, padding="longest", return_tensors="pd").input_ids
-            if (
-                untruncated_ids.shape[-1] >= text_input_ids.shape[-1]
-                and not paddle.equal_all(x=text_input_ids, y=untruncated_ids).item()
-            ):
+            # Both are padded to the same length unless truncation removed tokens, comparing the shapes is enough
+            # and does not wait on the device like `equal_all(...).item()`.
+            if untruncated_ids.shape[-1] > text_input_ids.shape[-1]:
                 removed_text = self.tokenizer.batch_decode(
                     untruncated_ids[:, self.tokenizer.model_max_length - 1 : -1]
                 )
@@ -251,9 +415,6 @@ class StableDiffusionControlNetImg2ImgPipeline(
             prompt_embeds = prompt_embeds[0]
         prompt_embeds = prompt_embeds.cast(dtype=self.text_encoder.dtype)
         bs_embed, seq_len, _ = prompt_embeds.shape
-        # duplicate text embeddings for each generation per prompt, using mps friendly method
-        prompt_embeds = prompt_embeds.tile(repeat_times=[1, num_images_per_prompt, 1])
-        prompt_embeds = prompt_embeds.reshape([bs_embed * num_images_per_prompt, seq_len, -1])
 
         # get unconditional embeddings for classifier free guidance
         if do_classifier_free_guidance and negative_prompt_embeds is None:
@@ -287,16 +448,25 @@ class StableDiffusionControlNetImg2ImgPipeline(
             negative_prompt_embeds = self.text_encoder(uncond_input.input_ids, attention_mask=attention_mask)
             negative_prompt_embeds = negative_prompt_embeds[0]
         if do_classifier_free_guidance:
-            # duplicate unconditional embeddings for each generation per prompt, using mps friendly method
-            seq_len = negative_prompt_embeds.shape[1]
             negative_prompt_embeds = negative_prompt_embeds.cast(dtype=self.text_encoder.dtype)
-            negative_prompt_embeds = negative_prompt_embeds.tile(repeat_times=[1, num_images_per_prompt, 1])
-            negative_prompt_embeds = negative_prompt_embeds.reshape([batch_size * num_images_per_prompt, seq_len, -1])
 
             # For classifier free guidance, we need to do two forward passes.
             # Here we concatenate the unconditional and text embeddings into a single batch
-            # to avoid doing two forward passes
+            # to avoid doing two forward passes. The concat runs before the per-prompt duplication below,
+            # so it copies `num_images_per_prompt` times less data and both halves are duplicated at once.
             prompt_embeds = paddle.concat(x=[negative_prompt_embeds, prompt_embeds])
+            bs_embed = bs_embed + batch_size
+
+        # duplicate text embeddings for each generation per prompt, using mps friendly method
+        if num_images_per_prompt > 1:
+            prompt_embeds = prompt_embeds.tile(repeat_times=[1, num_images_per_prompt, 1])
+        prompt_embeds = prompt_embeds.reshape([bs_embed * num_images_per_prompt, seq_len, -1])
+
+        if cache_key is not None:
+            self._prompt_cache[cache_key] = prompt_embeds
+            if len(self._prompt_cache) > self._prompt_cache_size:
+                self._prompt_cache.popitem(last=False)
+            prompt_embeds = prompt_embeds.clone()
         return prompt_embeds
 
     # Copied from ppdiffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline.run_safety_checker
@@ -314,7 +484,6 @@ class StableDiffusionControlNetImg2ImgPipeline(
             )
         return image, has_nsfw_concept
 
-    # Copied from ppdiffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline.decode_latents
     def decode_latents(self, latents):
         warnings.warn(
             "The decode_latents method is deprecated and will be removed in a future version. Please use VaeImageProcessor instead",
@@ -324,7 +493,8 @@ class StableDiffusionControlNetImg2ImgPipeline(
         image = self.vae.decode(latents, return_dict=False)[0]
         image = (image / 2 + 0.5).clip(min=0, max=1)
         # we always cast to float32 as this does not cause significant overhead and is compatible with bfloat16
-        image = image.cpu().transpose(perm=[0, 2, 3, 1]).astype(dtype="float32").numpy()
+        # The transpose and cast run on the device, `numpy()` then makes the one host copy.
+        image = image.transpose(perm=[0, 2, 3, 1]).cast(dtype="float32").numpy()
         return image
 
     def prepare_extra_step_kwargs(self, generator, eta):
@@ -333,13 +503,12 @@ class StableDiffusionControlNetImg2ImgPipeline(
         # eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
         # and should be between [0, 1]
 
-        accepts_eta = "eta" in set(inspect.signature(self.scheduler.step).parameters.keys())
+        accepts_eta, accepts_generator = _scheduler_step_accepts(type(self.scheduler))
         extra_step_kwargs = {}
         if accepts_eta:
             extra_step_kwargs["eta"] = eta
 
         # check if the scheduler accepts generator
-        accepts_generator = "generator" in set(inspect.signature(self.scheduler.step).parameters.keys())
         if accepts_generator:
             extra_step_kwargs["generator"] = generator
         return extra_step_kwargs
@@ -385,17 +554,23 @@ class StableDiffusionControlNetImg2ImgPipeline(
                     f"`prompt_embeds` and `negative_prompt_embeds` must have the same shape when passed directly, but got: `prompt_embeds` {prompt_embeds.shape} != `negative_prompt_embeds` {negative_prompt_embeds.shape}."
                 )
 
+        # Resolve the kind of controlnet once, every check below dispatches on it.
+        is_multi = isinstance(self.controlnet, MultiControlNetModel)
+        if not is_multi and not isinstance(self.controlnet, ControlNetModel):
+            assert False
+        num_nets = len(self.controlnet.nets) if is_multi else 1
+
         # `prompt` needs more sophisticated handling when there are multiple
         # conditionings.
-        if isinstance(self.controlnet, MultiControlNetModel):
+        if is_multi:
             if isinstance(prompt, list):
                 logger.warning(
-                    f"You have {len(self.controlnet.nets)} ControlNets and you have passed {len(prompt)} prompts. The conditionings will be fixed across the prompts."
+                    f"You have {num_nets} ControlNets and you have passed {len(prompt)} prompts. The conditionings will be fixed across the prompts."
                 )
         # Check `image`
-        if isinstance(self.controlnet, ControlNetModel):
+        if not is_multi:
             self.check_image(image, prompt, prompt_embeds)
-        elif isinstance(self.controlnet, MultiControlNetModel):
+        else:
             if not isinstance(image, list):
                 raise TypeError("For multiple controlnets: `image` must be type `list`")
 
@@ -403,37 +578,31 @@ class StableDiffusionControlNetImg2ImgPipeline(
             # (e.g. [[canny_image_1, pose_image_1], [canny_image_2, pose_image_2]]
             elif any(isinstance(i, list) for i in image):
                 raise ValueError("A single batch of multiple conditionings are supported at the moment.")
-            elif len(image) != len(self.controlnet.nets):
+            elif len(image) != num_nets:
                 raise ValueError(
-                    f"For multiple controlnets: `image` must have the same length as the number of controlnets, but got {len(image)} images and {len(self.controlnet.nets)} ControlNets."
+                    f"For multiple controlnets: `image` must have the same length as the number of controlnets, but got {len(image)} images and {num_nets} ControlNets."
                 )
             for image_ in image:
                 self.check_image(image_, prompt, prompt_embeds)
-        else:
-            assert False
-        if isinstance(self.controlnet, ControlNetModel):
+        if not is_multi:
             if not isinstance(controlnet_conditioning_scale, float):
                 raise TypeError("For single controlnet: `controlnet_conditioning_scale` must be type `float`.")
-        elif isinstance(self.controlnet, MultiControlNetModel):
+        else:
             if isinstance(controlnet_conditioning_scale, list):
                 if any(isinstance(i, list) for i in controlnet_conditioning_scale):
                     raise ValueError("A single batch of multiple conditionings are supported at the moment.")
-            elif isinstance(controlnet_conditioning_scale, list) and len(controlnet_conditioning_scale) != len(
-                self.controlnet.nets
-            ):
-                raise ValueError(
-                    "For multiple controlnets: When `controlnet_conditioning_scale` is specified as `list`, it must have the same length as the number of controlnets"
-                )
-        else:
-            assert False
+                if len(controlnet_conditioning_scale) != num_nets:
+                    raise ValueError(
+                        "For multiple controlnets: When `controlnet_conditioning_scale` is specified as `list`, it must have the same length as the number of controlnets"
+                    )
         if len(control_guidance_start) != len(control_guidance_end):
             raise ValueError(
                 f"`control_guidance_start` has {len(control_guidance_start)} elements, but `control_guidance_end` has {len(control_guidance_end)} elements. Make sure to provide the same number of elements to each list."
             )
-        if isinstance(self.controlnet, MultiControlNetModel):
-            if len(control_guidance_start) != len(self.controlnet.nets):
+        if is_multi:
+            if len(control_guidance_start) != num_nets:
                 raise ValueError(
-                    f"`control_guidance_start`: {control_guidance_start} has {len(control_guidance_start)} elements but there are {len(self.controlnet.nets)} controlnets available. Make sure to provide {len(self.controlnet.nets)}."
+                    f"`control_guidance_start`: {control_guidance_start} has {len(control_guidance_start)} elements but there are {num_nets} controlnets available. Make sure to provide {num_nets}."
                 )
         for start, end in zip(control_guidance_start, control_guidance_end):
             if start >= end:
@@ -445,8 +614,26 @@ class StableDiffusionControlNetImg2ImgPipeline(
             if end > 1.0:
                 raise ValueError(f"control guidance end: {end} can't be larger than 1.0.")
 
-    # Copied from ppdiffusers.pipelines.controlnet.pipeline_controlnet.StableDiffusionControlNetPipeline.check_image
     def check_image(self, image, prompt, prompt_embeds):
+        if isinstance(image, paddle.Tensor):
+            # The common case, a batched tensor needs none of the type probes below.
+            image_batch_size = len(image)
+        else:
+            image_batch_size = self._check_image_type(image)
+        if prompt is not None and isinstance(prompt, str):
+            prompt_batch_size = 1
+        elif prompt is not None and isinstance(prompt, list):
+            prompt_batch_size = len(prompt)
+        elif prompt_embeds is not None:
+            prompt_batch_size = prompt_embeds.shape[0]
+        if image_batch_size != 1 and image_batch_size != prompt_batch_size:
+            raise ValueError(
+                f"If image batch size is not 1, image batch size must be same as prompt batch size. image batch size: {image_batch_size}, prompt batch size: {prompt_batch_size}"
+            )
+
+    @staticmethod
+    def _check_image_type(image):
+        # Returns the batch size of a PIL image, numpy array or list of images.
         image_is_pil = isinstance(image, PIL.Image.Image)
         image_is_tensor = isinstance(image, paddle.Tensor)
         image_is_np = isinstance(image, np.ndarray)
@@ -464,22 +651,8 @@ class StableDiffusionControlNetImg2ImgPipeline(
             raise TypeError(
                 f"image must be passed and be one of PIL image, numpy array, paddle tensor, list of PIL images, list of numpy arrays or list of paddle tensors, but is {type(image)}"
             )
-        if image_is_pil:
-            image_batch_size = 1
-        else:
-            image_batch_size = len(image)
-        if prompt is not None and isinstance(prompt, str):
-            prompt_batch_size = 1
-        elif prompt is not None and isinstance(prompt, list):
-            prompt_batch_size = len(prompt)
-        elif prompt_embeds is not None:
-            prompt_batch_size = prompt_embeds.shape[0]
-        if image_batch_size != 1 and image_batch_size != prompt_batch_size:
-            raise ValueError(
-                f"If image batch size is not 1, image batch size must be same as prompt batch size. image batch size: {image_batch_size}, prompt batch size: {prompt_batch_size}"
-            )
+        return 1 if image_is_pil else len(image)
 
-    # Copied from ppdiffusers.pipelines.controlnet.pipeline_controlnet.StableDiffusionControlNetPipeline.prepare_image
     def prepare_control_image(
         self,
         image,
@@ -491,33 +664,389 @@ class StableDiffusionControlNetImg2ImgPipeline(
         do_classifier_free_guidance=False,
         guess_mode=False,
     ):
-        image = self.control_image_processor.preprocess(image, height=height, width=width).cast(dtype="float32")
-        image_batch_size = image.shape[0]
-        if image_batch_size == 1:
-            repeat_by = batch_size
-        else:
-            # image batch size is the same as prompt batch size
-            repeat_by = num_images_per_prompt
-        image = image.repeat_interleave(repeats=repeat_by, axis=0)
-        image = image.cast(dtype=dtype)
-        if do_classifier_free_guidance and not guess_mode:
-            image = paddle.concat(x=[image] * 2)
+        image = self.control_image_processor.preprocess(image, height=height, width=width)
+        # Cast before duplicating so the copies are made in `dtype`.
+        if image.dtype != dtype:
+            image = image.cast(dtype=dtype)
+        return self._repeat_control_image(image, num_images_per_prompt, do_classifier_free_guidance, guess_mode)
+
+    def prepare_control_images(
+        self,
+        images,
+        width,
+        height,
+        batch_size,
+        num_images_per_prompt,
+        dtype,
+        do_classifier_free_guidance=False,
+        guess_mode=False,
+    ):
+        r"""
+        [`~StableDiffusionControlNetImg2ImgPipeline.prepare_control_image`] for the list of images of a
+        [`MultiControlNetModel`], one entry per controlnet. When they are PIL images that end up the same size, all of
+        them are preprocessed, uploaded and cast as one batch and only split per controlnet at the end.
+        """
+        per_net = [image if isinstance(image, list) else [image] for image in images]
+        flat = [image for net_images in per_net for image in net_images]
+        batchable = all(isinstance(image, PIL.Image.Image) for image in flat) and (
+            (height is not None and width is not None) or len({image.size for image in flat}) == 1
+        )
+        if not batchable:
+            return [
+                self.prepare_control_image(
+                    image=image,
+                    width=width,
+                    height=height,
+                    batch_size=batch_size,
+                    num_images_per_prompt=num_images_per_prompt,
+                    dtype=dtype,
+                    do_classifier_free_guidance=do_classifier_free_guidance,
+                    guess_mode=guess_mode,
+                )
+                for image in images
+            ]
+
+        pixels = self.control_image_processor.preprocess(flat, height=height, width=width)
+        if pixels.dtype != dtype:
+            pixels = pixels.cast(dtype=dtype)
+        control_images = []
+        start = 0
+        for net_images in per_net:
+            control_images.append(
+                self._repeat_control_image(
+                    pixels[start : start + len(net_images)],
+                    num_images_per_prompt,
+                    do_classifier_free_guidance,
+                    guess_mode,
+                )
+            )
+            start += len(net_images)
+        return control_images
+
+    @staticmethod
+    def _repeat_control_image(image, num_images_per_prompt, do_classifier_free_guidance, guess_mode):
+        if image.shape[0] == 1:
+            # A single image shared by every prompt, image and guidance copy stays a batch of one: the controlnet
+            # adds its conditioning embedding to the latents by broadcasting, so the embedding is computed once
+            # instead of once per batch entry at every step.
+            return image
+        # image batch size is the same as prompt batch size
+        repeat_by = num_images_per_prompt
+        copies = 2 if do_classifier_free_guidance and not guess_mode else 1
+        if repeat_by * copies > 1:
+            # One tile does both the per-prompt repeat (each image `repeat_by` times in a row) and the classifier
+            # free guidance duplication (the whole batch twice), in that order.
+            _, channels, image_height, image_width = image.shape
+            image = image.unsqueeze(0).unsqueeze(2).tile(repeat_times=[copies, 1, repeat_by, 1, 1, 1])
+            image = image.reshape([-1, channels, image_height, image_width])
         return image
 
-    # Copied from ppdiffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img.StableDiffusionImg2ImgPipeline.get_timesteps
+    def submit(
+        self,
+        prompt: str,
+        image: Union[paddle.Tensor, PIL.Image.Image, np.ndarray],
+        control_image: Union[paddle.Tensor, PIL.Image.Image, np.ndarray],
+        **kwargs,
+    ) -> Future:
+        r"""
+        Queue a single-prompt generation and return a `concurrent.futures.Future` of its output.
+
+        A background thread collects the requests submitted within `_submit_max_wait_ms` milliseconds, up to
+        `_submit_max_batch` of them, and runs the ones that share the same keyword arguments and image sizes as one
+        batched pipeline call, so concurrent small requests share the UNet and ControlNet forwards of every step.
+        Each future gets the [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] (or tuple, with
+        `return_dict=False`) of its own prompt only. Direct calls of the pipeline wait for a running batch and vice
+        versa. [`~StableDiffusionControlNetImg2ImgPipeline.close`] stops the thread.
+
+        Args:
+            prompt (`str`):
+                The prompt to guide the image generation.
+            image (`paddle.Tensor`, `PIL.Image.Image` or `np.ndarray`):
+                The initial image of this request.
+            control_image (`paddle.Tensor`, `PIL.Image.Image` or `np.ndarray`):
+                The ControlNet input condition of this request.
+            kwargs:
+                Any other argument of [`~StableDiffusionControlNetImg2ImgPipeline.__call__`]. Requests are only
+                batched together when these are equal; a `generator` per request is kept per request.
+        """
+        if not isinstance(prompt, str):
+            raise ValueError(f"`submit` takes a single prompt, but got {type(prompt)}. Call the pipeline for batches.")
+        future = Future()
+        with _SUBMIT_LOCK:
+            if getattr(self, "_submit_queue", None) is None:
+                requests = self._submit_queue = queue.Queue()
+                self._submit_thread = threading.Thread(
+                    target=_submit_worker,
+                    args=(weakref.ref(self), requests),
+                    name="controlnet_img2img_submit",
+                    daemon=True,
+                )
+                # Also stops the worker when the pipeline is garbage collected without `close`.
+                self._submit_finalizer = weakref.finalize(self, requests.put, _SUBMIT_STOP)
+                self._submit_thread.start()
+            self._submit_queue.put((prompt, image, control_image, kwargs, future))
+        return future
+
+    def close(self):
+        r"""
+        Stop the background thread of [`~StableDiffusionControlNetImg2ImgPipeline.submit`] after running the
+        requests already submitted. A later `submit` starts a new thread.
+        """
+        with _SUBMIT_LOCK:
+            if getattr(self, "_submit_queue", None) is None:
+                return
+            self._submit_queue = None
+            self._submit_finalizer()
+            thread = self._submit_thread
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def _can_batch(self, request, other_request):
+        # Whether two submitted requests can run as one pipeline call.
+        kwargs, other_kwargs = request[3], other_request[3]
+        if isinstance(self.controlnet, MultiControlNetModel) or kwargs.keys() != other_kwargs.keys():
+            return False
+        # The images of a batch are stacked, so they need the same size.
+        if _image_size(request[1]) != _image_size(other_request[1]) or _image_size(request[2]) != _image_size(
+            other_request[2]
+        ):
+            return False
+        for key, value in kwargs.items():
+            other = other_kwargs[key]
+            if key == "generator":
+                # One generator per request becomes a list of generators, which needs one image per prompt.
+                if (value is None) != (other is None) or isinstance(value, list) or isinstance(other, list):
+                    return False
+                if value is not None and kwargs.get("num_images_per_prompt", 1) != 1:
+                    return False
+            elif isinstance(value, (paddle.Tensor, np.ndarray)) or isinstance(other, (paddle.Tensor, np.ndarray)):
+                return False
+            else:
+                try:
+                    if value != other:
+                        return False
+                except Exception:
+                    # Values that cannot be compared, e.g. containers holding tensors, are never batched.
+                    return False
+        return True
+
+    def _run_submitted(self, group):
+        group = [request for request in group if request[4].set_running_or_notify_cancel()]
+        if not group:
+            return
+        prompts, images, control_images, kwargs_list, futures = zip(*group)
+        kwargs = dict(kwargs_list[0])
+        return_dict = kwargs.pop("return_dict", True)
+        if len(group) > 1:
+            if kwargs.get("generator") is not None:
+                kwargs["generator"] = [request_kwargs["generator"] for request_kwargs in kwargs_list]
+            # A request may wrap its single image in a list.
+            image = [i for item in images for i in (item if isinstance(item, list) else [item])]
+            control_image = [i for item in control_images for i in (item if isinstance(item, list) else [item])]
+        else:
+            image, control_image = images[0], control_images[0]
+
+        try:
+            output = self(prompt=list(prompts), image=image, control_image=control_image, **kwargs)
+        except BaseException as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        num_images = kwargs.get("num_images_per_prompt") or 1
+        images, has_nsfw_concept = output.images, output.nsfw_content_detected
+        for i, future in enumerate(futures):
+            request_images = images[i * num_images : (i + 1) * num_images]
+            request_nsfw = (
+                None if has_nsfw_concept is None else has_nsfw_concept[i * num_images : (i + 1) * num_images]
+            )
+            if return_dict:
+                future.set_result(
+                    StableDiffusionPipelineOutput(images=request_images, nsfw_content_detected=request_nsfw)
+                )
+            else:
+                future.set_result((request_images, request_nsfw))
+
+    def quantize_controlnet(self, algo: str = "weight_only_int8"):
+        r"""
+        Store the linear weights of the ControlNet(s) quantized with [`~models.quantization.quantize_linear_layers`],
+        keeping the UNet as is. The ControlNet output is only added to the UNet residuals, so it tolerates the lower
+        precision well, and the residuals keep the ControlNet dtype.
+
+        Args:
+            algo (`str`, *optional*, defaults to `"weight_only_int8"`):
+                `"weight_only_int8"` or `"weight_only_int4"`.
+        """
+        nets = self.controlnet.nets if isinstance(self.controlnet, MultiControlNetModel) else [self.controlnet]
+        quantize_linear_layers(nets, algo)
+        self._retrace()
+
+    def fuse_qkv_projections(self, unet: bool = True, controlnet: bool = True):
+        r"""
+        Fuse the attention query, key and value projections of the UNet and/or ControlNet(s), which run at every
+        denoising step. See [`~ModelMixin.fuse_qkv_projections`]. Call it after loading LoRA weights and before
+        `quantize_controlnet`, projections that are already quantized or carry LoRA layers are left separate. The
+        fused weights are kept in addition to the separate ones, so this trades extra memory for speed.
+        """
+        if unet:
+            self.unet.fuse_qkv_projections()
+        if controlnet:
+            self.controlnet.fuse_qkv_projections()
+        self._retrace()
+
+    def unfuse_qkv_projections(self, unet: bool = True, controlnet: bool = True):
+        r"""
+        Undo [`~StableDiffusionControlNetImg2ImgPipeline.fuse_qkv_projections`].
+        """
+        if unet:
+            self.unet.unfuse_qkv_projections()
+        if controlnet:
+            self.controlnet.unfuse_qkv_projections()
+        self._retrace()
+
+    def enable_model_cpu_offload(self):
+        r"""
+        Keep the text encoder, VAE and safety checker on the CPU and move each of them to the accelerator only while
+        it runs. The UNet and ControlNet stay resident, so the denoising loop runs at full speed with less memory
+        in use. Pass `low_vram=True` to the pipeline call to swap the UNet and ControlNet in and out as well.
+        """
+        self._model_cpu_offload = True
+        for model in (self.text_encoder, self.vae, self.safety_checker):
+            if model is not None:
+                model.to(device="cpu")
+
+    @staticmethod
+    def _model_device(model):
+        return "cpu" if all(param.place.is_cpu_place() for param in model.parameters()) else paddle.get_device()
+
+    @contextmanager
+    def _offload(self, *models, enabled=True):
+        # Move `models` to the accelerator for the duration of the block. Afterwards the text encoder, VAE and safety
+        # checker go back to the CPU when `enable_model_cpu_offload` is on, any other model to where it was before.
+        device = paddle.get_device()
+        models = [m for m in models if m is not None] if enabled and device != "cpu" else []
+        devices = [self._model_device(model) for model in models]
+        for model in models:
+            model.to(device=device)
+        try:
+            yield
+        finally:
+            offloaded = (self.text_encoder, self.vae, self.safety_checker) if self._model_cpu_offload else ()
+            for model, model_device in zip(models, devices):
+                model.to(device="cpu" if any(model is m for m in offloaded) else model_device)
+            if models and paddle.is_compiled_with_cuda():
+                paddle.device.cuda.empty_cache()
+
+    @contextmanager
+    def _swap_out(self, *models, enabled=True):
+        # Park `models` on the CPU for the duration of the block, so `_offload` swaps them in and out around each of
+        # their calls, and put them back where they were afterwards.
+        models = [m for m in models if m is not None] if enabled and paddle.get_device() != "cpu" else []
+        devices = [self._model_device(model) for model in models]
+        for model in models:
+            model.to(device="cpu")
+        try:
+            yield
+        finally:
+            for model, model_device in zip(models, devices):
+                model.to(device=model_device)
+
+    @staticmethod
+    def _compute_controlnet_schedule(
+        num_steps, control_guidance_start, control_guidance_end, controlnet_conditioning_scale, is_multi
+    ):
+        # The `conditioning_scale` to pass to the controlnet(s) at every step: the configured scale inside the
+        # `[start, end]` guidance window of a controlnet, 0.0 outside of it. Plain floats, the controlnets take them
+        # as is and no step has to read a value back from the device.
+        scales = controlnet_conditioning_scale if is_multi else [controlnet_conditioning_scale]
+        schedule = []
+        for i in range(num_steps):
+            step_scales = [
+                scale * (1.0 - float(i / num_steps < start or (i + 1) / num_steps > end))
+                for scale, start, end in zip(scales, control_guidance_start, control_guidance_end)
+            ]
+            schedule.append(step_scales if is_multi else step_scales[0])
+        return schedule
+
+    def enable_compile(self):
+        r"""
+        Convert the UNet and ControlNet(s) to static graphs right away, with CINN fusion when paddle is built with
+        it, the same as passing `compile_model=True` to the first call. Each new input shape is traced once, on its
+        first step, and reuses its graph afterwards.
+
+        The conversion replaces the `forward` of the models themselves, so it also applies to every other pipeline
+        sharing them, and the graphs capture the LoRA layers, attention processors and fused projections present
+        when they are traced. The LoRA and projection methods of this pipeline retrace on their own; after calling
+        `set_attn_processor` or loading LoRA weights on the models directly, call
+        [`~StableDiffusionControlNetImg2ImgPipeline.disable_compile`] and compile again.
+        """
+        self._maybe_compile()
+
+    def disable_compile(self):
+        r"""
+        Undo [`~StableDiffusionControlNetImg2ImgPipeline.enable_compile`] and run the UNet and ControlNet(s) eagerly
+        again.
+        """
+        for model, forward in getattr(self, "_eager_forwards", None) or []:
+            if forward is None:
+                del model.forward
+            else:
+                model.forward = forward
+        self._eager_forwards = None
+
+    def _maybe_compile(self):
+        # Convert the UNet and ControlNet(s) to static graphs once, with CINN fusion when paddle is built with it.
+        # `to_static` converts the `forward` of a layer in place; a new input shape only triggers a retrace.
+        if getattr(self, "_eager_forwards", None) is not None:
+            return
+        build_strategy = paddle.static.BuildStrategy()
+        build_strategy.build_cinn_pass = paddle.is_compiled_with_cinn()
+        nets = self.controlnet.nets if isinstance(self.controlnet, MultiControlNetModel) else [self.controlnet]
+        self._eager_forwards = []
+        for model in [self.unet, *nets]:
+            # `forward` is only an instance attribute once converted, or when someone else patched it
+            self._eager_forwards.append((model, model.__dict__.get("forward")))
+            paddle.jit.to_static(model, build_strategy=build_strategy)
+
+    def _retrace(self):
+        # the traced graphs do not see LoRA layers or projections added or removed after tracing
+        if getattr(self, "_eager_forwards", None) is not None:
+            self.disable_compile()
+            self._maybe_compile()
+
+    def load_lora_weights(self, *args, **kwargs):
+        """See [`~loaders.LoraLoaderMixin.load_lora_weights`], retracing the compiled graphs if any."""
+        super().load_lora_weights(*args, **kwargs)
+        self._retrace()
+
+    def load_lora_weights_many(self, *args, **kwargs):
+        """See [`~loaders.LoraLoaderMixin.load_lora_weights_many`], retracing the compiled graphs if any."""
+        super().load_lora_weights_many(*args, **kwargs)
+        self._retrace()
+
+    def unload_lora_weights(self):
+        """See [`~loaders.LoraLoaderMixin.unload_lora_weights`], retracing the compiled graphs if any."""
+        super().unload_lora_weights()
+        self._retrace()
+
     def get_timesteps(self, num_inference_steps, strength):
         init_timestep = min(int(num_inference_steps * strength), num_inference_steps)
         t_start = max(num_inference_steps - init_timestep, 0)
         timesteps = self.scheduler.timesteps[t_start * self.scheduler.order :]
+        # The loop feeds `t` straight to the controlnet and unet, so keep the schedule on the device even if a
+        # scheduler hands back a host-side sequence. The dtype is left alone: Karras-style schedulers use float
+        # timesteps.
+        if not isinstance(timesteps, paddle.Tensor):
+            timesteps = paddle.to_tensor(timesteps)
         return timesteps, num_inference_steps - t_start
 
-    # Copied from ppdiffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img.StableDiffusionImg2ImgPipeline.prepare_latents
     def prepare_latents(self, image, timestep, batch_size, num_images_per_prompt, dtype, generator=None):
         if not isinstance(image, (paddle.Tensor, PIL.Image.Image, list)):
             raise ValueError(
                 f"`image` has to be of type `paddle.Tensor`, `PIL.Image.Image` or list but is {type(image)}"
             )
-        image = image.cast(dtype=dtype)
+        if image.dtype != dtype:
+            image = image.cast(dtype=dtype)
         batch_size = batch_size * num_images_per_prompt
         if image.shape[1] == 4:
             init_latents = image
@@ -526,13 +1055,9 @@ class StableDiffusionControlNetImg2ImgPipeline(
                 raise ValueError(
                     f"You have passed a list of generators of length {len(generator)}, but requested an effective batch size of {batch_size}. Make sure the batch size matches the length of the generators."
                 )
-            elif isinstance(generator, list):
-                init_latents = [
-                    self.vae.encode(image[i : i + 1]).latent_dist.sample(generator[i]) for i in range(batch_size)
-                ]
-                init_latents = paddle.concat(x=init_latents, axis=0)
-            else:
-                init_latents = self.vae.encode(image).latent_dist.sample(generator)
+            # One batched encode; `randn_tensor` draws sample `i` from `generator[i]` when a list is passed, so the
+            # samples match encoding the images one by one.
+            init_latents = self.vae.encode(image).latent_dist.sample(generator)
             init_latents = self.vae.config.scaling_factor * init_latents
         if batch_size > init_latents.shape[0] and batch_size % init_latents.shape[0] == 0:
 
@@ -545,8 +1070,6 @@ class StableDiffusionControlNetImg2ImgPipeline(
             raise ValueError(
                 f"Cannot duplicate `image` of batch size {init_latents.shape[0]} to {batch_size} text prompts."
             )
-        else:
-            init_latents = paddle.concat(x=[init_latents], axis=0)
         shape = init_latents.shape
         noise = randn_tensor(shape, generator=generator, dtype=dtype)
 
@@ -555,6 +1078,7 @@ class StableDiffusionControlNetImg2ImgPipeline(
         latents = init_latents
         return latents
 
+    @_serialized
     @paddle.no_grad()
     @replace_example_docstring(EXAMPLE_DOC_STRING)
     def __call__(
@@ -587,6 +1111,8 @@ class StableDiffusionControlNetImg2ImgPipeline(
         guess_mode: bool = False,
         control_guidance_start: Union[float, List[float]] = 0.0,
         control_guidance_end: Union[float, List[float]] = 1.0,
+        compile_model: bool = False,
+        low_vram: bool = False,
     ):
         """
         Function invoked when calling the pipeline for generation.
@@ -669,6 +1195,15 @@ class StableDiffusionControlNetImg2ImgPipeline(
                 The percentage of total steps at which the controlnet starts applying.
             control_guidance_end (`float` or `List[float]`, *optional*, defaults to 1.0):
                 The percentage of total steps at which the controlnet stops applying.
+            compile_model (`bool`, *optional*, defaults to `False`):
+                Convert the UNet and ControlNet to static graphs (with CINN when available) on the first call. The
+                first denoising step pays the conversion cost, later steps and calls run the compiled graphs. See
+                [`~StableDiffusionControlNetImg2ImgPipeline.enable_compile`] for what the graphs capture.
+            low_vram (`bool`, *optional*, defaults to `False`):
+                Keep every model on the CPU and move it to the accelerator only for its own forward, the ControlNet
+                and UNet included, so only one of them is resident at a time. Much slower, for GPUs that cannot
+                hold the UNet and ControlNet together. See also
+                [`~StableDiffusionControlNetImg2ImgPipeline.enable_model_cpu_offload`].
 
         Examples:
 
@@ -704,6 +1239,8 @@ class StableDiffusionControlNetImg2ImgPipeline(
             control_guidance_start,
             control_guidance_end,
         )
+        if compile_model:
+            self._maybe_compile()
 
         # 2. Define call parameters
         if prompt is not None and isinstance(prompt, str):
@@ -728,20 +1265,23 @@ class StableDiffusionControlNetImg2ImgPipeline(
         guess_mode = guess_mode or global_pool_conditions
 
         # 3. Encode input prompt
+        offload = self._model_cpu_offload or low_vram
         text_encoder_lora_scale = (
             cross_attention_kwargs.get("scale", None) if cross_attention_kwargs is not None else None
         )
-        prompt_embeds = self._encode_prompt(
-            prompt,
-            num_images_per_prompt,
-            do_classifier_free_guidance,
-            negative_prompt,
-            prompt_embeds=prompt_embeds,
-            negative_prompt_embeds=negative_prompt_embeds,
-            lora_scale=text_encoder_lora_scale,
-        )
+        with self._offload(self.text_encoder, enabled=offload):
+            prompt_embeds = self._encode_prompt(
+                prompt,
+                num_images_per_prompt,
+                do_classifier_free_guidance,
+                negative_prompt,
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_prompt_embeds,
+                lora_scale=text_encoder_lora_scale,
+            )
         # 4. Prepare image
-        image = self.image_processor.preprocess(image).cast(dtype="float32")
+        # `prepare_latents` casts it to the latents dtype, a float32 copy here would only be cast again.
+        image = self.image_processor.preprocess(image)
 
         # 5. Prepare controlnet_conditioning_image
         if isinstance(controlnet, ControlNetModel):
@@ -756,20 +1296,16 @@ class StableDiffusionControlNetImg2ImgPipeline(
                 guess_mode=guess_mode,
             )
         elif isinstance(controlnet, MultiControlNetModel):
-            control_images = []
-            for control_image_ in control_image:
-                control_image_ = self.prepare_control_image(
-                    image=control_image_,
-                    width=width,
-                    height=height,
-                    batch_size=batch_size * num_images_per_prompt,
-                    num_images_per_prompt=num_images_per_prompt,
-                    dtype=controlnet.dtype,
-                    do_classifier_free_guidance=do_classifier_free_guidance,
-                    guess_mode=guess_mode,
-                )
-                control_images.append(control_image_)
-            control_image = control_images
+            control_image = self.prepare_control_images(
+                images=control_image,
+                width=width,
+                height=height,
+                batch_size=batch_size * num_images_per_prompt,
+                num_images_per_prompt=num_images_per_prompt,
+                dtype=controlnet.dtype,
+                do_classifier_free_guidance=do_classifier_free_guidance,
+                guess_mode=guess_mode,
+            )
         else:
             assert False
 
@@ -779,91 +1315,111 @@ class StableDiffusionControlNetImg2ImgPipeline(
         latent_timestep = timesteps[:1].tile(repeat_times=[batch_size * num_images_per_prompt])
 
         # 6. Prepare latent variables
-        latents = self.prepare_latents(
-            image, latent_timestep, batch_size, num_images_per_prompt, prompt_embeds.dtype, generator
-        )
+        with self._offload(self.vae, enabled=offload):
+            latents = self.prepare_latents(
+                image, latent_timestep, batch_size, num_images_per_prompt, prompt_embeds.dtype, generator
+            )
         # 7. Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
-        # 7.1 Create tensor stating which controlnets to keep
-        controlnet_keep = []
-        for i in range(len(timesteps)):
-            keeps = [
-                (1.0 - float(i / len(timesteps) < s or (i + 1) / len(timesteps) > e))
-                for s, e in zip(control_guidance_start, control_guidance_end)
-            ]
-            controlnet_keep.append(keeps[0] if isinstance(controlnet, ControlNetModel) else keeps)
+        # 7.1 The conditioning scale(s) of every step, zero where a controlnet is switched off
+        controlnet_scales = self._compute_controlnet_schedule(
+            len(timesteps),
+            control_guidance_start,
+            control_guidance_end,
+            controlnet_conditioning_scale,
+            isinstance(controlnet, MultiControlNetModel),
+        )
+
+        # 7.2 Everything about the controlnet inputs that does not change from step to step. In guess mode with
+        # guidance the controlnet only sees the conditional half of the batch.
+        controlnet_cond_only = guess_mode and do_classifier_free_guidance
+        controlnet_prompt_embeds = prompt_embeds.chunk(chunks=2)[1] if controlnet_cond_only else prompt_embeds
+        # The zero residuals padding the unconditional half, allocated on the first step and reused afterwards.
+        zero_residuals = None
 
         # 8. Denoising loop
-        num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
-        with self.progress_bar(total=num_inference_steps) as progress_bar:
-            for i, t in enumerate(timesteps):
-                # expand the latents if we are doing classifier free guidance
-                latent_model_input = paddle.concat(x=[latents] * 2) if do_classifier_free_guidance else latents
-                latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-
-                # controlnet(s) inference
-                if guess_mode and do_classifier_free_guidance:
-                    # Infer ControlNet only for the conditional batch.
-                    control_model_input = latents
-                    control_model_input = self.scheduler.scale_model_input(control_model_input, t)
-                    controlnet_prompt_embeds = prompt_embeds.chunk(chunks=2)[1]
-                else:
-                    control_model_input = latent_model_input
-                    controlnet_prompt_embeds = prompt_embeds
-                if isinstance(controlnet_keep[i], list):
-                    cond_scale = [(c * s) for c, s in zip(controlnet_conditioning_scale, controlnet_keep[i])]
-                else:
-                    cond_scale = controlnet_conditioning_scale * controlnet_keep[i]
-                down_block_res_samples, mid_block_res_sample = self.controlnet(
-                    control_model_input,
-                    t,
-                    encoder_hidden_states=controlnet_prompt_embeds,
-                    controlnet_cond=control_image,
-                    conditioning_scale=cond_scale,
-                    guess_mode=guess_mode,
-                    return_dict=False,
-                )
-                if guess_mode and do_classifier_free_guidance:
-                    # Infered ControlNet only for the conditional batch.
-                    # To apply the output of ControlNet to both the unconditional and conditional batches,
-                    # add 0 to the unconditional batch to keep it unchanged.
-                    down_block_res_samples = [
-                        paddle.concat(x=[paddle.zeros_like(x=d), d]) for d in down_block_res_samples
-                    ]
-                    mid_block_res_sample = paddle.concat(
-                        x=[paddle.zeros_like(x=mid_block_res_sample), mid_block_res_sample]
+        # With `low_vram` the UNet and ControlNet(s) only come to the accelerator for their steps, and go back to where
+        # they were once the images are decoded.
+        with self._swap_out(self.unet, self.controlnet, enabled=low_vram):
+            num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
+            with self.progress_bar(total=num_inference_steps) as progress_bar:
+                for i, t in enumerate(timesteps):
+                    # The input scaling is the same for every sample, so scale the latents once before expanding them
+                    # for classifier free guidance rather than scaling both copies.
+                    scaled_latents = self.scheduler.scale_model_input(latents, t)
+                    latent_model_input = (
+                        paddle.concat(x=[scaled_latents] * 2) if do_classifier_free_guidance else scaled_latents
                     )
 
-                # predict the noise residual
-                noise_pred = self.unet(
-                    latent_model_input,
-                    t,
-                    encoder_hidden_states=prompt_embeds,
-                    cross_attention_kwargs=cross_attention_kwargs,
-                    down_block_additional_residuals=down_block_res_samples,
-                    mid_block_additional_residual=mid_block_res_sample,
-                    return_dict=False,
-                )[0]
-
-                # perform guidance
-                if do_classifier_free_guidance:
-                    noise_pred_uncond, noise_pred_text = noise_pred.chunk(chunks=2)
-                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
-
-                # compute the previous noisy sample x_t -> x_t-1
-                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs, return_dict=False)[0]
-
-                # call the callback, if provided
-                if i == len(timesteps) - 1 or i + 1 > num_warmup_steps and (i + 1) % self.scheduler.order == 0:
-                    progress_bar.update()
-                    if callback is not None and i % callback_steps == 0:
-                        callback(i, t, latents)
-        if not output_type == "latent":
-            image = self.vae.decode(latents / self.vae.config.scaling_factor, return_dict=False)[0]
-            image, has_nsfw_concept = self.run_safety_checker(image, prompt_embeds.dtype)
-        else:
-            image = latents
-            has_nsfw_concept = None
+                    # controlnet(s) inference
+                    cond_scale = controlnet_scales[i]
+                    if not (any(cond_scale) if isinstance(cond_scale, list) else cond_scale):
+                        # Every controlnet is outside of its guidance window, its residuals would all be zeros.
+                        down_block_res_samples, mid_block_res_sample = None, None
+                    else:
+                        if controlnet_cond_only:
+                            # Infer ControlNet only for the conditional batch.
+                            control_model_input = scaled_latents
+                        else:
+                            control_model_input = latent_model_input
+                        with self._offload(self.controlnet, enabled=low_vram):
+                            down_block_res_samples, mid_block_res_sample = self.controlnet(
+                                control_model_input,
+                                t,
+                                encoder_hidden_states=controlnet_prompt_embeds,
+                                controlnet_cond=control_image,
+                                conditioning_scale=cond_scale,
+                                guess_mode=guess_mode,
+                                return_dict=False,
+                            )
+                        if controlnet_cond_only:
+                            # Infered ControlNet only for the conditional batch.
+                            # To apply the output of ControlNet to both the unconditional and conditional batches,
+                            # add 0 to the unconditional batch to keep it unchanged.
+                            if zero_residuals is None:
+                                zero_residuals = [
+                                    paddle.zeros_like(x=d) for d in [*down_block_res_samples, mid_block_res_sample]
+                                ]
+                            down_block_res_samples = [
+                                paddle.concat(x=[z, d]) for z, d in zip(zero_residuals, down_block_res_samples)
+                            ]
+                            mid_block_res_sample = paddle.concat(x=[zero_residuals[-1], mid_block_res_sample])
+
+                    # predict the noise residual
+                    with self._offload(self.unet, enabled=low_vram):
+                        noise_pred = self.unet(
+                            latent_model_input,
+                            t,
+                            encoder_hidden_states=prompt_embeds,
+                            cross_attention_kwargs=cross_attention_kwargs,
+                            down_block_additional_residuals=down_block_res_samples,
+                            mid_block_additional_residual=mid_block_res_sample,
+                            return_dict=False,
+                        )[0]
+
+                    # perform guidance
+                    if do_classifier_free_guidance:
+                        noise_pred_uncond, noise_pred_text = noise_pred.chunk(chunks=2)
+                        # uncond + scale * (text - uncond) is a lerp, one elementwise kernel instead of three. `lerp`
+                        # only wraps a python float weight into a tensor, an int scale has to be converted first.
+                        noise_pred = noise_pred_uncond.lerp(noise_pred_text, float(guidance_scale))
+
+                    # compute the previous noisy sample x_t -> x_t-1
+                    latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs, return_dict=False)[0]
+
+                    # call the callback, if provided
+                    if i == len(timesteps) - 1 or i + 1 > num_warmup_steps and (i + 1) % self.scheduler.order == 0:
+                        progress_bar.update()
+                        if callback is not None and i % callback_steps == 0:
+                            callback(i, t, latents)
+            if not output_type == "latent":
+                with self._offload(self.vae, enabled=offload):
+                    image = self.vae.decode(latents / self.vae.config.scaling_factor, return_dict=False)[0]
+                with self._offload(self.safety_checker, enabled=offload):
+                    image, has_nsfw_concept = self.run_safety_checker(image, prompt_embeds.dtype)
+            else:
+                image = latents
+                has_nsfw_concept = None
         if has_nsfw_concept is None:
             do_denormalize = [True] * image.shape[0]
         else:
@@ -14,6 +14,7 @@
 # limitations under the License.
 from typing import Callable, List, Optional, Union
 
+import numpy as np
 import paddle
 from paddlenlp.transformers import XLMRobertaTokenizer
 
@@ -117,19 +118,19 @@ class KandinskyPipeline(DiffusionPipeline):
             max_length=77,
             return_attention_mask=True,
             add_special_tokens=True,
-            return_tensors="pd",
+            return_tensors="np",
         )
         text_input_ids = text_inputs.input_ids
-        untruncated_ids = self.tokenizer(prompt, padding="longest", return_tensors="pd").input_ids
-        if (
-            untruncated_ids.shape[-1] >= text_input_ids.shape[-1]
-            and not paddle.equal_all(x=text_input_ids, y=untruncated_ids).item()
+        untruncated_ids = self.tokenizer(prompt, padding="longest", return_tensors="np").input_ids
+        if untruncated_ids.shape[-1] >= text_input_ids.shape[-1] and not np.array_equal(
+            text_input_ids, untruncated_ids
         ):
             removed_text = self.tokenizer.batch_decode(untruncated_ids[:, self.tokenizer.model_max_length - 1 : -1])
             logger.warning(
                 f"The following part of your input was truncated because CLIP can only handle sequences up to {self.tokenizer.model_max_length} tokens: {removed_text}"
             )
         text_mask = text_inputs.attention_mask
+        # host-side token ids, the text encoder looks them up in its forward cache before uploading them
         prompt_embeds, text_encoder_hidden_states = self.text_encoder(
             input_ids=text_input_ids, attention_mask=text_mask
         )
@@ -137,7 +138,7 @@ class KandinskyPipeline(DiffusionPipeline):
         text_encoder_hidden_states = text_encoder_hidden_states.repeat_interleave(
             repeats=num_images_per_prompt, axis=0
         )
-        text_mask = text_mask.repeat_interleave(repeats=num_images_per_prompt, axis=0)
+        text_mask = paddle.to_tensor(text_mask).repeat_interleave(repeats=num_images_per_prompt, axis=0)
         if do_classifier_free_guidance:
             uncond_tokens: List[str]
             if negative_prompt is None:
@@ -161,7 +162,7 @@ class KandinskyPipeline(DiffusionPipeline):
                 truncation=True,
                 return_attention_mask=True,
                 add_special_tokens=True,
-                return_tensors="pd",
+                return_tensors="np",
             )
             uncond_text_input_ids = uncond_input.input_ids
             uncond_text_mask = uncond_input.attention_mask
@@ -181,7 +182,9 @@ class KandinskyPipeline(DiffusionPipeline):
             uncond_text_encoder_hidden_states = uncond_text_encoder_hidden_states.reshape(
                 [batch_size * num_images_per_prompt, seq_len, -1]
             )
-            uncond_text_mask = uncond_text_mask.repeat_interleave(repeats=num_images_per_prompt, axis=0)
+            uncond_text_mask = paddle.to_tensor(uncond_text_mask).repeat_interleave(
+                repeats=num_images_per_prompt, axis=0
+            )
 
             # done duplicates
 
@@ -12,10 +12,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from collections import OrderedDict
+
+import numpy as np
 import paddle
 import paddlenlp
 from paddlenlp.transformers import RobertaConfig, RobertaModel
 
+from ...models.quantization import quantize_linear_layers
+
 
 class MCLIPConfig(RobertaConfig):
     model_type = "M-CLIP"
@@ -28,6 +33,8 @@ class MCLIPConfig(RobertaConfig):
 
 class MultilingualCLIP(paddlenlp.transformers.PretrainedModel):
     config_class = MCLIPConfig
+    # Number of `forward` results kept for inference, most recently used last. Off until `enable_forward_cache`.
+    _forward_cache_size = 0
 
     def __init__(self, config, *args, **kwargs):
         super().__init__(config, *args, **kwargs)
@@ -35,8 +42,90 @@ class MultilingualCLIP(paddlenlp.transformers.PretrainedModel):
         self.LinearTransformation = paddle.nn.Linear(
             in_features=config.transformerDimensions, out_features=config.numDims
         )
+        self._forward_cache = OrderedDict()
+
+    def quantize_transformer(self, algo: str = "weight_only_int8"):
+        r"""
+        Store the linear weights of the XLM-Roberta transformer quantized with
+        [`~models.quantization.quantize_linear_layers`]. `LinearTransformation` keeps its precision, the projected
+        embeddings are what the prior and decoder see.
+
+        Args:
+            algo (`str`, *optional*, defaults to `"weight_only_int8"`):
+                `"weight_only_int8"` or `"weight_only_int4"`.
+        """
+        quantize_linear_layers([self.transformer], algo)
+        # outputs computed with the full precision weights
+        self._forward_cache.clear()
+
+    def enable_forward_cache(self, maxsize: int = 64):
+        r"""
+        Keep the outputs of the `maxsize` most recently encoded token sequences, so that the pipelines skip the
+        transformer for prompts they have seen before (the negative prompt on every call). Only inputs passed as host
+        arrays or lists are cached, the lookup never reads a tensor back from the device. The cache is disabled by
+        default, and loading weights with `set_state_dict` or `quantize_transformer` clears it.
+
+        Args:
+            maxsize (`int`, *optional*, defaults to 64):
+                Number of cached outputs. `0` disables the cache.
+        """
+        if maxsize < 0:
+            raise ValueError(f"`maxsize` has to be a non-negative integer but is {maxsize}.")
+        self._forward_cache_size = maxsize
+        while len(self._forward_cache) > maxsize:
+            self._forward_cache.popitem(last=False)
+
+    def disable_forward_cache(self):
+        r"""
+        Stop caching outputs and drop the ones already cached.
+        """
+        self.enable_forward_cache(maxsize=0)
+
+    def set_state_dict(self, *args, **kwargs):
+        # outputs computed with the previous weights
+        self._forward_cache.clear()
+        return super().set_state_dict(*args, **kwargs)
+
+    load_dict = set_state_dict
 
     def forward(self, input_ids, attention_mask):
+        # At inference the pipelines pass the token ids as host arrays, so a cached output is found without any
+        # device round trip. Never while training or tracking gradients.
+        cache_key = None
+        if (
+            self._forward_cache_size > 0
+            and not isinstance(input_ids, paddle.Tensor)
+            and not isinstance(attention_mask, paddle.Tensor)
+            and not self.training
+            and not paddle.is_grad_enabled()
+        ):
+            input_ids = np.asarray(input_ids, dtype="int64")
+            attention_mask = np.asarray(attention_mask, dtype="int64")
+            cache_key = (
+                input_ids.shape,
+                input_ids.tobytes(),
+                attention_mask.tobytes(),
+                self.LinearTransformation.weight.dtype,
+            )
+            cached = self._forward_cache.get(cache_key)
+            if cached is not None:
+                self._forward_cache.move_to_end(cache_key)
+                return tuple(t.clone() for t in cached)
+        if not isinstance(input_ids, paddle.Tensor):
+            input_ids = paddle.to_tensor(input_ids)
+        if not isinstance(attention_mask, paddle.Tensor):
+            attention_mask = paddle.to_tensor(attention_mask)
+
         embs = self.transformer(input_ids=input_ids, attention_mask=attention_mask)[0]
-        embs2 = (embs * attention_mask.unsqueeze(axis=2)).sum(axis=1) / attention_mask.sum(axis=1)[:, (None)]
-        return self.LinearTransformation(embs2), embs
+        # masked mean over the tokens as one batched matmul, [B, 1, L] x [B, L, D], so that the masked copy of the
+        # hidden states is never materialized
+        mask = attention_mask.cast(embs.dtype)
+        embs2 = paddle.matmul(mask.unsqueeze(axis=1), embs).squeeze(axis=1) / mask.sum(axis=1, keepdim=True)
+        outputs = (self.LinearTransformation(embs2), embs)
+
+        if cache_key is not None:
+            self._forward_cache[cache_key] = outputs
+            if len(self._forward_cache) > self._forward_cache_size:
+                self._forward_cache.popitem(last=False)
+            outputs = tuple(t.clone() for t in outputs)
+        return outputs
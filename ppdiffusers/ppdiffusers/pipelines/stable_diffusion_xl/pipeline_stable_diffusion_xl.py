@@ -14,12 +14,18 @@
 # limitations under the License.
 import inspect
 import os
+from itertools import chain
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import paddle
 
 from ...image_processor import VaeImageProcessor
-from ...loaders import FromSingleFileMixin, LoraLoaderMixin, TextualInversionLoaderMixin
+from ...loaders import (
+    _LORA_MAX_SHARD_SIZE,
+    FromSingleFileMixin,
+    LoraLoaderMixin,
+    TextualInversionLoaderMixin,
+)
 from ...models import AutoencoderKL, UNet2DConditionModel
 from ...models.attention_processor import (
     LoRAXFormersAttnProcessor,
@@ -713,11 +719,18 @@ class StableDiffusionXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoad
         # We could have accessed the unet config from `lora_state_dict()` too. We pass
         # it here explicitly to be able to tell that it's coming from an SDXL
         # pipeline.
+        pf_lora = kwargs.pop("pf_lora", False)
         state_dict, network_alphas = self.lora_state_dict(
             pretrained_model_name_or_path_or_dict, unet_config=self.unet.config, **kwargs
         )
         self.load_lora_into_unet(state_dict, network_alphas=network_alphas, unet=self.unet)
-        text_encoder_state_dict = {k: v for k, v in state_dict.items() if "text_encoder." in k}
+        # Split the text encoder weights of both encoders in a single pass over the keys.
+        text_encoder_state_dict, text_encoder_2_state_dict = {}, {}
+        for k, v in state_dict.items():
+            if k.startswith("text_encoder."):
+                text_encoder_state_dict[k] = v
+            elif k.startswith("text_encoder_2."):
+                text_encoder_2_state_dict[k] = v
         if len(text_encoder_state_dict) > 0:
             self.load_lora_into_text_encoder(
                 text_encoder_state_dict,
@@ -726,7 +739,6 @@ class StableDiffusionXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoad
                 prefix="text_encoder",
                 lora_scale=self.lora_scale,
             )
-        text_encoder_2_state_dict = {k: v for k, v in state_dict.items() if "text_encoder_2." in k}
         if len(text_encoder_2_state_dict) > 0:
             self.load_lora_into_text_encoder(
                 text_encoder_2_state_dict,
@@ -735,6 +747,14 @@ class StableDiffusionXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoad
                 prefix="text_encoder_2",
                 lora_scale=self.lora_scale,
             )
+        if pf_lora:
+            # A single flat pass over the patched projections of both text encoders.
+            for projection in chain(
+                getattr(self.text_encoder, "_patched_lora_modules", ()),
+                getattr(self.text_encoder_2, "_patched_lora_modules", ()),
+            ):
+                if projection.fused_lora is None:
+                    projection.fuse_down_projection()
 
     @classmethod
     def save_lora_weights(
@@ -747,27 +767,34 @@ class StableDiffusionXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoad
         weight_name: str = None,
         save_function: Callable = None,
         safe_serialization: bool = False,
+        async_save: bool = False,
+        save_dtype: Optional[paddle.dtype] = None,
+        max_shard_size: Optional[int] = _LORA_MAX_SHARD_SIZE,
     ):
-        state_dict = {}
-
-        def pack_weights(layers, prefix):
-            layers_weights = layers.state_dict() if isinstance(layers, paddle.nn.Layer) else layers
-            layers_state_dict = {f"{prefix}.{module_name}": param for module_name, param in layers_weights.items()}
-            return layers_state_dict
+        if unet_lora_layers is None:
+            raise ValueError("You must pass `unet_lora_layers`.")
 
-        state_dict.update(pack_weights(unet_lora_layers, "unet"))
+        # `write_lora_layers` collects the prefixed pairs into the one flat state dict.
+        state_dict = self._pack_lora_weights(unet_lora_layers, "unet", save_dtype)
         if text_encoder_lora_layers and text_encoder_2_lora_layers:
-            state_dict.update(pack_weights(text_encoder_lora_layers, "text_encoder"))
-            state_dict.update(pack_weights(text_encoder_2_lora_layers, "text_encoder_2"))
-        self.write_lora_layers(
+            state_dict = chain(
+                state_dict,
+                self._pack_lora_weights(text_encoder_lora_layers, "text_encoder", save_dtype),
+                self._pack_lora_weights(text_encoder_2_lora_layers, "text_encoder_2", save_dtype),
+            )
+        return self.write_lora_layers(
             state_dict=state_dict,
             save_directory=save_directory,
             is_main_process=is_main_process,
             weight_name=weight_name,
             save_function=save_function,
             safe_serialization=safe_serialization,
+            async_save=async_save,
+            max_shard_size=max_shard_size,
         )
 
     def _remove_text_encoder_monkey_patch(self):
-        self._remove_text_encoder_monkey_patch_classmethod(self.text_encoder)
-        self._remove_text_encoder_monkey_patch_classmethod(self.text_encoder_2)
+        # Each call is a flat pass over the projections patched in that encoder, and returns right away
+        # for an encoder that is missing or was never patched.
+        for text_encoder in (self.text_encoder, self.text_encoder_2):
+            self._remove_text_encoder_monkey_patch_classmethod(text_encoder)
@@ -122,3 +122,26 @@ class DeprecatedAttentionBlockTests(unittest.TestCase):
         ).images
         self.assertTrue(np.allclose(pre_conversion, conversion, atol=1e-03, rtol=1e-03))
         self.assertTrue(np.allclose(conversion, after_conversion, atol=1e-03, rtol=1e-03))
+
+
+class FusedProjectionsTests(unittest.TestCase):
+    def test_fused_projections_match_separate(self):
+        paddle.seed(0)
+        hidden_states = paddle.rand((2, 6, 16))
+        encoder_hidden_states = paddle.rand((2, 5, 12))
+
+        for cross_attention_dim, bias in [(None, False), (12, False), (12, True)]:
+            attn = Attention(query_dim=16, cross_attention_dim=cross_attention_dim, heads=2, dim_head=8, bias=bias)
+            attn.eval()
+            context = encoder_hidden_states if cross_attention_dim is not None else None
+
+            expected = attn(hidden_states, encoder_hidden_states=context)
+            attn.fuse_projections()
+            self.assertTrue(attn.fused_projections)
+            fused = attn(hidden_states, encoder_hidden_states=context)
+            attn.unfuse_projections()
+            unfused = attn(hidden_states, encoder_hidden_states=context)
+
+            self.assertTrue(np.allclose(expected.numpy(), fused.numpy(), atol=1e-5))
+            self.assertTrue(np.allclose(expected.numpy(), unfused.numpy()))
+            self.assertFalse(any("to_qkv" in k or "to_kv" in k for k in attn.state_dict()))
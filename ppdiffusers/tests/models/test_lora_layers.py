@@ -39,6 +39,7 @@ from ppdiffusers.loaders import (
     LoraLoaderMixin,
     PatchedLoraProjection,
     text_encoder_attn_modules,
+    text_encoder_lora_state_dict,
 )
 from ppdiffusers.models.attention_processor import (
     Attention,
@@ -330,6 +331,107 @@ class LoraLoaderMixinTests(unittest.TestCase):
             x=outputs_without_lora, y=outputs_without_lora_removed
         ).item(), "remove lora monkey patch should restore the original outputs"
 
+    def test_text_encoder_lora_fuse_down_projection(self):
+        pipeline_components, _ = self.get_dummy_components()
+        pipe = StableDiffusionPipeline(**pipeline_components)
+        dummy_tokens = self.get_dummy_tokens()
+        params = pipe._modify_text_encoder(pipe.text_encoder, pipe.lora_scale)
+        set_lora_weights(params, randn_weight=True)
+        outputs_with_lora = pipe.text_encoder(**dummy_tokens)[0]
+        # fuse the lora down projections with the base weights
+        pipe._fuse_text_encoder_lora(pipe.text_encoder)
+        outputs_with_fused_lora = pipe.text_encoder(**dummy_tokens)[0]
+        assert paddle.allclose(
+            x=outputs_with_lora, y=outputs_with_fused_lora, atol=1e-4
+        ).item(), "fused lora outputs should be the same as the lora outputs"
+
+    def test_text_encoder_lora_fuse_qkv(self):
+        pipeline_components, _ = self.get_dummy_components()
+        pipe = StableDiffusionPipeline(**pipeline_components)
+        dummy_tokens = self.get_dummy_tokens()
+        params = pipe._modify_text_encoder(pipe.text_encoder, pipe.lora_scale)
+        set_lora_weights(params, randn_weight=True)
+        outputs_with_lora = pipe.text_encoder(**dummy_tokens)[0]
+        # share one lora matmul pair between the q/k/v projections
+        pipe._fuse_text_encoder_qkv_lora(pipe.text_encoder)
+        outputs_with_fused_lora = pipe.text_encoder(**dummy_tokens)[0]
+        assert paddle.allclose(
+            x=outputs_with_lora, y=outputs_with_fused_lora, atol=1e-4
+        ).item(), "fused q/k/v lora outputs should be the same as the lora outputs"
+        # the shared outputs only live for the attention call
+        fused_qkv = pipe.text_encoder.text_model.transformer.layers[0].self_attn.q_proj.fused_qkv[0]
+        self.assertIsNone(fused_qkv._local.shared)
+        # the fused weights are copies, new lora weights are seen after `build`
+        set_lora_weights(params, randn_weight=True)
+        outputs_with_new_lora = pipe.text_encoder(**dummy_tokens)[0]
+        for layer in pipe.text_encoder.text_model.transformer.layers:
+            layer.self_attn.q_proj.fused_qkv[0].build()
+        assert not paddle.allclose(
+            x=outputs_with_new_lora, y=pipe.text_encoder(**dummy_tokens)[0], atol=1e-4
+        ).item(), "rebuilt fused q/k/v lora should use the new lora weights"
+        # unloading also removes the fused q/k/v computation
+        pipe._remove_text_encoder_monkey_patch_classmethod(pipe.text_encoder)
+        self.assertTrue(
+            all("_prepare_qkv" not in vars(layer.self_attn) for layer in pipe.text_encoder.text_model.transformer.layers)
+        )
+
+    def test_text_encoder_lora_copies_state_dict(self):
+        pipeline_components, _ = self.get_dummy_components()
+        pipe = StableDiffusionPipeline(**pipeline_components)
+        dummy_tokens = self.get_dummy_tokens()
+        params = pipe._modify_text_encoder(pipe.text_encoder, pipe.lora_scale)
+        set_lora_weights(params, randn_weight=True)
+        state_dict = {
+            f"text_encoder.{k}": v.clone() for k, v in text_encoder_lora_state_dict(pipe.text_encoder).items()
+        }
+        pipe._remove_text_encoder_monkey_patch()
+        pipe.load_lora_into_text_encoder(state_dict, network_alphas=None, text_encoder=pipe.text_encoder)
+        outputs = pipe.text_encoder(**dummy_tokens)[0]
+        # the caller's state dict stays its own, editing it does not change the loaded lora
+        with paddle.no_grad():
+            for value in state_dict.values():
+                value.zero_()
+        assert paddle.allclose(
+            x=outputs, y=pipe.text_encoder(**dummy_tokens)[0], atol=1e-6
+        ).item(), "the text encoder lora parameters should not alias the state dict passed in"
+
+    def test_text_encoder_kohya_lora_alpha(self):
+        pipeline_components, _ = self.get_dummy_components()
+        pipe = StableDiffusionPipeline(**pipeline_components)
+        dummy_tokens = self.get_dummy_tokens()
+        rank, alpha = 4, 2.0
+        hidden_size = pipe.text_encoder.config.hidden_size
+        paddle.seed(0)
+        kohya_lora = {}
+        for i in range(len(pipe.text_encoder.text_model.transformer.layers)):
+            for proj in ("q", "k", "v", "out"):
+                name = f"lora_te_text_model_encoder_layers_{i}_self_attn_{proj}_proj"
+                kohya_lora[f"{name}.lora_down.weight"] = paddle.randn([rank, hidden_size])
+                kohya_lora[f"{name}.lora_up.weight"] = paddle.randn([hidden_size, rank])
+                kohya_lora[f"{name}.alpha"] = paddle.to_tensor(alpha)
+        # the same LoRA with `alpha / rank` folded into the up weights by hand
+        prescaled_lora = {
+            k: v * (alpha / rank) if k.endswith("lora_up.weight") else v
+            for k, v in kohya_lora.items()
+            if not k.endswith(".alpha")
+        }
+        unscaled_lora = {k: v for k, v in kohya_lora.items() if not k.endswith(".alpha")}
+
+        def encode(lora):
+            state_dict, network_alphas = pipe.lora_state_dict(dict(lora))
+            pipe.load_lora_into_text_encoder(state_dict, network_alphas=network_alphas, text_encoder=pipe.text_encoder)
+            outputs = pipe.text_encoder(**dummy_tokens)[0]
+            pipe._remove_text_encoder_monkey_patch()
+            return outputs
+
+        outputs_with_alpha = encode(kohya_lora)
+        assert paddle.allclose(
+            x=outputs_with_alpha, y=encode(prescaled_lora), atol=1e-4
+        ).item(), "text encoder lora alphas should scale the lora outputs by alpha / rank"
+        assert not paddle.allclose(
+            x=outputs_with_alpha, y=encode(unscaled_lora), atol=1e-4
+        ).item(), "text encoder lora alphas should not be ignored"
+
     def test_text_encoder_lora_scale(self):
         pipeline_components, lora_components = self.get_dummy_components()
         sd_pipe = StableDiffusionPipeline(**pipeline_components)
@@ -409,6 +511,79 @@ class LoraLoaderMixinTests(unittest.TestCase):
             orig_image_slice, orig_image_slice_two, atol=0.001
         ), "Unloading LoRA parameters should lead to results similar to what was obtained with the pipeline without any LoRA parameters."
 
+    def test_async_save_lora_weights(self):
+        _, lora_components = self.get_dummy_components()
+        with tempfile.TemporaryDirectory() as first_dir, tempfile.TemporaryDirectory() as second_dir:
+            # a save only waits for the pending save to its own directory
+            futures = [
+                LoraLoaderMixin.save_lora_weights(
+                    save_directory=save_directory,
+                    unet_lora_layers=lora_components["unet_lora_layers"],
+                    text_encoder_lora_layers=lora_components["text_encoder_lora_layers"],
+                    async_save=True,
+                )
+                for save_directory in (first_dir, second_dir, first_dir)
+            ]
+            for future in futures:
+                future.result(timeout=60)
+            for save_directory in (first_dir, second_dir):
+                self.assertTrue(os.path.isfile(os.path.join(save_directory, "paddle_lora_weights.pdparams")))
+
+    def test_lora_merge_matches_unmerged(self):
+        pipeline_components, lora_components = self.get_dummy_components()
+        _, _, pipeline_inputs = self.get_dummy_inputs(with_generator=False)
+        set_lora_weights(lora_components["unet_lora_layers"].parameters(), randn_weight=True)
+        set_lora_weights(lora_components["text_encoder_lora_layers"].parameters(), randn_weight=True)
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            LoraLoaderMixin.save_lora_weights(
+                save_directory=tmpdirname,
+                unet_lora_layers=lora_components["unet_lora_layers"],
+                text_encoder_lora_layers=lora_components["text_encoder_lora_layers"],
+            )
+            sd_pipe = StableDiffusionPipeline(**pipeline_components)
+            sd_pipe.load_lora_weights(tmpdirname)
+            lora_images = sd_pipe(**pipeline_inputs, generator=paddle.Generator().manual_seed(0)).images
+            pipeline_components, _ = self.get_dummy_components()
+            merged_pipe = StableDiffusionPipeline(**pipeline_components)
+            merged_pipe.load_lora_weights(tmpdirname, merge=True)
+        merged_images = merged_pipe(**pipeline_inputs, generator=paddle.Generator().manual_seed(0)).images
+        # merged weights leave the vanilla attention processors in place
+        for _, module in merged_pipe.unet.named_sublayers():
+            if isinstance(module, Attention):
+                self.assertIsInstance(module.processor, (AttnProcessor, AttnProcessor2_5))
+        assert np.allclose(
+            lora_images[0, -3:, -3:, -1], merged_images[0, -3:, -3:, -1], atol=0.001
+        ), "Merged LoRA weights should give the same results as LoRA layers."
+
+    def test_unload_merged_and_stacked_lora(self):
+        pipeline_components, lora_components = self.get_dummy_components()
+        _, _, pipeline_inputs = self.get_dummy_inputs(with_generator=False)
+        sd_pipe = StableDiffusionPipeline(**pipeline_components)
+        original_images = sd_pipe(**pipeline_inputs, generator=paddle.Generator().manual_seed(0)).images
+        set_lora_weights(lora_components["unet_lora_layers"].parameters(), randn_weight=True)
+        set_lora_weights(lora_components["text_encoder_lora_layers"].parameters(), randn_weight=True)
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            LoraLoaderMixin.save_lora_weights(
+                save_directory=tmpdirname,
+                unet_lora_layers=lora_components["unet_lora_layers"],
+                text_encoder_lora_layers=lora_components["text_encoder_lora_layers"],
+            )
+            for load in (
+                lambda: sd_pipe.load_lora_weights(tmpdirname, merge=True),
+                lambda: sd_pipe.load_lora_weights(tmpdirname, stack=True),
+                lambda: sd_pipe.load_lora_weights_many([tmpdirname, tmpdirname], adapter_weights=[0.5, 1.0]),
+            ):
+                load()
+                lora_images = sd_pipe(**pipeline_inputs, generator=paddle.Generator().manual_seed(0)).images
+                assert not np.allclose(
+                    original_images[0, -3:, -3:, -1], lora_images[0, -3:, -3:, -1]
+                ), "LoRA parameters should lead to a different image slice."
+                sd_pipe.unload_lora_weights()
+                unloaded_images = sd_pipe(**pipeline_inputs, generator=paddle.Generator().manual_seed(0)).images
+                assert np.allclose(
+                    original_images[0, -3:, -3:, -1], unloaded_images[0, -3:, -3:, -1], atol=0.001
+                ), "Unloading merged LoRA weights should restore the base model."
+
     def test_lora_unet_attn_processors_with_xformers(self):
         with tempfile.TemporaryDirectory() as tmpdirname:
             self.create_lora_weight_file(tmpdirname)
@@ -0,0 +1,51 @@
+# Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import numpy as np
+import paddle
+
+from ppdiffusers.models.quantization import WeightOnlyLinear, quantize_linear_layers
+from ppdiffusers.utils.testing_utils import require_paddle_gpu
+
+
+class QuantizeLinearLayersTests(unittest.TestCase):
+    def get_model(self, dtype):
+        paddle.seed(0)
+        model = paddle.nn.Sequential(paddle.nn.Linear(64, 128), paddle.nn.GELU(), paddle.nn.Linear(128, 64))
+        return model.to(dtype=dtype)
+
+    def test_rejects_unknown_algo(self):
+        with self.assertRaises(ValueError):
+            quantize_linear_layers([self.get_model("float32")], algo="weight_only_int2")
+
+    def test_rejects_float32(self):
+        model = self.get_model("float32")
+        with self.assertRaises(ValueError):
+            quantize_linear_layers([model])
+        # nothing was replaced
+        self.assertTrue(all(isinstance(model[i], paddle.nn.Linear) for i in (0, 2)))
+
+    @require_paddle_gpu
+    def test_weight_only_int8(self):
+        model = self.get_model("float16")
+        x = paddle.randn([4, 64]).cast("float16")
+        expected = model(x).cast("float32").numpy()
+
+        quantize_linear_layers([model])
+        self.assertTrue(all(isinstance(model[i], WeightOnlyLinear) for i in (0, 2)))
+        output = model(x)
+        self.assertEqual(output.dtype, paddle.float16)
+        self.assertLess(np.abs(output.cast("float32").numpy() - expected).max(), 0.05)
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import functools
 import gc
 import random
 import tempfile
@@ -30,6 +32,7 @@ from ppdiffusers import (
     UNet2DConditionModel,
 )
 from ppdiffusers.initializer import normal_, ones_
+from ppdiffusers.loaders import LoraLoaderMixin, text_encoder_lora_state_dict
 from ppdiffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_controlnet import (
     MultiControlNetModel,
 )
@@ -50,6 +53,12 @@ from ..test_pipelines_common import (
 enable_full_determinism()
 
 
+@functools.lru_cache(maxsize=1)
+def _tokenizer():
+    # Loading parses the vocabulary and merges; the tests never modify the tokenizer, so one instance serves them all.
+    return CLIPTokenizer.from_pretrained("hf-internal-testing/tiny-random-clip")
+
+
 class ControlNetImg2ImgPipelineFastTests(
     PipelineLatentTesterMixin, PipelineKarrasSchedulerTesterMixin, PipelineTesterMixin, unittest.TestCase
 ):
@@ -59,7 +68,19 @@ class ControlNetImg2ImgPipelineFastTests(
     image_params = IMAGE_TO_IMAGE_IMAGE_PARAMS.union({"control_image"})
     image_latents_params = IMAGE_TO_IMAGE_IMAGE_PARAMS
 
+    _dummy_components = None
+
     def get_dummy_components(self):
+        # Building the models takes most of the time of these tests, build them once per class and hand every test
+        # its own copy, so tests that modify their components stay independent.
+        cls = type(self)
+        if cls._dummy_components is None:
+            cls._dummy_components = cls._build_dummy_components()
+        tokenizer = cls._dummy_components["tokenizer"]
+        return copy.deepcopy(cls._dummy_components, {id(tokenizer): tokenizer})
+
+    @classmethod
+    def _build_dummy_components(cls):
         paddle.seed(seed=0)
         unet = UNet2DConditionModel(
             block_out_channels=(32, 64),
@@ -110,7 +131,7 @@ class ControlNetImg2ImgPipelineFastTests(
             vocab_size=1000,
         )
         text_encoder = CLIPTextModel(text_encoder_config)
-        tokenizer = CLIPTokenizer.from_pretrained("hf-internal-testing/tiny-random-clip")
+        tokenizer = _tokenizer()
         components = {
             "unet": unet,
             "controlnet": controlnet,
@@ -131,8 +152,8 @@ class ControlNetImg2ImgPipelineFastTests(
             generator=generator,
         )
         image = floats_tensor(control_image.shape, rng=random.Random(seed))
-        image = image.cpu().transpose(perm=[0, 2, 3, 1])[0]
-        image = Image.fromarray(np.uint8(image)).convert("RGB").resize((64, 64))
+        # already at the 64x64 input size, an RGB image without converting or resizing
+        image = Image.fromarray(image.transpose(perm=[0, 2, 3, 1])[0].numpy().astype(np.uint8))
         inputs = {
             "prompt": "A painting of a squirrel eating a burger",
             "generator": generator,
@@ -153,6 +174,229 @@ class ControlNetImg2ImgPipelineFastTests(
     def test_inference_batch_single_identical(self):
         self._test_inference_batch_single_identical(expected_max_diff=0.002)
 
+    def test_int_guidance_scale(self):
+        pipe = self.pipeline_class(**self.get_dummy_components())
+        pipe.set_progress_bar_config(disable=None)
+        inputs = self.get_dummy_inputs()
+        inputs["guidance_scale"] = 6
+        images = pipe(**inputs).images
+        expected = pipe(**self.get_dummy_inputs()).images
+        self.assertLess(np.abs(images - expected).max(), 1e-4)
+
+    def test_submit_matches_single_calls(self):
+        pipe = self.pipeline_class(**self.get_dummy_components())
+        pipe.set_progress_bar_config(disable=None)
+        expected = [pipe(**self.get_dummy_inputs(seed)).images for seed in (0, 1)]
+
+        # Both requests land in the same batching window and run as one pipeline call.
+        pipe._submit_max_wait_ms = 1000
+        futures = [pipe.submit(**self.get_dummy_inputs(seed)) for seed in (0, 1)]
+        for future, expected_images in zip(futures, expected):
+            images = future.result(timeout=600).images
+            self.assertEqual(images.shape, expected_images.shape)
+            self.assertLess(np.abs(images - expected_images).max(), 0.002)
+
+    def test_submit_batches_only_equal_image_sizes(self):
+        pipe = self.pipeline_class(**self.get_dummy_components())
+        inputs = self.get_dummy_inputs()
+        request = (inputs["prompt"], inputs["image"], inputs["control_image"], {}, None)
+        resized = (inputs["prompt"], inputs["image"].resize((32, 32)), inputs["control_image"], {}, None)
+        self.assertTrue(pipe._can_batch(request, request))
+        self.assertFalse(pipe._can_batch(request, resized))
+
+    def test_submit_does_not_batch_uncomparable_kwargs(self):
+        pipe = self.pipeline_class(**self.get_dummy_components())
+        inputs = self.get_dummy_inputs()
+        kwargs = {"cross_attention_kwargs": {"scale": paddle.ones([2])}}
+        request = (inputs["prompt"], inputs["image"], inputs["control_image"], kwargs, None)
+        self.assertFalse(pipe._can_batch(request, request))
+
+    def test_submit_worker_survives_errors(self):
+        pipe = self.pipeline_class(**self.get_dummy_components())
+        pipe.set_progress_bar_config(disable=None)
+
+        def broken_can_batch(request, other_request):
+            raise RuntimeError("grouping failed")
+
+        # Both requests land in the same batching window, grouping them fails.
+        pipe._can_batch = broken_can_batch
+        pipe._submit_max_wait_ms = 1000
+        futures = [pipe.submit(**self.get_dummy_inputs(seed)) for seed in (0, 1)]
+        for future in futures:
+            with self.assertRaises(RuntimeError):
+                future.result(timeout=600)
+
+        # The worker is still running and serves the next request.
+        del pipe._can_batch
+        pipe.submit(**self.get_dummy_inputs()).result(timeout=600)
+        pipe.close()
+
+    def test_submit_worker_stops(self):
+        pipe = self.pipeline_class(**self.get_dummy_components())
+        pipe.set_progress_bar_config(disable=None)
+        future = pipe.submit(**self.get_dummy_inputs())
+        thread = pipe._submit_thread
+        pipe.close()
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(future.done())
+
+        # The worker only holds a weak reference to the pipeline, dropping the pipeline stops it too.
+        pipe.submit(**self.get_dummy_inputs()).result(timeout=600)
+        thread = pipe._submit_thread
+        del pipe
+        for _ in range(10):
+            gc.collect()
+            thread.join(timeout=1)
+            if not thread.is_alive():
+                break
+        self.assertFalse(thread.is_alive())
+
+    def test_prompt_cache(self):
+        pipe = self.pipeline_class(**self.get_dummy_components())
+        calls = []
+        pipe.text_encoder.register_forward_pre_hook(lambda layer, inputs: calls.append(None))
+        prompt = self.get_dummy_inputs()["prompt"]
+
+        # Off by default: every call runs the text encoder.
+        expected = pipe._encode_prompt(prompt, 1, False).numpy()
+        pipe._encode_prompt(prompt, 1, False)
+        self.assertEqual(len(calls), 2)
+
+        pipe.enable_prompt_cache(maxsize=1)
+        pipe._encode_prompt(prompt, 1, False)
+        cached = pipe._encode_prompt(prompt, 1, False)
+        self.assertEqual(len(calls), 3)
+        self.assertLess(np.abs(cached.numpy() - expected).max(), 1e-6)
+
+        pipe.disable_prompt_cache()
+        self.assertEqual(len(pipe._prompt_cache), 0)
+        pipe._encode_prompt(prompt, 1, False)
+        self.assertEqual(len(calls), 4)
+
+    @staticmethod
+    def _random_text_encoder_lora(text_encoder, seed):
+        # Every seed gives a LoRA of the same rank and layout, only the weights differ.
+        params = LoraLoaderMixin._modify_text_encoder(text_encoder)
+        paddle.seed(seed)
+        with paddle.no_grad():
+            for param in params:
+                param.set_value(paddle.randn(param.shape, dtype=param.dtype))
+        state_dict = {f"text_encoder.{k}": v.clone() for k, v in text_encoder_lora_state_dict(text_encoder).items()}
+        LoraLoaderMixin._remove_text_encoder_monkey_patch_classmethod(text_encoder)
+        return state_dict
+
+    def test_prompt_cache_tracks_text_encoder_lora(self):
+        pipe = self.pipeline_class(**self.get_dummy_components())
+        pipe.enable_prompt_cache()
+        loras = [self._random_text_encoder_lora(pipe.text_encoder, seed) for seed in (0, 1)]
+        prompt = self.get_dummy_inputs()["prompt"]
+
+        def encode():
+            return pipe._encode_prompt(prompt, 1, False).numpy()
+
+        without_lora = encode()
+        with_lora = []
+        for lora in loras:
+            pipe.load_lora_into_text_encoder(lora, network_alphas=None, text_encoder=pipe.text_encoder)
+            with_lora.append(encode())
+        self.assertGreater(np.abs(with_lora[0] - without_lora).max(), 1e-3)
+        self.assertGreater(np.abs(with_lora[1] - with_lora[0]).max(), 1e-3)
+
+        pipe.unload_lora_weights()
+        self.assertEqual(len(pipe._prompt_cache), 0)
+        self.assertLess(np.abs(encode() - without_lora).max(), 1e-5)
+
+    def test_quantize_controlnet_rejects_float32(self):
+        pipe = self.pipeline_class(**self.get_dummy_components())
+        with self.assertRaises(ValueError):
+            pipe.quantize_controlnet()
+
+    @require_paddle_gpu
+    def test_quantize_controlnet(self):
+        pipe = self.pipeline_class(**self.get_dummy_components())
+        pipe.to(paddle_dtype=paddle.float16)
+        pipe.set_progress_bar_config(disable=None)
+        inputs = self.get_dummy_inputs()
+        inputs["control_image"] = inputs["control_image"].cast(paddle.float16)
+        expected = pipe(**inputs).images
+
+        pipe.quantize_controlnet()
+        self.assertFalse(any(isinstance(layer, paddle.nn.Linear) for layer in pipe.controlnet.sublayers()))
+        inputs = self.get_dummy_inputs()
+        inputs["control_image"] = inputs["control_image"].cast(paddle.float16)
+        images = pipe(**inputs).images
+        self.assertEqual(images.shape, expected.shape)
+        self.assertLess(np.abs(images - expected).max(), 0.05)
+
+    @require_paddle_gpu
+    def test_compile_model(self):
+        pipe = self.pipeline_class(**self.get_dummy_components())
+        pipe.set_progress_bar_config(disable=None)
+        expected = pipe(**self.get_dummy_inputs()).images
+
+        pipe.enable_compile()
+        images = pipe(**self.get_dummy_inputs(), compile_model=True).images
+        self.assertLess(np.abs(images - expected).max(), 0.002)
+
+        pipe.disable_compile()
+        self.assertNotIn("forward", pipe.unet.__dict__)
+        self.assertNotIn("forward", pipe.controlnet.__dict__)
+        images = pipe(**self.get_dummy_inputs()).images
+        self.assertLess(np.abs(images - expected).max(), 1e-5)
+
+    @require_paddle_gpu
+    def test_enable_compile_retraces_after_fuse(self):
+        pipe = self.pipeline_class(**self.get_dummy_components())
+        pipe.set_progress_bar_config(disable=None)
+        expected = pipe(**self.get_dummy_inputs()).images
+
+        pipe.enable_compile()
+        pipe(**self.get_dummy_inputs())
+        compiled_forward = pipe.unet.forward
+        pipe.fuse_qkv_projections()
+        self.assertIsNot(pipe.unet.forward, compiled_forward)
+        self.assertIn("forward", pipe.unet.__dict__)
+        images = pipe(**self.get_dummy_inputs()).images
+        self.assertLess(np.abs(images - expected).max(), 0.002)
+
+    @require_paddle_gpu
+    def test_model_cpu_offload(self):
+        pipe = self.pipeline_class(**self.get_dummy_components())
+        pipe.set_progress_bar_config(disable=None)
+        expected = pipe(**self.get_dummy_inputs()).images
+
+        def on_cpu(model):
+            return all(param.place.is_cpu_place() for param in model.parameters())
+
+        pipe.enable_model_cpu_offload()
+        images = pipe(**self.get_dummy_inputs()).images
+        self.assertLess(np.abs(images - expected).max(), 0.002)
+        self.assertTrue(on_cpu(pipe.text_encoder) and on_cpu(pipe.vae))
+        self.assertFalse(on_cpu(pipe.unet))
+
+        images = pipe(**self.get_dummy_inputs(), low_vram=True).images
+        self.assertLess(np.abs(images - expected).max(), 0.002)
+        self.assertTrue(on_cpu(pipe.text_encoder) and on_cpu(pipe.vae))
+        self.assertFalse(on_cpu(pipe.unet) or on_cpu(pipe.controlnet))
+
+        # A default call after a `low_vram` one finds the UNet and ControlNet where they were.
+        images = pipe(**self.get_dummy_inputs()).images
+        self.assertLess(np.abs(images - expected).max(), 0.002)
+
+    @require_paddle_gpu
+    def test_low_vram_keeps_model_places(self):
+        pipe = self.pipeline_class(**self.get_dummy_components())
+        pipe.set_progress_bar_config(disable=None)
+        expected = pipe(**self.get_dummy_inputs()).images
+
+        images = pipe(**self.get_dummy_inputs(), low_vram=True).images
+        self.assertLess(np.abs(images - expected).max(), 0.002)
+        for model in (pipe.text_encoder, pipe.vae, pipe.unet, pipe.controlnet):
+            self.assertFalse(any(param.place.is_cpu_place() for param in model.parameters()))
+
+        images = pipe(**self.get_dummy_inputs()).images
+        self.assertLess(np.abs(images - expected).max(), 0.002)
+
 
 class StableDiffusionMultiControlNetPipelineFastTests(
     PipelineTesterMixin, PipelineKarrasSchedulerTesterMixin, unittest.TestCase
@@ -162,7 +406,17 @@ class StableDiffusionMultiControlNetPipelineFastTests(
     batch_params = TEXT_GUIDED_IMAGE_VARIATION_BATCH_PARAMS
     image_params = frozenset([])
 
+    _dummy_components = None
+
     def get_dummy_components(self):
+        cls = type(self)
+        if cls._dummy_components is None:
+            cls._dummy_components = cls._build_dummy_components()
+        tokenizer = cls._dummy_components["tokenizer"]
+        return copy.deepcopy(cls._dummy_components, {id(tokenizer): tokenizer})
+
+    @classmethod
+    def _build_dummy_components(cls):
         paddle.seed(seed=0)
         unet = UNet2DConditionModel(
             block_out_channels=(32, 64),
@@ -234,7 +488,7 @@ class StableDiffusionMultiControlNetPipelineFastTests(
             vocab_size=1000,
         )
         text_encoder = CLIPTextModel(text_encoder_config)
-        tokenizer = CLIPTokenizer.from_pretrained("hf-internal-testing/tiny-random-clip")
+        tokenizer = _tokenizer()
         controlnet = MultiControlNetModel([controlnet1, controlnet2])
         components = {
             "unet": unet,
@@ -262,8 +516,8 @@ class StableDiffusionMultiControlNetPipelineFastTests(
             ),
         ]
         image = floats_tensor(control_image[0].shape, rng=random.Random(seed))
-        image = image.cpu().transpose(perm=[0, 2, 3, 1])[0]
-        image = Image.fromarray(np.uint8(image)).convert("RGB").resize((64, 64))
+        # already at the 64x64 input size, an RGB image without converting or resizing
+        image = Image.fromarray(image.transpose(perm=[0, 2, 3, 1])[0].numpy().astype(np.uint8))
         inputs = {
             "prompt": "A painting of a squirrel eating a burger",
             "generator": generator,
@@ -278,24 +532,19 @@ class StableDiffusionMultiControlNetPipelineFastTests(
     def test_control_guidance_switch(self):
         components = self.get_dummy_components()
         pipe = self.pipeline_class(**components)
-        scale = 10.0
-        steps = 4
-        inputs = self.get_dummy_inputs()
-        inputs["num_inference_steps"] = steps
-        inputs["controlnet_conditioning_scale"] = scale
-        output_1 = pipe(**inputs)[0]
         inputs = self.get_dummy_inputs()
-        inputs["num_inference_steps"] = steps
-        inputs["controlnet_conditioning_scale"] = scale
-        output_2 = pipe(**inputs, control_guidance_start=0.1, control_guidance_end=0.2)[0]
-        inputs = self.get_dummy_inputs()
-        inputs["num_inference_steps"] = steps
-        inputs["controlnet_conditioning_scale"] = scale
-        output_3 = pipe(**inputs, control_guidance_start=[0.1, 0.3], control_guidance_end=[0.2, 0.7])[0]
-        inputs = self.get_dummy_inputs()
-        inputs["num_inference_steps"] = steps
-        inputs["controlnet_conditioning_scale"] = scale
-        output_4 = pipe(**inputs, control_guidance_start=0.4, control_guidance_end=[0.5, 0.8])[0]
+        inputs["num_inference_steps"] = 4
+        inputs["controlnet_conditioning_scale"] = 10.0
+
+        def run(**kwargs):
+            # the inputs only differ in the guidance window, every run starts from the same noise
+            inputs["generator"] = paddle.Generator().manual_seed(0)
+            return pipe(**inputs, **kwargs)[0]
+
+        output_1 = run()
+        output_2 = run(control_guidance_start=0.1, control_guidance_end=0.2)
+        output_3 = run(control_guidance_start=[0.1, 0.3], control_guidance_end=[0.2, 0.7])
+        output_4 = run(control_guidance_start=0.4, control_guidance_end=[0.5, 0.8])
         assert np.sum(np.abs(output_1 - output_2)) > 0.001
         assert np.sum(np.abs(output_1 - output_3)) > 0.001
         assert np.sum(np.abs(output_1 - output_4)) > 0.001
@@ -323,6 +572,15 @@ class StableDiffusionMultiControlNetPipelineFastTests(
 @slow
 @require_paddle_gpu
 class ControlNetImg2ImgPipelineSlowTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.control_image = load_image(
+            "https://huggingface.co/datasets/hf-internal-testing/diffusers-images/resolve/main/sd_controlnet/bird_canny.png"
+        ).resize((512, 512))
+        cls.image = load_image(
+            "https://huggingface.co/lllyasviel/sd-controlnet-canny/resolve/main/images/bird.png"
+        ).resize((512, 512))
+
     def tearDown(self):
         super().tearDown()
         gc.collect()
@@ -337,16 +595,10 @@ class ControlNetImg2ImgPipelineSlowTests(unittest.TestCase):
         pipe.set_progress_bar_config(disable=None)
         generator = paddle.Generator().manual_seed(0)
         prompt = "evil space-punk bird"
-        control_image = load_image(
-            "https://huggingface.co/datasets/hf-internal-testing/diffusers-images/resolve/main/sd_controlnet/bird_canny.png"
-        ).resize((512, 512))
-        image = load_image(
-            "https://huggingface.co/lllyasviel/sd-controlnet-canny/resolve/main/images/bird.png"
-        ).resize((512, 512))
         output = pipe(
             prompt,
-            image,
-            control_image=control_image,
+            self.image,
+            control_image=self.control_image,
             generator=generator,
             output_type="np",
             num_inference_steps=50,
@@ -360,42 +612,41 @@ class ControlNetImg2ImgPipelineSlowTests(unittest.TestCase):
         assert np.abs(expected_image - image).max() < 0.09
 
     def test_load_local(self):
-        controlnet = ControlNetModel.from_pretrained("lllyasviel/control_v11p_sd15_canny")
-        pipe_1 = StableDiffusionControlNetImg2ImgPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5", safety_checker=None, controlnet=controlnet
-        )
-        controlnet = ControlNetModel.from_single_file(
-            "https://huggingface.co/lllyasviel/ControlNet-v1-1/blob/main/control_v11p_sd15_canny.pth"
-        )
-        pipe_2 = StableDiffusionControlNetImg2ImgPipeline.from_single_file(
-            "https://huggingface.co/runwayml/stable-diffusion-v1-5/blob/main/v1-5-pruned-emaonly.safetensors",
-            safety_checker=None,
-            controlnet=controlnet,
-        )
-        control_image = load_image(
-            "https://huggingface.co/datasets/hf-internal-testing/diffusers-images/resolve/main/sd_controlnet/bird_canny.png"
-        ).resize((512, 512))
-        image = load_image(
-            "https://huggingface.co/lllyasviel/sd-controlnet-canny/resolve/main/images/bird.png"
-        ).resize((512, 512))
-        pipes = [pipe_1, pipe_2]
+        def from_pretrained():
+            controlnet = ControlNetModel.from_pretrained("lllyasviel/control_v11p_sd15_canny")
+            return StableDiffusionControlNetImg2ImgPipeline.from_pretrained(
+                "runwayml/stable-diffusion-v1-5", safety_checker=None, controlnet=controlnet
+            )
+
+        def from_single_file():
+            controlnet = ControlNetModel.from_single_file(
+                "https://huggingface.co/lllyasviel/ControlNet-v1-1/blob/main/control_v11p_sd15_canny.pth"
+            )
+            return StableDiffusionControlNetImg2ImgPipeline.from_single_file(
+                "https://huggingface.co/runwayml/stable-diffusion-v1-5/blob/main/v1-5-pruned-emaonly.safetensors",
+                safety_checker=None,
+                controlnet=controlnet,
+            )
+
         images = []
-        for pipe in pipes:
+        # Load each pipeline only once the previous one is released, so only one of them is in memory at a time.
+        for load_pipe in (from_pretrained, from_single_file):
+            pipe = load_pipe()
             pipe.enable_model_cpu_offload()
             pipe.set_progress_bar_config(disable=None)
             generator = paddle.Generator().manual_seed(0)
             prompt = "bird"
             output = pipe(
                 prompt,
-                image=image,
-                control_image=control_image,
+                image=self.image,
+                control_image=self.control_image,
                 strength=0.9,
                 generator=generator,
                 output_type="np",
                 num_inference_steps=3,
             )
             images.append(output.images[0])
-            del pipe
+            del pipe, output
             gc.collect()
             paddle.device.cuda.empty_cache()
         assert np.abs(images[0] - images[1]).sum() < 0.001
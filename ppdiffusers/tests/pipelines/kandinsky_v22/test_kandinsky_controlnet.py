@@ -191,22 +191,25 @@ class KandinskyV22ControlnetPipelineIntegrationTests(unittest.TestCase):
         hint = load_image(
             "https://huggingface.co/datasets/hf-internal-testing/diffusers-images/resolve/main/kandinskyv22/hint_image_cat.png"
         )
-        hint = paddle.to_tensor(data=np.array(hint)).astype(dtype="float32") / 255.0
-        hint = hint.transpose(perm=[2, 0, 1]).unsqueeze(axis=0)
+        # scale and lay out the hint on the host, so it is uploaded once, already as a [1, C, H, W] float tensor
+        hint = paddle.to_tensor(data=(np.array(hint, dtype=np.float32) / 255.0).transpose([2, 0, 1])[None])
         pipe_prior = KandinskyV22PriorPipeline.from_pretrained(
             "kandinsky-community/kandinsky-2-2-prior", paddle_dtype="float16"
         )
-
-        pipeline = KandinskyV22ControlnetPipeline.from_pretrained(
-            "kandinsky-community/kandinsky-2-2-controlnet-depth", paddle_dtype="float16"
-        )
-
-        pipeline.set_progress_bar_config(disable=None)
         prompt = "A robot, 4k photo"
         generator = paddle.Generator().manual_seed(0)
         image_emb, zero_image_emb = pipe_prior(
             prompt, generator=generator, num_inference_steps=5, negative_prompt=""
         ).to_tuple()
+        # only the embeddings are needed from here on, free the prior before loading the decoder
+        del pipe_prior
+        gc.collect()
+        paddle.device.cuda.empty_cache()
+
+        pipeline = KandinskyV22ControlnetPipeline.from_pretrained(
+            "kandinsky-community/kandinsky-2-2-controlnet-depth", paddle_dtype="float16"
+        )
+        pipeline.set_progress_bar_config(disable=None)
         generator = paddle.Generator().manual_seed(0)
         output = pipeline(
             image_embeds=image_emb,
@@ -0,0 +1,56 @@
+# Copyright (c) 2023 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import paddle
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../.."))
+from paddlemix.appflow.audio_asr import HOP_LENGTH, N_FFT, N_MELS, AudioASRTask
+
+
+class AudioASRLogMelTest(unittest.TestCase):
+    def setUp(self):
+        # Only the feature extraction is exercised, so the task is built without loading Whisper.
+        self.task = AudioASRTask.__new__(AudioASRTask)
+        rng = np.random.RandomState(0)
+        self.task._mel_filters = paddle.to_tensor(rng.rand(N_MELS, N_FFT // 2 + 1).astype("float32"))
+        self.task._hann_window = paddle.audio.functional.get_window("hann", N_FFT)
+        self.waveforms = [rng.randn(length).astype("float32") for length in (16000, 9130, 23999)]
+
+    def test_batched_features_match_single_clip(self):
+        batched = self.task._log_mel_spectrogram(self.waveforms)
+        for waveform, mel in zip(self.waveforms, batched):
+            (expected,) = self.task._log_mel_spectrogram([waveform])
+            self.assertEqual(mel.shape, expected.shape)
+            np.testing.assert_allclose(mel.numpy(), expected.numpy(), atol=1e-5)
+
+    def test_single_clip_matches_centered_stft(self):
+        waveform = self.waveforms[1]
+        stft = paddle.signal.stft(
+            paddle.to_tensor(waveform).unsqueeze(0), N_FFT, HOP_LENGTH, window=self.task._hann_window
+        )
+        log_spec = paddle.clip(paddle.matmul(self.task._mel_filters, stft[:, :, :-1].abs() ** 2), min=1e-10).log10()
+        log_spec = paddle.maximum(log_spec[0], log_spec.max() - 8.0)
+        expected = (log_spec + 4.0) / 4.0
+
+        (mel,) = self.task._log_mel_spectrogram([waveform])
+        np.testing.assert_allclose(mel.numpy(), expected.numpy(), atol=1e-5)
+
+
+if __name__ == "__main__":
+    unittest.main()